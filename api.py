@@ -9,7 +9,7 @@ from fastapi import HTTPException
 from pydantic import BaseModel
 import uuid
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List
+from typing import List, Optional
 import base64
 import socket
 import sys
@@ -24,6 +24,18 @@ from utils.cosmos_helpers import *
 from utils.id_document_processor import *
 from utils.general_helpers import *
 from utils.face_liveness import *
+from utils.async_helpers import *
+from utils.document_buffer import DocumentBuffer
+from utils.upload_helpers import StreamingDocumentUpload, UploadTooLargeError
+from utils.verdict_cache import verdict_cache
+from utils.analysis_memo import analysis_memo
+from utils.analysis_log import analysis_log
+from utils.extraction_cache import extraction_cache
+from utils.reference_face_cache import reference_face_cache
+from utils.face_detector import get_face_detector
+from utils.batch_jobs import BatchJobManager
+from utils.customer_directory import CustomerDirectory
+from utils.retry_helpers import get_retry_stats
 
 from env_vars import *
 
@@ -33,6 +45,8 @@ logger.setLevel(logging.INFO)
 
 cosmos = CosmosDBHelper()
 blob_helper = BlobStorageHelper()
+batch_jobs = BatchJobManager()
+customer_directory = CustomerDirectory(cosmos)
 
 hostname = socket.gethostname()
 local_ip = socket.gethostbyname(hostname)
@@ -50,6 +64,16 @@ class LivenessSessionResponse(BaseModel):
     authToken: str
     session_id: str
 
+class BatchJobItem(BaseModel):
+    customer_id: str
+    url: str
+
+class BatchJobRequest(BaseModel):
+    items: List[BatchJobItem]
+    name: Optional[str] = None
+    # "offline" sends the LLM calls through the OpenAI Batch API, for bulk backfills
+    mode: str = "online"
+
 # uvicorn main:app --reload
 app = FastAPI()
 
@@ -62,6 +86,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def startup_event():
+    # Load the local face detector model once, instead of on the first analysis
+    await run_blocking(get_face_detector)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    batch_jobs.shutdown()
+    # Writes the analysis results still queued
+    await run_blocking(analysis_log.shutdown)
+    shutdown_blocking_executor(wait=False)
+
 @app.post("/api/detectLiveness", response_model=LivenessSessionResponse)
 async def detect_liveness(
     parameters: str = Form(...),
@@ -95,31 +131,29 @@ async def livenessComplete(info: dict):
 
 @app.get("/api/customers")
 async def get_customers():
-    # Fetch list of customers from the database
-    customers = cosmos.get_all_documents()
-    # Return a list of customer IDs and names
-    customer_list = []
-    for customer in customers:
-        customer_id = customer.get("id")
-        first_name = customer.get("first_name", "")
-        last_name = customer.get("last_name", "")
-        full_name = f"{first_name} {last_name}".strip()
-        customer_list.append({
-            "id": customer_id,
-            "name": full_name
-        })
-    return customer_list
+    # The whole list of customer IDs and names, from the projected and cached pages
+    return await run_blocking(customer_directory.get_all)
+
+@app.get("/api/customers/page")
+async def get_customers_page(prefix: Optional[str] = None, page_size: int = CUSTOMER_LIST_PAGE_SIZE, continuation_token: Optional[str] = None):
+    # One page of customer IDs and names. Pass the returned continuation_token back to get the next page
+    if (page_size < 1) or (page_size > 1000):
+        raise HTTPException(status_code=400, detail="page_size must be between 1 and 1000.")
+    try:
+        return await run_blocking(customer_directory.get_page, prefix=prefix, page_size=page_size, continuation_token=continuation_token)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/api/get_sas")
 async def get_sas(info: dict):
     file_url = info.get("url", "")
     file_url = file_url.replace("'", "").replace('"', '')
-    return {"sas": blob_helper.create_sas_from_blob(file_url)}
+    return {"sas": await run_blocking(blob_helper.create_sas_from_blob, file_url)}
 
 @app.get("/api/customer/{customer_id}")
 async def get_customer(customer_id: str):
     # Fetch customer data from the database
-    customer_record = cosmos.read_document(customer_id, partition_key="customers")
+    customer_record = await run_blocking(cosmos.read_document, customer_id, partition_key="customers")
     if customer_record:
         return customer_record
     else:
@@ -134,27 +168,96 @@ async def upload_files(files: List[UploadFile] = File(...)):
 @app.post("/api/analyze")
 async def analyze_documents(info: dict):
     customer_id = info.get("customer_id", "")
-    id_document = base64.b64decode(info.get("id_document", ""))
     id_document_name = info.get("id_document_name", "")
+    id_document = DocumentBuffer.from_base64(id_document_name, info.get("id_document", ""))
 
     logger.info(f"Analyzing document for customer {customer_id}")
     logger.info(f"Document name: {id_document_name}")
     logger.info(f"Document size: {len(id_document)} bytes")
 
-    work_dir = "temp_imgs"
-    os.makedirs(work_dir, exist_ok=True)
-    im_fn = os.path.join(work_dir, id_document_name)
-    write_bytes_to_file(id_document, im_fn, "wb")
-    doc_processor = IDDocumentProcessor(customer_id=customer_id, doc_path=im_fn)
-    return doc_processor.compare_document_to_database()
+    # The document stays in memory for the whole pipeline. The pipeline itself (PDF rasterization,
+    # OpenAI, Blob, Cosmos, Face) is blocking, so it runs in the bounded executor to keep the event
+    # loop free for other requests. Results are memoized by document content and record version
+    return await run_blocking(analyze_document, customer_id, id_document)
+
+@app.post("/api/analyze/upload")
+async def analyze_document_upload(request: Request):
+    """
+    Multipart variant of /api/analyze, with the customer_id form field and the id_document file.
+    The body is parsed and hashed as it streams in, and the raw file bytes go straight to the
+    pipeline, without the base64 inflation and the copies of the JSON endpoint.
+    """
+    try:
+        upload = StreamingDocumentUpload(request.headers.get("content-type"))
+        async for chunk in request.stream():
+            upload.write(chunk)
+        upload.finish()
+        id_document = upload.to_document()
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    customer_id = upload.fields.get("customer_id", "")
+    if not customer_id:
+        raise HTTPException(status_code=400, detail="The customer_id form field is required.")
+
+    logger.info(f"Analyzing uploaded document {id_document.name} ({len(id_document)} bytes) for customer {customer_id}")
+    return await run_blocking(analyze_document, customer_id, id_document)
+
+@app.post("/api/jobs")
+async def create_batch_job(request: BatchJobRequest):
+    try:
+        return await run_blocking(batch_jobs.create_job, [item.dict() for item in request.items], name=request.name, mode=request.mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/jobs/{job_id}")
+async def get_batch_job(job_id: str):
+    job = await run_blocking(batch_jobs.get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+@app.get("/api/jobs/{job_id}/items")
+async def get_batch_job_items(job_id: str, status: Optional[str] = None, offset: int = 0, limit: int = 100):
+    return await run_blocking(batch_jobs.get_items, job_id, status=status, offset=offset, limit=limit)
+
+@app.post("/api/jobs/{job_id}/resume")
+async def resume_batch_job(job_id: str, retry_failed: bool = False):
+    job = await run_blocking(batch_jobs.resume_job, job_id, retry_failed=retry_failed)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+@app.get("/api/metrics")
+async def get_metrics():
+    return {
+        "verdict_cache": verdict_cache.get_stats(),
+        "analysis_memo": analysis_memo.get_stats(),
+        "extraction_cache": extraction_cache.get_stats(),
+        "reference_face_cache": reference_face_cache.get_stats(),
+        "customer_directory": customer_directory.get_stats(),
+        "analysis_log": analysis_log.get_stats(),
+        "cosmos": cosmos.get_stats(),
+        "openai_endpoints": openai_router.get_stats(),
+        "openai_retries": get_retry_stats(),
+    }
 
 @app.get("/api/status/{customer_id}")
 async def get_status(customer_id: str):
-    return {"customer_id": customer_id, "status": "green"}
+    # The status of the latest analysis of the customer: "green", "red", or "unknown" if never analyzed
+    return await run_blocking(analysis_log.get_status, customer_id)
 
 @app.get("/api/logs/{customer_id}")
-async def get_logs(customer_id: str):
-    return {"customer_id": customer_id, "logs": ["No discrepancies found."]}
+async def get_logs(customer_id: str, page_size: int = 20, continuation_token: Optional[str] = None):
+    # The analyses of the customer, latest first. Pass the returned continuation_token back to get older ones
+    if (page_size < 1) or (page_size > 100):
+        raise HTTPException(status_code=400, detail="page_size must be between 1 and 100.")
+    try:
+        return await run_blocking(analysis_log.get_logs, customer_id, page_size=page_size, continuation_token=continuation_token)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/api/update")
 async def update_customer(data: dict):
@@ -165,7 +268,9 @@ async def update_customer(data: dict):
     try: del data['processedPhotoUrl']
     except: pass
     
-    return cosmos.upsert_document(data)
+    result = await run_blocking(cosmos.upsert_document, data)
+    customer_directory.invalidate()
+    return result
 
 # # Mount the 'build' directory to serve static files
 # app.mount("/", StaticFiles(directory="ui/react-js/build", html=True), name="static")
@@ -0,0 +1,97 @@
+"""
+Measures the write request charge (RU) of customer documents under the index-everything policy the
+containers were created with, and under the policy of utils/cosmos_indexing.py. Each policy gets a
+temporary container in COSMOS_DB_NAME, which is deleted at the end.
+
+    python code/cosmos_index_benchmark.py --documents 200
+"""
+import uuid
+import random
+import asyncio
+import argparse
+
+from azure.cosmos import CosmosClient, PartitionKey
+from azure.identity import DefaultAzureCredential
+
+from utils.cosmos_helpers import AsyncCosmosDBHelper, close_async_cosmos_client
+from utils.cosmos_indexing import index_everything_policy, get_indexing_policy
+
+from env_vars import *
+
+
+first_names = ["John", "Maria", "Ahmed", "Yuki", "Olga", "Pedro", "Fatima", "Liam", "Chen", "Amara"]
+last_names = ["Doe", "Garcia", "Haddad", "Tanaka", "Ivanova", "Silva", "Khan", "Murphy", "Wang", "Okafor"]
+
+
+def make_customer(index):
+    """A synthetic customer record, with the fields of an extracted passport."""
+    first_name, last_name = random.choice(first_names), random.choice(last_names)
+    passport_number = f"{random.randint(10 ** 8, 10 ** 9 - 1)}"
+    return {
+        "id": f"benchmark-{index}-{uuid.uuid4().hex[:8]}",
+        "categoryId": COSMOS_CATEGORYID_VALUE,
+        "document_type": "Passport",
+        "first_name": first_name,
+        "middle_name": random.choice(first_names),
+        "last_name": last_name,
+        "date_of_birth": f"{random.randint(1, 28):02d}.{random.randint(1, 12):02d}.{random.randint(1950, 2005)}",
+        "nationality": "American",
+        "gender": random.choice(["M", "F"]),
+        "address": f"{random.randint(1, 999)} Main Street, Springfield, IL {random.randint(10000, 99999)}, United States",
+        "passport_number": passport_number,
+        "place_of_birth": "Springfield",
+        "passport_issue_date": "01.01.2020",
+        "passport_expiry_date": "01.01.2030",
+        "passport_place_of_issue": "Chicago",
+        "passport_mrz_code": f"P<USA{last_name.upper()}<<{first_name.upper()}".ljust(44, "<") + f"{passport_number}<USA850615M3001014<<<<<<<<<<<<<<04",
+        "photo": "yes",
+        "signature": "yes",
+        "additional_attributes": {"eye_color": "Brown", "height": "180 cm", "authority": "United States Department of State"},
+    }
+
+
+async def write_documents(container_name, documents):
+    """:return: The request charge of inserting the documents, then of replacing them with an updated address."""
+    helper = AsyncCosmosDBHelper(container_name)
+    try:
+        inserted = await helper.upsert_many(documents)
+        updated = await helper.upsert_many([{**document, "address": document["address"].replace("Main", "Oak")} for document in documents])
+    finally:
+        await close_async_cosmos_client()
+
+    for summary in [inserted, updated]:
+        if summary["failed"]:
+            raise RuntimeError(f"{len(summary['failed'])} writes failed, e.g. {next(iter(summary['failed'].values()))}")
+    return inserted["request_charge"], updated["request_charge"]
+
+
+def run_benchmark(documents):
+    client = CosmosClient(url=COSMOS_URI, credential=DefaultAzureCredential())
+    database = client.create_database_if_not_exists(id=COSMOS_DB_NAME)
+    tuned_policy, version = get_indexing_policy(COSMOS_CONTAINER_NAME)
+
+    results = {}
+    for name, policy in [("index everything (v1)", index_everything_policy), (f"tuned (v{version})", tuned_policy)]:
+        container_name = f"index-benchmark-{uuid.uuid4().hex[:8]}"
+        database.create_container(id=container_name, partition_key=PartitionKey(path="/categoryId"), indexing_policy=policy)
+        try:
+            results[name] = asyncio.run(write_documents(container_name, documents))
+        finally:
+            database.delete_container(container_name)
+
+    print(f"{len(documents)} customer documents, RU per write:")
+    print(f"{'policy':<24}{'insert':>10}{'replace':>10}")
+    for name, (insert_charge, replace_charge) in results.items():
+        print(f"{name:<24}{insert_charge / len(documents):>10.2f}{replace_charge / len(documents):>10.2f}")
+
+    (baseline_insert, _), (tuned_insert, _) = results.values()
+    print(f"Write RU saved by the tuned policy on inserts: {100 * (1 - tuned_insert / baseline_insert):.0f}%")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=200, help="Number of customer documents written per policy.")
+    args = parser.parse_args()
+
+    run_benchmark([make_customer(i) for i in range(args.documents)])
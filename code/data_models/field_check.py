@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Literal
+from typing import Literal, List
 
 class FieldComparisonResult(BaseModel):
     field1: str
@@ -7,4 +7,15 @@ class FieldComparisonResult(BaseModel):
     result: Literal['Same', 'Different', 'ToBeChecked']
 
     def to_string(self) -> str:
-        return str(self.dict())
\ No newline at end of file
+        return str(self.dict())
+
+
+class FieldBatchComparisonItem(BaseModel):
+    field_name: str
+    field1: str
+    field2: str
+    result: Literal['Same', 'Different', 'ToBeChecked']
+
+
+class FieldBatchComparisonResult(BaseModel):
+    results: List[FieldBatchComparisonItem]
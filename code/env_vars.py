@@ -27,6 +27,18 @@ AZURE_OPENAI_KEY_5 = os.environ.get('AZURE_OPENAI_KEY_5', '')
 AZURE_OPENAI_RESOURCE_6 = os.environ.get('AZURE_OPENAI_RESOURCE_6', '')
 AZURE_OPENAI_KEY_6 = os.environ.get('AZURE_OPENAI_KEY_6', '')
 
+# Load balancing over the above resources. Each one can also set AZURE_OPENAI_MODEL_<n> (deployment name,
+# defaults to AZURE_OPENAI_CHAT_DEPLOYMENT_NAME) and AZURE_OPENAI_TPM_<n> (tokens-per-minute budget, 0 for none)
+OPENAI_ROUTER_EJECT_SECONDS = float(os.environ.get('OPENAI_ROUTER_EJECT_SECONDS', '10'))
+
+# Retry and backoff policy of all the OpenAI calls, and the per-deployment circuit breakers
+OPENAI_RETRY_MAX_ATTEMPTS = int(os.environ.get('OPENAI_RETRY_MAX_ATTEMPTS', '6'))
+OPENAI_RETRY_BUDGET = float(os.environ.get('OPENAI_RETRY_BUDGET', '60'))
+OPENAI_RETRY_BASE_DELAY = float(os.environ.get('OPENAI_RETRY_BASE_DELAY', '0.5'))
+OPENAI_RETRY_MAX_DELAY = float(os.environ.get('OPENAI_RETRY_MAX_DELAY', '10'))
+OPENAI_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('OPENAI_CIRCUIT_FAILURE_THRESHOLD', '5'))
+OPENAI_CIRCUIT_RESET_TIMEOUT = float(os.environ.get('OPENAI_CIRCUIT_RESET_TIMEOUT', '30'))
+
 AZURE_OPENAI_EMBEDDING_MODEL_RESOURCE = os.environ.get('AZURE_OPENAI_EMBEDDING_MODEL_RESOURCE', '')
 AZURE_OPENAI_EMBEDDING_MODEL_RESOURCE_KEY = os.environ.get('AZURE_OPENAI_EMBEDDING_MODEL_RESOURCE_KEY', '')
 AZURE_OPENAI_EMBEDDING_MODEL_API_VERSION = os.environ.get('AZURE_OPENAI_EMBEDDING_MODEL_API_VERSION', '2023-12-01-preview')
@@ -43,6 +55,18 @@ AZURE_OPENAI_TOP_P = os.environ.get('AZURE_OPENAI_TOP_P', '')
 AZURE_OPENAI_MAX_TOKENS = os.environ.get('AZURE_OPENAI_MAX_TOKENS', '')
 AZURE_OPENAI_STOP_SEQUENCE = os.environ.get('AZURE_OPENAI_STOP_SEQUENCE', '')
 
+# Connection pool limits of the shared Azure OpenAI clients
+OPENAI_MAX_CONNECTIONS = int(os.environ.get('OPENAI_MAX_CONNECTIONS', '100'))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('OPENAI_MAX_KEEPALIVE_CONNECTIONS', '20'))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get('OPENAI_KEEPALIVE_EXPIRY', '60'))
+
+# Preprocessing of the images sent to the vision model
+LLM_IMAGE_MAX_LONG_EDGE = int(os.environ.get('LLM_IMAGE_MAX_LONG_EDGE', '1600'))
+LLM_IMAGE_MAX_BYTES = int(os.environ.get('LLM_IMAGE_MAX_BYTES', str(500 * 1024)))
+LLM_IMAGE_FORMAT = os.environ.get('LLM_IMAGE_FORMAT', 'JPEG')
+LLM_IMAGE_CROP_TO_DOCUMENT = os.environ.get('LLM_IMAGE_CROP_TO_DOCUMENT', 'False').lower() in ['true', '1', 'yes']
+PDF_RASTER_DPI = int(os.environ.get('PDF_RASTER_DPI', '150'))
+
 ROOT_PATH_INGESTION = os.environ.get('ROOT_PATH_INGESTION', '')
 
 COG_SERV_ENDPOINT = os.environ.get('COG_SERV_ENDPOINT', '')
@@ -85,6 +109,19 @@ CHAINLIT_APP = os.environ.get('CHAINLIT_APP', '')
 TENACITY_STOP_AFTER_DELAY = int(os.environ.get('TENACITY_STOP_AFTER_DELAY', '300'))
 TENACITY_TIMEOUT = int(os.environ.get('TENACITY_TIMEOUT', '200'))
 
+# Maximum number of blocking analysis pipelines a single API worker keeps in flight
+ANALYSIS_MAX_WORKERS = int(os.environ.get('ANALYSIS_MAX_WORKERS', '32'))
+# Number of threads running background work, such as the annotated image uploads
+BACKGROUND_MAX_WORKERS = int(os.environ.get('BACKGROUND_MAX_WORKERS', '4'))
+# Largest document accepted by the streaming /api/analyze/upload endpoint
+UPLOAD_MAX_MB = float(os.environ.get('UPLOAD_MAX_MB', '20'))
+# Maximum number of concurrent LLM field comparisons per analyzed document
+FIELD_CHECK_MAX_CONCURRENCY = int(os.environ.get('FIELD_CHECK_MAX_CONCURRENCY', '8'))
+# How mismatching fields are sent to the LLM: "parallel" (one request per field) or "batch" (one request per document)
+FIELD_CHECK_MODE = os.environ.get('FIELD_CHECK_MODE', 'parallel')
+# Decide obvious field matches/mismatches with deterministic rules before calling the LLM
+FIELD_NORMALIZER_ENABLED = os.environ.get('FIELD_NORMALIZER_ENABLED', 'True').lower() in ['true', '1', 'yes']
+
 ## AML
 AML_SUBSCRIPTION_ID=os.environ.get('AML_SUBSCRIPTION_ID', '')
 AML_RESOURCE_GROUP=os.environ.get('AML_RESOURCE_GROUP', '')
@@ -104,6 +141,78 @@ COSMOS_CATEGORYID = os.environ.get('COSMOS_CATEGORYID', 'prompts')
 COSMOS_CATEGORYID_VALUE = os.environ.get('COSMOS_CATEGORYID_VALUE', 'customers')
 COSMOS_LOG_CONTAINER = os.environ.get('COSMOS_LOG_CONTAINER', 'logs')
 
+# Caches
+CACHE_SQLITE_PATH = os.environ.get('CACHE_SQLITE_PATH', 'cache/kyc_cache.db')
+CACHE_COSMOS_CONTAINER = os.environ.get('CACHE_COSMOS_CONTAINER', 'cache')
+# Backend of the FieldChecker verdict cache: "memory", "sqlite", "cosmos" or "none"
+VERDICT_CACHE_BACKEND = os.environ.get('VERDICT_CACHE_BACKEND', 'memory')
+VERDICT_CACHE_TTL = int(os.environ.get('VERDICT_CACHE_TTL', str(7 * 24 * 3600)))
+VERDICT_CACHE_MAX_ENTRIES = int(os.environ.get('VERDICT_CACHE_MAX_ENTRIES', '50000'))
+# Read-through cache of the Cosmos documents read by CosmosDBHelper.read_document. Cached documents are
+# served as is for COSMOS_READ_CACHE_FRESH_SECONDS, then revalidated with their etag (If-None-Match)
+COSMOS_READ_CACHE_TTL = int(os.environ.get('COSMOS_READ_CACHE_TTL', '300'))
+COSMOS_READ_CACHE_FRESH_SECONDS = float(os.environ.get('COSMOS_READ_CACHE_FRESH_SECONDS', '5'))
+COSMOS_READ_CACHE_MAX_ENTRIES = int(os.environ.get('COSMOS_READ_CACHE_MAX_ENTRIES', '10000'))
+# Replaces the indexing policy of the existing containers when it differs from utils/cosmos_indexing.py
+COSMOS_MANAGE_INDEXING_POLICY = os.environ.get('COSMOS_MANAGE_INDEXING_POLICY', 'True').lower() in ['true', '1', 'yes']
+# Background writer of the analysis results to COSMOS_LOG_CONTAINER: records per write round,
+# seconds waited for more records before writing, and records waiting above which new ones are dropped
+ANALYSIS_LOG_BATCH_SIZE = int(os.environ.get('ANALYSIS_LOG_BATCH_SIZE', '500'))
+ANALYSIS_LOG_FLUSH_SECONDS = float(os.environ.get('ANALYSIS_LOG_FLUSH_SECONDS', '1'))
+ANALYSIS_LOG_MAX_QUEUE = int(os.environ.get('ANALYSIS_LOG_MAX_QUEUE', '10000'))
+# Bulk operations of AsyncCosmosDBHelper: requests in flight, and retries of a throttled (429) request
+COSMOS_BULK_MAX_CONCURRENCY = int(os.environ.get('COSMOS_BULK_MAX_CONCURRENCY', '32'))
+COSMOS_BULK_MAX_RETRIES = int(os.environ.get('COSMOS_BULK_MAX_RETRIES', '10'))
+# Short-lived cache of the /api/customers pages, invalidated by /api/update
+CUSTOMER_LIST_CACHE_TTL = int(os.environ.get('CUSTOMER_LIST_CACHE_TTL', '30'))
+CUSTOMER_LIST_PAGE_SIZE = int(os.environ.get('CUSTOMER_LIST_PAGE_SIZE', '100'))
+# Local CPU face detector pre-screening documents before the Face API: "yolo", "yunet" or "none"
+LOCAL_FACE_DETECTOR = os.environ.get('LOCAL_FACE_DETECTOR', 'none')
+# Weights of the "yolo" backend: YOLO weights trained on faces, with face as class 0
+LOCAL_YOLO_MODEL_PATH = os.environ.get('LOCAL_YOLO_MODEL_PATH', 'yolov8n-face.pt')
+# Weights of the "yunet" backend: the YuNet ONNX model of the OpenCV model zoo
+LOCAL_YUNET_MODEL_PATH = os.environ.get('LOCAL_YUNET_MODEL_PATH', 'face_detection_yunet_2023mar.onnx')
+LOCAL_FACE_MIN_CONFIDENCE = float(os.environ.get('LOCAL_FACE_MIN_CONFIDENCE', '0.4'))
+# Batch re-verification jobs, checkpointed in their own Cosmos container
+BATCH_JOBS_CONTAINER = os.environ.get('BATCH_JOBS_CONTAINER', 'jobs')
+# Number of items of a batch job analyzed at the same time
+BATCH_JOB_MAX_CONCURRENCY = int(os.environ.get('BATCH_JOB_MAX_CONCURRENCY', '8'))
+# Number of finished items between two checkpoints of the job progress
+BATCH_JOB_CHECKPOINT_EVERY = int(os.environ.get('BATCH_JOB_CHECKPOINT_EVERY', '10'))
+# Concurrency limits of the batch jobs per downstream service, 0 for no limit
+BATCH_BLOB_CONCURRENCY = int(os.environ.get('BATCH_BLOB_CONCURRENCY', '8'))
+BATCH_OPENAI_CONCURRENCY = int(os.environ.get('BATCH_OPENAI_CONCURRENCY', '4'))
+BATCH_FACE_CONCURRENCY = int(os.environ.get('BATCH_FACE_CONCURRENCY', '4'))
+BATCH_COSMOS_CONCURRENCY = int(os.environ.get('BATCH_COSMOS_CONCURRENCY', '8'))
+# In-memory cache of the downloaded and detected customer reference photos
+REFERENCE_FACE_CACHE_TTL = int(os.environ.get('REFERENCE_FACE_CACHE_TTL', str(24 * 3600)))
+REFERENCE_FACE_CACHE_MAX_ENTRIES = int(os.environ.get('REFERENCE_FACE_CACHE_MAX_ENTRIES', '256'))
+# Cache of the extracted IDDocuments, keyed by document hash, prompt and model. The entries hold the
+# personal data of the documents: "sqlite" (a plain local file) and "cosmos" persist it, so they are opt-in
+EXTRACTION_CACHE_BACKEND = os.environ.get('EXTRACTION_CACHE_BACKEND', 'memory')
+EXTRACTION_CACHE_TTL = int(os.environ.get('EXTRACTION_CACHE_TTL', str(30 * 24 * 3600)))
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.environ.get('EXTRACTION_CACHE_MAX_ENTRIES', '10000'))
+# Memo of the /api/analyze results, keyed by document hash and customer record etag
+ANALYSIS_MEMO_BACKEND = os.environ.get('ANALYSIS_MEMO_BACKEND', 'memory')
+ANALYSIS_MEMO_TTL = int(os.environ.get('ANALYSIS_MEMO_TTL', str(24 * 3600)))
+ANALYSIS_MEMO_MAX_ENTRIES = int(os.environ.get('ANALYSIS_MEMO_MAX_ENTRIES', '1000'))
+# Offline mode of the batch jobs, through the Azure OpenAI Batch API. The deployment must be a Global-Batch
+# deployment of the same model as the online ones, since the extractions and verdicts share their caches,
+# which are keyed by the online deployment names. It defaults to the online chat deployment name
+AZURE_OPENAI_BATCH_RESOURCE = os.environ.get('AZURE_OPENAI_BATCH_RESOURCE', AZURE_OPENAI_RESOURCE)
+AZURE_OPENAI_BATCH_KEY = os.environ.get('AZURE_OPENAI_BATCH_KEY', AZURE_OPENAI_KEY)
+AZURE_OPENAI_BATCH_DEPLOYMENT = os.environ.get('AZURE_OPENAI_BATCH_DEPLOYMENT', '') or os.environ.get('AZURE_OPENAI_CHAT_DEPLOYMENT_NAME', '')
+AZURE_OPENAI_BATCH_API_VERSION = os.environ.get('AZURE_OPENAI_BATCH_API_VERSION', '2024-10-21')
+# Base URL of an OpenAI-compatible batch server to use instead of Azure, e.g. http://localhost:8001/v1 for code/local_batch_server.py
+OPENAI_BATCH_ENDPOINT = os.environ.get('OPENAI_BATCH_ENDPOINT', '')
+OPENAI_BATCH_POLL_SECONDS = float(os.environ.get('OPENAI_BATCH_POLL_SECONDS', '30'))
+OPENAI_BATCH_TIMEOUT = float(os.environ.get('OPENAI_BATCH_TIMEOUT', str(25 * 3600)))
+# Limits of a single batch input file, above which the requests are split over several batches
+OPENAI_BATCH_MAX_REQUESTS = int(os.environ.get('OPENAI_BATCH_MAX_REQUESTS', '50000'))
+OPENAI_BATCH_MAX_FILE_MB = float(os.environ.get('OPENAI_BATCH_MAX_FILE_MB', '180'))
+# Number of items of an offline batch job whose LLM calls are sent together as one round of batches
+BATCH_JOB_OFFLINE_CHUNK_SIZE = int(os.environ.get('BATCH_JOB_OFFLINE_CHUNK_SIZE', '500'))
+
 
 INITIAL_INDEX = os.environ.get('INITIAL_INDEX', 'rag-data')
 
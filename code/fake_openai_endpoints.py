@@ -0,0 +1,191 @@
+"""
+Fake Azure OpenAI chat-completion endpoints, to try the OpenAIRouter without real deployments.
+Each fake endpoint answers with a fixed completion after a configurable latency, or with a
+configurable error status (429 with Retry-After, 5xx), which can be changed while it runs.
+
+Serve fake endpoints, e.g. for AZURE_OPENAI_RESOURCE="http://localhost:8101" and
+AZURE_OPENAI_RESOURCE_1="http://localhost:8102":
+
+    python code/fake_openai_endpoints.py serve --count 2
+    curl -X PUT localhost:8101/fake/behavior -H "Content-Type: application/json" -d '{"status": 429, "retry_after": 5}'
+
+Or check the load balancing, ejection, Retry-After failover and endpoint dedupe of the router:
+
+    python code/fake_openai_endpoints.py check
+"""
+import os
+import sys
+import time
+import uuid
+import argparse
+import threading
+
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from typing import Optional
+
+from utils.openai_helpers import get_azure_openai_client, get_resource_endpoint
+from utils.openai_router import OpenAIRouter, OpenAIEndpoint, NoHealthyEndpointError
+from utils.async_helpers import run_concurrently
+
+from env_vars import *
+
+
+fake_api_version = "2024-10-21"
+fake_deployment = "fake-gpt"
+
+
+class FakeBehavior(BaseModel):
+    latency: float = 0.05
+    # 200 to answer, or the error status to return, e.g. 429 or 503
+    status: int = 200
+    retry_after: Optional[float] = None
+
+
+def create_app(name):
+    """:return: A fake endpoint, whose behavior is app.state.behavior and its served calls app.state.requests."""
+    app = FastAPI()
+    app.state.behavior = FakeBehavior()
+    app.state.requests = 0
+    lock = threading.Lock()
+
+    @app.post("/openai/deployments/{deployment}/chat/completions")
+    def chat_completions(deployment: str, body: dict):
+        behavior = app.state.behavior
+        with lock:
+            app.state.requests += 1
+        time.sleep(behavior.latency)
+
+        if behavior.status != 200:
+            headers = {"retry-after": str(behavior.retry_after)} if behavior.retry_after is not None else {}
+            return JSONResponse(status_code=behavior.status, headers=headers, content={"error": {"code": str(behavior.status), "message": f"Fake error from {name}"}})
+
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": deployment,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": f"Answered by {name}"}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+        }
+
+    @app.put("/fake/behavior")
+    def set_behavior(behavior: FakeBehavior):
+        app.state.behavior = behavior
+        return behavior
+
+    return app
+
+
+def serve(apps, first_port):
+    """Starts the fake endpoints in background threads. :return: Their base URLs."""
+    urls = []
+    for i, app in enumerate(apps):
+        server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=first_port + i, log_level="warning"))
+        threading.Thread(target=server.run, name=f"kyc-fake-openai-{i}", daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+        urls.append(f"http://127.0.0.1:{first_port + i}")
+    return urls
+
+
+def client_factory(azure_endpoint, api_key):
+    return get_azure_openai_client(azure_endpoint, api_key, api_version=fake_api_version)
+
+
+def complete(router):
+    return router.call(lambda endpoint: endpoint.client.chat.completions.create(
+        model=endpoint.deployment,
+        messages=[{"role": "user", "content": "ping"}],
+        timeout=10
+    ))
+
+
+def run_checks(first_port):
+    """:return: True if all the checks passed."""
+    apps = [create_app(f"fake-{i}") for i in range(3)]
+    urls = serve(apps, first_port)
+    results = []
+
+    def check(description, passed):
+        results.append(passed)
+        print(f"[{'PASS' if passed else 'FAIL'}] {description}")
+
+    def reset():
+        for app in apps:
+            app.state.behavior = FakeBehavior()
+            app.state.requests = 0
+
+    def new_router(eject_seconds=1):
+        # Distinct deployment names per router, so that the circuit breakers start closed
+        deployment = f"{fake_deployment}-{uuid.uuid4().hex[:6]}"
+        return OpenAIRouter([OpenAIEndpoint(f"fake-{i}", url, "fake", deployment, 0, client_factory) for i, url in enumerate(urls)], eject_seconds=eject_seconds)
+
+    # Least outstanding requests: concurrent calls spread over all the endpoints
+    reset()
+    router = new_router()
+    for app in apps: app.state.behavior = FakeBehavior(latency=0.2)
+    run_concurrently([lambda: complete(router) for _ in range(30)], max_concurrency=30)
+    served = [app.state.requests for app in apps]
+    check(f"30 concurrent calls spread over the 3 endpoints: {served}", min(served) >= 5)
+
+    # A 429 ejects its endpoint for its Retry-After time, and the calls fail over to the others
+    reset()
+    router = new_router()
+    apps[0].state.behavior = FakeBehavior(status=429, retry_after=2)
+    answers = [complete(router).choices[0].message.content for _ in range(12)]
+    check(f"12 calls succeed while fake-0 throttles: {sorted(set(answers))}", all(["fake-0" not in answer for answer in answers]))
+    check(f"fake-0 is called once, then ejected: {apps[0].state.requests} calls", apps[0].state.requests == 1)
+    ejected_for = [e["ejected_for"] for e in router.get_stats() if e["name"] == "fake-0"][0]
+    check(f"fake-0 is ejected for its Retry-After of 2 seconds: {ejected_for:.1f} s left", 1.0 < ejected_for <= 2.0)
+
+    for app in apps: app.state.behavior = FakeBehavior(latency=0.2)
+    time.sleep(2.1)
+    run_concurrently([lambda: complete(router) for _ in range(12)], max_concurrency=12)
+    check(f"fake-0 serves calls again after its Retry-After: {apps[0].state.requests - 1} calls", apps[0].state.requests > 1)
+
+    # A half-open circuit breaker whose probe call was claimed by another caller gets no other call,
+    # even when the probe is claimed between the health check and the pick of the endpoint
+    reset()
+    router = new_router()
+    breaker = router.endpoints[0].breaker
+    breaker.opened_at = time.time() - breaker.reset_timeout
+    breaker.allow()
+    breaker.is_available = lambda: True
+    for _ in range(6): complete(router)
+    breaker.record_success()
+    check(f"fake-0 gets no call while its probe is in flight: {apps[0].state.requests} calls", apps[0].state.requests == 0)
+
+    # With every endpoint failing, the router says when to retry instead of spinning
+    reset()
+    router = new_router(eject_seconds=1)
+    for app in apps: app.state.behavior = FakeBehavior(status=503)
+    try:
+        complete(router)
+        check("NoHealthyEndpointError when all the endpoints fail", False)
+    except NoHealthyEndpointError as e:
+        check(f"NoHealthyEndpointError when all the endpoints fail, retry after {e.retry_after:.1f} s", (0 < e.retry_after <= 1) and (sum([app.state.requests for app in apps]) == 3))
+
+    # The same resource and deployment configured twice is a single endpoint
+    os.environ.update({"AZURE_OPENAI_RESOURCE": urls[0], "AZURE_OPENAI_RESOURCE_1": urls[0] + "/", "AZURE_OPENAI_RESOURCE_2": urls[1], "AZURE_OPENAI_CHAT_DEPLOYMENT_NAME": fake_deployment})
+    router = OpenAIRouter.from_env(client_factory, None, get_resource_endpoint)
+    check(f"Duplicate deployments are merged: {[e.name for e in router.endpoints]}", [e.name for e in router.endpoints] == ["primary", "resource_2"])
+
+    return all(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["serve", "check"])
+    parser.add_argument("--count", type=int, default=2, help="Number of fake endpoints to serve.")
+    parser.add_argument("--port", type=int, default=8101, help="Port of the first fake endpoint, the next ones follow.")
+    args = parser.parse_args()
+
+    if args.command == "check":
+        sys.exit(0 if run_checks(args.port) else 1)
+
+    for url in serve([create_app(f"fake-{i}") for i in range(args.count)], args.port):
+        print(f"Fake Azure OpenAI endpoint on {url}")
+    threading.Event().wait()
@@ -0,0 +1,201 @@
+"""
+Local stand-in for the OpenAI Batch API, to try the offline batch jobs without a Global-Batch
+deployment. It implements the files and batches endpoints used by OpenAIBatchRunner, and runs
+each request of a batch as a synchronous chat completion on the usual deployments.
+
+    python code/local_batch_server.py
+    OPENAI_BATCH_ENDPOINT="http://localhost:8001/v1" OPENAI_BATCH_POLL_SECONDS="2"
+"""
+import json
+import time
+import uuid
+import logging
+import threading
+
+import uvicorn
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.responses import Response
+from pydantic import BaseModel
+from typing import Optional
+
+from utils.openai_helpers import openai_router
+from utils.retry_helpers import openai_retry
+from utils.async_helpers import run_concurrently
+
+from env_vars import *
+
+
+@openai_retry
+def complete_with_router(body):
+    """Runs one chat completion request of a batch on the least loaded healthy deployment."""
+    response = openai_router.call(lambda endpoint: endpoint.client.chat.completions.create(
+        **{**body, "model": endpoint.deployment},
+        timeout=TENACITY_TIMEOUT
+    ))
+    return response.model_dump()
+
+
+class BatchCreateRequest(BaseModel):
+    input_file_id: str
+    endpoint: str
+    completion_window: str
+    metadata: Optional[dict] = None
+
+
+def create_app(complete=complete_with_router, max_concurrency=4):
+    """
+    :param complete: A callable taking the body of a request and returning the chat completion as a dict.
+    :param max_concurrency: Number of requests of a batch running at the same time.
+    """
+    app = FastAPI()
+    lock = threading.Lock()
+    files = {}
+    batches = {}
+
+    def store_file(content, filename, purpose):
+        file_id = f"file-{uuid.uuid4().hex}"
+        files[file_id] = {
+            "meta": {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()), "filename": filename, "purpose": purpose, "status": "processed"},
+            "content": content,
+        }
+        return files[file_id]["meta"]
+
+    def run_request(batch, request):
+        if batch["cancelling"]:
+            return None
+
+        try:
+            body = complete(request["body"])
+            return {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"], "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": body}, "error": None}
+        except Exception as e:
+            logging.warning(f"Batch request {request['custom_id']} failed: {e}")
+            return {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"], "response": None, "error": {"code": type(e).__name__, "message": str(e)}}
+
+    def parse_input(batch):
+        """:return: The requests of the input file, raising ValueError on the first invalid line, as the validation of the Batch API does."""
+        requests = []
+        for i, line in enumerate(files[batch["input_file_id"]]["content"].decode("utf-8").splitlines()):
+            if not line.strip(): continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"Line {i + 1} of the input file is not valid JSON: {e}")
+            if (not isinstance(request, dict)) or ("custom_id" not in request) or ("body" not in request):
+                raise ValueError(f"Line {i + 1} of the input file needs a custom_id and a body.")
+            requests.append(request)
+        return requests
+
+    def fail_batch(batch, code, message):
+        with lock:
+            batch.update({"status": "failed", "failed_at": int(time.time()), "errors": {"object": "list", "data": [{"code": code, "message": message}]}})
+
+    def run_batch(batch_id):
+        batch = batches[batch_id]
+        try:
+            requests = parse_input(batch)
+        except ValueError as e:
+            fail_batch(batch, "invalid_request", str(e))
+            return
+
+        with lock:
+            # A cancel received while validating wins over the start of the batch
+            if batch["cancelling"]:
+                batch.update({"status": "cancelled", "cancelled_at": int(time.time())})
+                return
+            batch.update({"status": "in_progress", "in_progress_at": int(time.time())})
+            batch["request_counts"]["total"] = len(requests)
+
+        try:
+            outputs = run_concurrently([lambda request=request: run_request(batch, request) for request in requests], max_concurrency=max_concurrency)
+        except Exception as e:
+            logging.error(f"Local batch {batch_id} failed: {e}")
+            fail_batch(batch, type(e).__name__, str(e))
+            return
+
+        succeeded = [output for output in outputs if (output is not None) and (output["error"] is None)]
+        failed = [output for output in outputs if (output is not None) and (output["error"] is not None)]
+
+        with lock:
+            if succeeded:
+                batch["output_file_id"] = store_file("".join([json.dumps(o) + "\n" for o in succeeded]).encode("utf-8"), f"{batch_id}_output.jsonl", "batch_output")["id"]
+            if failed:
+                batch["error_file_id"] = store_file("".join([json.dumps(o) + "\n" for o in failed]).encode("utf-8"), f"{batch_id}_error.jsonl", "batch_output")["id"]
+
+            batch["request_counts"].update({"completed": len(succeeded), "failed": len(failed)})
+            if batch["cancelling"]:
+                batch.update({"status": "cancelled", "cancelled_at": int(time.time())})
+            else:
+                batch.update({"status": "completed", "completed_at": int(time.time())})
+
+    def public(batch):
+        return {k: v for k, v in batch.items() if k != "cancelling"}
+
+    @app.post("/v1/files")
+    async def create_file(file: UploadFile = File(...), purpose: str = Form(...)):
+        content = await file.read()
+        with lock:
+            return store_file(content, file.filename, purpose)
+
+    @app.get("/v1/files/{file_id}")
+    async def get_file(file_id: str):
+        if file_id not in files:
+            raise HTTPException(status_code=404, detail="File not found")
+        return files[file_id]["meta"]
+
+    @app.get("/v1/files/{file_id}/content")
+    async def get_file_content(file_id: str):
+        if file_id not in files:
+            raise HTTPException(status_code=404, detail="File not found")
+        return Response(content=files[file_id]["content"], media_type="application/jsonl")
+
+    @app.post("/v1/batches")
+    async def create_batch(request: BatchCreateRequest):
+        if request.input_file_id not in files:
+            raise HTTPException(status_code=404, detail="Input file not found")
+
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        with lock:
+            batches[batch_id] = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": request.endpoint,
+                "errors": None,
+                "input_file_id": request.input_file_id,
+                "completion_window": request.completion_window,
+                "status": "validating",
+                "output_file_id": None,
+                "error_file_id": None,
+                "created_at": int(time.time()),
+                "request_counts": {"total": 0, "completed": 0, "failed": 0},
+                "metadata": request.metadata,
+                "cancelling": False,
+            }
+
+        threading.Thread(target=run_batch, args=(batch_id,), name=f"kyc-local-batch-{batch_id}", daemon=True).start()
+        return public(batches[batch_id])
+
+    @app.get("/v1/batches/{batch_id}")
+    async def get_batch(batch_id: str):
+        if batch_id not in batches:
+            raise HTTPException(status_code=404, detail="Batch not found")
+        return public(batches[batch_id])
+
+    @app.post("/v1/batches/{batch_id}/cancel")
+    async def cancel_batch(batch_id: str):
+        if batch_id not in batches:
+            raise HTTPException(status_code=404, detail="Batch not found")
+
+        batch = batches[batch_id]
+        with lock:
+            if batch["status"] not in ["completed", "failed", "expired", "cancelled"]:
+                batch.update({"cancelling": True, "status": "cancelling", "cancelling_at": int(time.time())})
+            return public(batch)
+
+    return app
+
+
+app = create_app()
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=8001)
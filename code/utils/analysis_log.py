@@ -0,0 +1,213 @@
+import time
+import uuid
+import queue
+import logging
+import threading
+from datetime import datetime, timezone
+
+from utils.cosmos_helpers import *
+from utils.openai_helpers import openai_router
+from utils.face_service import face_detection_model, face_recognition_model
+
+from env_vars import *
+
+
+# Cosmos executes at most 100 operations per transactional batch
+max_batch_operations = 100
+
+
+def utc_now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def get_model_versions():
+    """:return: The models configured for the analyses: the OpenAI deployments, and the Face API and local detector models."""
+    return {
+        "openai_deployments": openai_router.get_deployments(),
+        "openai_api_version": AZURE_OPENAI_API_VERSION,
+        "face_detection_model": face_detection_model.value,
+        "face_recognition_model": face_recognition_model.value,
+        "local_face_detector": LOCAL_FACE_DETECTOR,
+    }
+
+
+class AnalysisLog:
+    """
+    Persists the outcome of every document analysis in the logs container, one document per
+    analysis in the partition of the customer, and serves the status and logs of a customer from it.
+
+    Writes add no latency to the analyses: record() only queues the document, and a background
+    thread writes the queue every ANALYSIS_LOG_FLUSH_SECONDS, grouped by customer as transactional
+    batches, with a fallback to one upsert per document when a batch fails. A record may therefore
+    show up in the queries about a second after its analysis returned. When the queue is full,
+    e.g. while Cosmos is unavailable, new records are dropped rather than blocking the analyses.
+    """
+
+    log_type = "analysis"
+
+    status_query = (
+        "SELECT TOP 1 c.id, c.timestamp, c.status, c.data_fields_status, c.photo_comparison_status, c.document FROM c "
+        "WHERE c.categoryId = @customerId AND c.type = @type ORDER BY c.timestamp DESC"
+    )
+    logs_query = (
+        "SELECT c.id, c.timestamp, c.status, c.document, c.log_checks, c.data_fields_checks, c.photo_comparison_status, c.stage_timings, c.models FROM c "
+        "WHERE c.categoryId = @customerId AND c.type = @type ORDER BY c.timestamp DESC"
+    )
+
+    def __init__(self, container_name=COSMOS_LOG_CONTAINER, flush_interval=ANALYSIS_LOG_FLUSH_SECONDS, max_queue=ANALYSIS_LOG_MAX_QUEUE, batch_size=ANALYSIS_LOG_BATCH_SIZE):
+        """
+        :param flush_interval: How long the writer waits for more records before writing a batch, in seconds.
+        :param max_queue: Number of records waiting to be written, above which new records are dropped.
+        :param batch_size: Number of records written per round, split into one transactional batch per customer.
+        """
+        # Each analysis is written once and never updated, so its reads are not cached
+        self.cosmos = CosmosDBHelper(container_name, read_cache_ttl=0)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_queue)
+
+        self.lock = threading.Lock()
+        self.counters = {"queued": 0, "written": 0, "batches": 0, "fallback_upserts": 0, "failed": 0, "dropped": 0}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def increment(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def build_record(self, customer_id, document, result):
+        """
+        :param document: The analyzed DocumentBuffer.
+        :param result: The compare_document_to_database result.
+        :return: The log document. The extracted fields are not copied: the checks and the verdicts are.
+        """
+        ok = bool(result.get("data_fields_status")) and bool(result.get("photo_comparison_status"))
+        return {
+            "id": str(uuid.uuid4()),
+            "categoryId": customer_id,
+            "type": self.log_type,
+            "timestamp": utc_now(),
+            "status": "green" if ok else "red",
+            "document": {"name": document.name, "sha256": document.sha256, "size": len(document)},
+            "data_fields_checks": result.get("data_fields_checks"),
+            "data_fields_status": result.get("data_fields_status"),
+            "photo_comparison_result": result.get("photo_comparison_result"),
+            "photo_comparison_status": result.get("photo_comparison_status"),
+            "log_checks": result.get("log_checks"),
+            "stage_timings": result.get("stage_timings"),
+            "models": get_model_versions(),
+        }
+
+    def record(self, customer_id, document, result):
+        """Queues the log document of an analysis, without waiting for it to be written."""
+        try:
+            self.queue.put_nowait(self.build_record(customer_id, document, result))
+            self.increment("queued")
+        except queue.Full:
+            self.increment("dropped")
+            logging.warning(f"The analysis log queue is full, dropping the record of customer {customer_id}.")
+            return
+
+        self.start()
+
+    def start(self):
+        with self.lock:
+            if (self.thread is None) or (not self.thread.is_alive()):
+                self.stop_event.clear()
+                self.thread = threading.Thread(target=self.run, name="kyc-analysis-log", daemon=True)
+                self.thread.start()
+
+    def take_batch(self):
+        """Waits for a first record, then collects the records arriving within the flush interval."""
+        try:
+            records = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+
+        deadline = time.time() + self.flush_interval
+        while len(records) < self.batch_size:
+            try:
+                records.append(self.queue.get(timeout=max(0.0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return records
+
+    def write(self, records):
+        """Writes the records as one transactional batch per customer, or one by one if a batch fails."""
+        by_customer = {}
+        for record in records:
+            by_customer.setdefault(record["categoryId"], []).append(record)
+
+        for customer_id, customer_records in by_customer.items():
+            for i in range(0, len(customer_records), max_batch_operations):
+                chunk = customer_records[i:i + max_batch_operations]
+                try:
+                    self.cosmos.upsert_batch(chunk, partition_key=customer_id)
+                    self.increment("batches")
+                    self.increment("written", len(chunk))
+                    continue
+                except Exception as e:
+                    logging.warning(f"Transactional batch of {len(chunk)} analysis records failed, writing them one by one: {e}")
+
+                for record in chunk:
+                    self.increment("fallback_upserts")
+                    if self.cosmos.upsert_document(record) is None:
+                        self.increment("failed")
+                    else:
+                        self.increment("written")
+
+    def run(self):
+        while not (self.stop_event.is_set() and self.queue.empty()):
+            records = self.take_batch()
+            if not records:
+                continue
+
+            try:
+                self.write(records)
+            except Exception as e:
+                self.increment("failed", len(records))
+                logging.error(f"Failed to write {len(records)} analysis records: {e}")
+            finally:
+                for _ in records:
+                    self.queue.task_done()
+
+    def flush(self):
+        """Blocks until the queued records are written."""
+        if (self.thread is not None) and self.thread.is_alive():
+            self.queue.join()
+
+    def shutdown(self, timeout=10):
+        """Writes the queued records and stops the writer thread, e.g. when the API shuts down."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=timeout)
+
+    def get_status(self, customer_id):
+        """
+        :return: The status of the latest analysis of the customer ('green' when all the fields and the
+            photo match, 'red' otherwise, 'unknown' when the customer was never analyzed), with its summary.
+        """
+        parameters = [{"name": "@customerId", "value": customer_id}, {"name": "@type", "value": self.log_type}]
+        records, _ = self.cosmos.query_page(self.status_query, parameters, page_size=1, partition_key=customer_id)
+
+        if len(records) == 0:
+            return {"customer_id": customer_id, "status": "unknown", "last_analysis": None}
+        return {"customer_id": customer_id, "status": records[0]["status"], "last_analysis": records[0]}
+
+    def get_logs(self, customer_id, page_size=20, continuation_token=None):
+        """
+        :param continuation_token: The token of the previous page, None for the latest analyses.
+        :return: A dict with the analysis 'logs' of the customer, latest first, and the 'continuation_token' of the next page.
+        """
+        parameters = [{"name": "@customerId", "value": customer_id}, {"name": "@type", "value": self.log_type}]
+        records, next_token = self.cosmos.query_page(self.logs_query, parameters, page_size=page_size, continuation_token=continuation_token, partition_key=customer_id)
+        return {"customer_id": customer_id, "logs": records, "continuation_token": next_token}
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["pending"] = self.queue.qsize()
+        return stats
+
+
+analysis_log = AnalysisLog()
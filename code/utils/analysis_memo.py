@@ -0,0 +1,71 @@
+import logging
+import threading
+from concurrent.futures import Future
+
+from utils.cache_helpers import *
+
+from env_vars import *
+
+
+class AnalysisMemo:
+    """
+    Memoizes the document analysis results by (document content hash, customer record etag), so a
+    resubmitted document returns the previous result without rerunning extraction, uploads and face
+    detection. Any update of the customer record changes its etag and naturally invalidates the entry.
+    Concurrent identical submissions are coalesced onto a single in-flight computation.
+    """
+
+    def __init__(self, backend="memory", ttl=ANALYSIS_MEMO_TTL, max_entries=ANALYSIS_MEMO_MAX_ENTRIES):
+        self.cache = JSONCache(create_cache_backend(backend, "analyses", ttl=ttl, max_entries=max_entries))
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def make_key(self, content_hash, customer_id, etag):
+        return make_cache_key("analysis", content_hash, customer_id, etag or "")
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the memoized result for the key. On a miss, the first caller runs compute() while
+        the concurrent callers for the same key wait for its result. Failures are not memoized.
+
+        :param key: The memo key, from make_key.
+        :param compute: A zero-argument callable returning the JSON-serializable analysis result.
+        """
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
+        with self.lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.in_flight[key] = future
+
+        if not owner:
+            logging.info("Identical analysis already in flight, waiting for its result.")
+            self.cache.stats.increment("coalesced")
+            return future.result()
+
+        try:
+            result = compute()
+            self.cache.set(key, result)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+
+        return result
+
+    def get_stats(self):
+        stats = self.cache.get_stats()
+        with self.lock:
+            stats["in_flight"] = len(self.in_flight)
+        return stats
+
+
+analysis_memo = AnalysisMemo(backend=ANALYSIS_MEMO_BACKEND)
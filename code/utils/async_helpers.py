@@ -0,0 +1,108 @@
+import asyncio
+import functools
+import logging
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+from env_vars import *
+
+
+# Shared, bounded pool used to run the blocking SDK calls (OpenAI, Cosmos, Blob, Face)
+# off the event loop. Its size caps how many blocking pipelines a single worker runs at once.
+blocking_executor = ThreadPoolExecutor(max_workers=ANALYSIS_MAX_WORKERS, thread_name_prefix="kyc-blocking")
+
+# Small pool for fire-and-forget work kept off the critical path of a request, such as
+# uploading annotated images whose URLs were already returned
+background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_MAX_WORKERS, thread_name_prefix="kyc-background")
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Runs a blocking function in the shared bounded executor and awaits its result,
+    so that the event loop stays free to serve other requests in the meantime.
+
+    :param func: The blocking callable.
+    :param args: Positional arguments for the callable.
+    :param kwargs: Keyword arguments for the callable.
+    :return: The return value of the callable.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, functools.partial(func, *args, **kwargs))
+
+
+def run_concurrently(funcs, max_concurrency=8):
+    """
+    Runs blocking callables concurrently in a dedicated bounded pool and returns their
+    results in the same order as the callables. The first exception raised is re-raised.
+
+    A dedicated pool is used instead of the shared one, so that callers already running
+    inside the shared executor cannot starve it and deadlock.
+
+    :param funcs: A list of zero-argument callables.
+    :param max_concurrency: Maximum number of callables running at the same time.
+    :return: A list with the return values of the callables.
+    """
+    if len(funcs) == 0:
+        return []
+
+    if (len(funcs) == 1) or (max_concurrency <= 1):
+        return [func() for func in funcs]
+
+    with ThreadPoolExecutor(max_workers=min(max_concurrency, len(funcs)), thread_name_prefix="kyc-fanout") as executor:
+        futures = [executor.submit(func) for func in funcs]
+        return [future.result() for future in futures]
+
+
+class ServiceLimiter:
+    """
+    Named semaphores bounding how many calls run at the same time against each downstream
+    service ("blob", "openai", "face", "cosmos"), e.g. so that a large batch job does not
+    flood one service. Services without a limit are not bounded.
+    """
+
+    def __init__(self, limits):
+        self.limits = dict(limits)
+        self.semaphores = {service: threading.BoundedSemaphore(limit) for service, limit in limits.items() if limit > 0}
+
+    @contextlib.contextmanager
+    def limit(self, service):
+        semaphore = self.semaphores.get(service)
+        if semaphore is None:
+            yield
+            return
+
+        with semaphore:
+            yield
+
+    def wrap(self, service, func):
+        """Returns func, running under the limit of the given service."""
+        @functools.wraps(func)
+        def limited(*args, **kwargs):
+            with self.limit(service):
+                return func(*args, **kwargs)
+        return limited
+
+
+def log_background_error(future):
+    if future.exception() is not None:
+        logging.error(f"Background task failed: {future.exception()}")
+
+
+def run_in_background(func, *args, **kwargs):
+    """
+    Submits a blocking function to the background executor without waiting for it.
+    Failures are logged, since nobody awaits the result.
+
+    :return: The Future of the background task.
+    """
+    future = background_executor.submit(func, *args, **kwargs)
+    future.add_done_callback(log_background_error)
+    return future
+
+
+def shutdown_blocking_executor(wait=True):
+    logging.info("Shutting down the blocking executor.")
+    blocking_executor.shutdown(wait=wait)
+    # Let the pending background uploads finish
+    background_executor.shutdown(wait=True)
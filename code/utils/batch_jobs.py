@@ -0,0 +1,403 @@
+import uuid
+import logging
+import threading
+import urllib.parse
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from data_models.id_document import IDDocument
+from data_models.field_check import FieldBatchComparisonResult
+
+from utils.cosmos_helpers import *
+from utils.storage_helpers import *
+from utils.async_helpers import ServiceLimiter, run_concurrently
+from utils.document_buffer import DocumentBuffer
+from utils.id_document_processor import IDDocumentProcessor, analyze_document
+from utils.extraction_cache import extraction_cache
+from utils.verdict_cache import verdict_cache
+from utils.openai_batch import OpenAIBatchRunner
+
+from env_vars import *
+
+
+def utc_now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def create_batch_service_limiter():
+    return ServiceLimiter({
+        "blob": BATCH_BLOB_CONCURRENCY,
+        "openai": BATCH_OPENAI_CONCURRENCY,
+        "face": BATCH_FACE_CONCURRENCY,
+        "cosmos": BATCH_COSMOS_CONCURRENCY,
+    })
+
+
+class BatchJobManager:
+    """
+    Runs back-office re-verification jobs: a manifest of (customer_id, blob URL) pairs analyzed with
+    the same pipeline as /api/analyze, without going through base64 and HTTP. Jobs and their items
+    are checkpointed in Cosmos (one logical partition per job), so that an interrupted job resumes
+    with the items that were not finished. Items run with bounded concurrency, and each downstream
+    service has its own concurrency limit, so that a large job does not starve the online traffic.
+
+    Jobs in "offline" mode first send the extractions and field comparisons of a chunk of items
+    through the OpenAI Batch API, and store the results in the extraction and verdict caches: the
+    items then run through the usual pipeline, which only calls the Face API and Cosmos.
+    """
+
+    modes = ["online", "offline"]
+
+    # The fields needed to run an item. The results of the finished items are only read by the items API
+    item_fields = ["id", "categoryId", "type", "index", "customer_id", "url", "status"]
+
+    def __init__(self, container_name=BATCH_JOBS_CONTAINER, max_concurrency=BATCH_JOB_MAX_CONCURRENCY, limiter=None, checkpoint_every=BATCH_JOB_CHECKPOINT_EVERY):
+        # The job progress is polled while it changes, so its reads are not cached
+        self.cosmos = CosmosDBHelper(container_name, read_cache_ttl=0)
+        # The customer records the items are compared to, read by the offline prefetch
+        self.customers = CosmosDBHelper()
+        self.blob_helper = BlobStorageHelper()
+        self.max_concurrency = max_concurrency
+        self.limiter = limiter if limiter is not None else create_batch_service_limiter()
+        self.checkpoint_every = checkpoint_every
+
+        self.lock = threading.Lock()
+        self.running = {}
+        self.stop_event = threading.Event()
+
+    def get_offline_cache_error(self, chunk_size=BATCH_JOB_OFFLINE_CHUNK_SIZE):
+        """
+        Offline jobs hand the Batch API results to the pipeline through the extraction and verdict
+        caches. A disabled cache would throw them away, and one evicting before the items of a chunk
+        run would lose some of them: either way, the calls would be paid again online.
+
+        :return: Why offline jobs cannot run with the current caches, or None if they can.
+        """
+        # One extraction, and at most one verdict per IDDocument field, per item of a chunk
+        entries_per_item = {"extraction": 1, "verdict": len(IDDocument.__fields__)}
+
+        for name, cache in [("extraction", extraction_cache), ("verdict", verdict_cache)]:
+            if not cache.enabled:
+                return f"Offline jobs need the {name} cache, which is disabled."
+            if (cache.max_entries is not None) and (cache.max_entries < chunk_size * entries_per_item[name]):
+                return f"The {name} cache holds {cache.max_entries} entries, too few for the results of {chunk_size} items: lower BATCH_JOB_OFFLINE_CHUNK_SIZE."
+        return None
+
+    def create_job(self, items, name=None, mode="online"):
+        """
+        Checkpoints a new job and its items in Cosmos, then starts it in the background.
+
+        :param items: A list of dicts with the 'customer_id' and the blob 'url' of the ID document.
+        :param name: An optional name for the job.
+        :param mode: "online" to call OpenAI synchronously, or "offline" to go through the Batch API.
+        :return: The job document.
+        """
+        if mode not in self.modes:
+            raise ValueError(f"Unknown job mode {mode}. Use one of {self.modes}.")
+        if (mode == "offline") and (self.get_offline_cache_error() is not None):
+            raise ValueError(self.get_offline_cache_error())
+
+        for i, item in enumerate(items):
+            if not item.get("customer_id") or not item.get("url"):
+                raise ValueError(f"Item {i} of the manifest needs a customer_id and a url.")
+
+        job_id = str(uuid.uuid4())
+        job = {
+            "id": job_id,
+            "categoryId": job_id,
+            "type": "job",
+            "name": name or job_id,
+            "mode": mode,
+            "status": "pending",
+            "total": len(items),
+            "done": 0,
+            "failed": 0,
+            "created_at": utc_now(),
+            "updated_at": utc_now(),
+        }
+
+        item_docs = [
+            {
+                "id": f"{job_id}-{i:06d}",
+                "categoryId": job_id,
+                "type": "item",
+                "index": i,
+                "customer_id": item["customer_id"],
+                "url": item["url"],
+                "status": "pending",
+            }
+            for i, item in enumerate(items)
+        ]
+
+        run_concurrently([lambda doc=doc: self.upsert(doc) for doc in item_docs], max_concurrency=BATCH_COSMOS_CONCURRENCY)
+        self.upsert(job)
+
+        self.start_job(job_id)
+        return job
+
+    def upsert(self, document):
+        with self.limiter.limit("cosmos"):
+            if self.cosmos.upsert_document(document) is None:
+                raise RuntimeError(f"Could not checkpoint {document['type']} {document['id']}.")
+
+    def start_job(self, job_id, retry_failed=False):
+        """Starts (or resumes) a job in a background thread, unless it is already running in this process."""
+        with self.lock:
+            if job_id in self.running:
+                return False
+
+            thread = threading.Thread(target=self.run_job, args=(job_id, retry_failed), name=f"kyc-job-{job_id}", daemon=True)
+            self.running[job_id] = thread
+
+        thread.start()
+        return True
+
+    def resume_job(self, job_id, retry_failed=False):
+        """
+        Resumes an interrupted job from its checkpoint.
+
+        :param retry_failed: Whether the failed items are run again too.
+        :return: The job document, or None if the job does not exist.
+        """
+        job = self.get_job(job_id)
+        if job is None:
+            return None
+
+        self.start_job(job_id, retry_failed=retry_failed)
+        return job
+
+    def get_items(self, job_id, status=None, offset=0, limit=None, fields=None):
+        """
+        :param fields: The fields of the items to return, None for the whole items with their results.
+        :return: The items of the job, in manifest order. Raises if the query fails.
+        """
+        projection = ", ".join([f"c.{field}" for field in fields]) if fields else "*"
+        query = f"SELECT {projection} FROM c WHERE c.categoryId = @jobId AND c.type = 'item'"
+        parameters = [{"name": "@jobId", "value": job_id}]
+
+        if status is not None:
+            query += " AND c.status = @status"
+            parameters.append({"name": "@status", "value": status})
+
+        query += " ORDER BY c.index"
+        if limit is not None:
+            query += " OFFSET @offset LIMIT @limit"
+            parameters += [{"name": "@offset", "value": offset}, {"name": "@limit", "value": limit}]
+
+        return self.cosmos.query_all(query, parameters, partition_key=job_id)
+
+    def get_job(self, job_id):
+        job = self.cosmos.read_document(job_id, partition_key=job_id)
+        if job is not None:
+            job["running"] = job_id in self.running
+        return job
+
+    def run_job(self, job_id, retry_failed=False):
+        job = None
+        try:
+            job = self.cosmos.read_document(job_id, partition_key=job_id)
+            if job is None:
+                logging.error(f"Batch job {job_id} not found.")
+                return
+
+            items = self.get_items(job_id, fields=self.item_fields)
+            statuses = ["pending", "running"] + (["failed"] if retry_failed else [])
+            todo = [item for item in items if item["status"] in statuses]
+
+            counts = {
+                "done": len([item for item in items if item["status"] == "done"]),
+                "failed": len([item for item in items if (item["status"] == "failed") and not retry_failed]),
+            }
+            job.update({"status": "running", "started_at": job.get("started_at", utc_now()), **counts})
+            job.pop("error", None)
+            self.checkpoint_job(job)
+            logging.info(f"Running batch job {job_id}: {len(todo)} items left out of {job['total']}.")
+
+            progress_lock = threading.Lock()
+
+            def run_item(item, document=None):
+                if self.stop_event.is_set(): return
+                status = self.process_item(item, document=document)
+                with progress_lock:
+                    job[status] += 1
+                    if (job["done"] + job["failed"]) % self.checkpoint_every == 0:
+                        self.checkpoint_job(job)
+
+            offline = job.get("mode") == "offline"
+            if offline and (self.get_offline_cache_error() is not None):
+                # E.g. a job resumed after the cache settings changed
+                logging.warning(f"Batch job {job_id} runs online: {self.get_offline_cache_error()}")
+                offline = False
+            chunk_size = BATCH_JOB_OFFLINE_CHUNK_SIZE if offline else max(1, len(todo))
+
+            with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="kyc-job") as executor:
+                for start in range(0, len(todo), chunk_size):
+                    if self.stop_event.is_set(): break
+                    chunk = todo[start:start + chunk_size]
+                    documents = self.prefetch_offline(chunk) if offline else {}
+                    list(executor.map(lambda item: run_item(item, documents.get(item["id"])), chunk))
+
+            job["status"] = "interrupted" if self.stop_event.is_set() else "completed"
+            if job["status"] == "completed": job["completed_at"] = utc_now()
+            self.checkpoint_job(job)
+            logging.info(f"Batch job {job_id} {job['status']}: {job['done']} done, {job['failed']} failed.")
+
+        except Exception as e:
+            logging.error(f"Batch job {job_id} failed: {e}")
+            if job is not None:
+                # Not left as "running": resume_job picks the job up from its last checkpoint
+                job.update({"status": "failed", "error": str(e)})
+                self.checkpoint_job(job)
+
+        finally:
+            with self.lock:
+                self.running.pop(job_id, None)
+
+    def checkpoint_job(self, job):
+        job["updated_at"] = utc_now()
+        try:
+            self.upsert({k: v for k, v in job.items() if (not k.startswith("_")) and (k != "running")})
+        except Exception as e:
+            logging.warning(f"Could not checkpoint batch job {job['id']}: {e}")
+
+    def download_document(self, item):
+        with self.limiter.limit("blob"):
+            data = self.blob_helper.download_blob_bytes_by_url(item["url"])
+        return DocumentBuffer(urllib.parse.urlparse(item["url"]).path, data)
+
+    def process_item(self, item, document=None):
+        """
+        Downloads the document of an item into memory and analyzes it, then checkpoints the item.
+
+        :param document: The DocumentBuffer of the item, if it was already downloaded.
+        :return: The final status of the item, "done" or "failed".
+        """
+        item = {k: v for k, v in item.items() if not k.startswith("_")}
+        item.update({"status": "running", "started_at": utc_now()})
+
+        try:
+            if document is None:
+                document = self.download_document(item)
+
+            item["result"] = analyze_document(item["customer_id"], document, limiter=self.limiter)
+            item["status"] = "done"
+            item.pop("error", None)
+
+        except Exception as e:
+            logging.warning(f"Batch item {item['id']} failed: {e}")
+            item["status"] = "failed"
+            item["error"] = str(e)
+
+        item["finished_at"] = utc_now()
+        try:
+            self.upsert(item)
+        except Exception as e:
+            # The item stays pending in Cosmos, and runs again if the job is resumed
+            logging.warning(f"Could not checkpoint batch item {item['id']}: {e}")
+
+        return item["status"]
+
+    def prefetch_offline(self, items):
+        """
+        Runs the LLM calls of a chunk of items through the Batch API: first the extractions, then
+        the field comparisons that need the extractions. The results are mapped back onto IDDocuments
+        and comparison results, and stored in the caches the pipeline reads from. Anything missing
+        from the batches is simply computed synchronously when the item is processed.
+
+        :return: A dict of item id to the DocumentBuffer downloaded for it.
+        """
+        def load(item):
+            try:
+                document = self.download_document(item)
+                with self.limiter.limit("cosmos"):
+                    record = self.customers.read_document(item["customer_id"], partition_key=COSMOS_CATEGORYID_VALUE)
+                if record is None:
+                    logging.warning(f"No customer record {item['customer_id']} for batch item {item['id']}, its field comparisons are not batched.")
+                return IDDocumentProcessor(customer_id=item["customer_id"], document=document), record
+            except Exception as e:
+                logging.warning(f"Could not prefetch batch item {item['id']}, it runs online: {e}")
+                return None, None
+
+        loaded = run_concurrently([lambda item=item: load(item) for item in items], max_concurrency=self.max_concurrency)
+        processors = {item["id"]: processor for item, (processor, _) in zip(items, loaded) if processor is not None}
+        records = {item["id"]: record for item, (_, record) in zip(items, loaded) if record is not None}
+
+        try:
+            runner = OpenAIBatchRunner()
+            id_docs = self.run_offline_extractions(runner, processors)
+            self.run_offline_field_checks(runner, processors, id_docs, records)
+        except Exception as e:
+            logging.error(f"Offline batch of {len(items)} items failed, they run online: {e}")
+
+        return {item_id: processor.document for item_id, processor in processors.items()}
+
+    def run_offline_extractions(self, runner, processors):
+        """:return: A dict of item id to the extracted IDDocument dict, from the cache or from the batch."""
+        id_docs = {}
+        keys = {}
+        requests = []
+
+        for item_id, processor in processors.items():
+            keys[item_id] = processor.extraction_cache_key()
+            id_docs[item_id] = extraction_cache.get(keys[item_id])
+            if id_docs[item_id] is None:
+                requests.append(runner.request(item_id, processor.build_extraction_prompt(), processor.images, response_format=IDDocument))
+
+        logging.info(f"Sending {len(requests)} extractions to the Batch API, {len(processors) - len(requests)} are cached.")
+        results = runner.run(requests, stop_event=self.stop_event)
+
+        def store(item_id, result):
+            try:
+                id_doc = processors[item_id].store_extraction(keys[item_id], result.parse(IDDocument), limiter=self.limiter)
+                return IDDocumentProcessor.IDDocument_to_dict(id_doc)
+            except Exception as e:
+                logging.warning(f"No offline extraction for batch item {item_id}: {e}")
+                return None
+
+        stored = run_concurrently([lambda item_id=item_id, result=result: store(item_id, result) for item_id, result in results.items()], max_concurrency=BATCH_BLOB_CONCURRENCY)
+        id_docs.update(dict(zip(results.keys(), stored)))
+
+        return {item_id: id_doc for item_id, id_doc in id_docs.items() if id_doc is not None}
+
+    def run_offline_field_checks(self, runner, processors, id_docs, records):
+        """
+        Sends the field comparisons left for the LLM as one batch, in the same FIELD_CHECK_MODE as the
+        online pipeline so that it finds the verdicts in the cache. Identical comparisons across items
+        are sent once.
+        """
+        requests = {}
+        pending = {}
+
+        for item_id, id_doc_dict in id_docs.items():
+            if item_id not in records: continue
+            processor = processors[item_id]
+            _, pending_checks = processor.collect_field_checks(id_doc_dict, records[item_id])
+
+            if (FIELD_CHECK_MODE == "batch") and (len(pending_checks) > 1):
+                _, keys, field_pairs, prompt = processor.field_checker.prepare_fields_batch(pending_checks)
+                if prompt is not None:
+                    custom_id = f"{item_id}-fields"
+                    requests[custom_id] = runner.request(custom_id, prompt, response_format=FieldBatchComparisonResult)
+                    pending[custom_id] = lambda result, processor=processor, field_pairs=field_pairs, keys=keys: \
+                        processor.field_checker.apply_fields_batch(result.parse(FieldBatchComparisonResult), field_pairs, keys)
+                continue
+
+            for field_name, (check_type, field1, field2) in pending_checks.items():
+                key, prompt, response_format, _ = processor.field_checker.prepare_check(check_type, field_name, field1, field2)
+                if (key in requests) or (processor.field_checker.verdict_cache.get(key) is not None): continue
+                requests[key] = runner.request(key, prompt, response_format=response_format)
+                pending[key] = lambda result, processor=processor, key=key, response_format=response_format: \
+                    processor.field_checker.verdict_cache.set(key, result.parse(response_format).result)
+
+        logging.info(f"Sending {len(requests)} field comparisons to the Batch API.")
+        results = runner.run(list(requests.values()), stop_event=self.stop_event)
+
+        for custom_id, result in results.items():
+            try:
+                pending[custom_id](result)
+            except Exception as e:
+                logging.warning(f"No offline field comparison for {custom_id}: {e}")
+
+    def shutdown(self):
+        """Stops scheduling new items. Running jobs are checkpointed as interrupted, to be resumed."""
+        self.stop_event.set()
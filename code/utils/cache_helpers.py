@@ -0,0 +1,270 @@
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from env_vars import *
+
+
+def hash_text(text):
+    return hashlib.sha256(str(text).encode("utf-8")).hexdigest()
+
+
+def make_cache_key(*parts):
+    """Builds a content-addressed cache key from the given parts."""
+    return hash_text("\x1f".join([str(p) for p in parts]))
+
+
+class CacheStats:
+    """Thread-safe hit/miss counters of a cache."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "sets": 0, "evictions": 0}
+
+    def increment(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def as_dict(self):
+        with self.lock:
+            stats = dict(self.counters)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] / lookups) if lookups > 0 else 0.0
+        return stats
+
+
+class InMemoryCacheBackend:
+    """In-process cache with TTL expiry and LRU eviction."""
+
+    def __init__(self, ttl=3600, max_entries=10000, stats=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = stats if stats is not None else CacheStats()
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if (expires_at is not None) and (expires_at < time.time()):
+                del self.entries[key]
+                self.stats.increment("evictions")
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = (time.time() + ttl) if ttl else None
+
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats.increment("evictions")
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SQLiteCacheBackend:
+    """Local SQLite cache with TTL expiry and LRU eviction, persisted across restarts."""
+
+    def __init__(self, path="cache/kyc_cache.db", table="cache", ttl=3600, max_entries=100000, stats=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.table = table
+        self.stats = stats if stats is not None else CacheStats()
+        self.lock = threading.Lock()
+
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value TEXT, expires_at REAL, last_access REAL)")
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_last_access ON {self.table} (last_access)")
+            self.conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+
+            value, expires_at = row
+            if (expires_at is not None) and (expires_at < now):
+                self.conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                self.conn.commit()
+                self.stats.increment("evictions")
+                return None
+
+            self.conn.execute(f"UPDATE {self.table} SET last_access = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        expires_at = (now + ttl) if ttl else None
+
+        with self.lock:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, now)
+            )
+
+            count = self.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            if count > self.max_entries:
+                evicted = count - self.max_entries
+                self.conn.execute(
+                    f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} ORDER BY last_access ASC LIMIT ?)",
+                    (evicted,)
+                )
+                self.stats.increment("evictions", evicted)
+
+            self.conn.commit()
+
+    def delete(self, key):
+        with self.lock:
+            self.conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute(f"DELETE FROM {self.table}")
+            self.conn.commit()
+
+
+class CosmosCacheBackend:
+    """
+    Cache stored in a Cosmos DB container, shared by all the API workers. Expiry relies on the
+    Cosmos per-item TTL; there is no LRU eviction, so entries only leave the container when they expire.
+    """
+
+    def __init__(self, container_name=CACHE_COSMOS_CONTAINER, namespace="cache", ttl=3600, stats=None):
+        from utils.cosmos_helpers import CosmosDBHelper
+
+        self.ttl = ttl
+        self.namespace = namespace
+        self.stats = stats if stats is not None else CacheStats()
+        # Entries already expire through their own expires_at, so the documents are not cached again
+        self.cosmos = CosmosDBHelper(container_name=container_name, default_ttl=-1, read_cache_ttl=0)
+
+    def get(self, key):
+        doc = self.cosmos.read_document(key, partition_key=self.namespace)
+        if doc is None:
+            return None
+
+        expires_at = doc.get("expires_at")
+        if (expires_at is not None) and (expires_at < time.time()):
+            return None
+
+        return doc.get("value")
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        doc = {
+            "id": key,
+            "categoryId": self.namespace,
+            "value": value,
+            "expires_at": (time.time() + ttl) if ttl else None,
+            "ttl": int(ttl) if ttl else -1,
+        }
+        self.cosmos.upsert_document(doc)
+
+    def delete(self, key):
+        self.cosmos.delete_document(key, partition_key=self.namespace)
+
+    def clear(self):
+        logging.warning("Clearing is not supported by the Cosmos cache backend, entries expire through their TTL.")
+
+
+def create_cache_backend(backend, namespace, ttl=3600, max_entries=10000, stats=None):
+    """
+    Creates a cache backend by name.
+
+    :param backend: One of "memory", "sqlite" or "cosmos". Anything else disables the cache.
+    :param namespace: Name of the cache, used as the SQLite table and the Cosmos partition.
+    :return: The backend, or None if caching is disabled.
+    """
+    backend = backend.lower()
+
+    if backend == "memory":
+        return InMemoryCacheBackend(ttl=ttl, max_entries=max_entries, stats=stats)
+    elif backend == "sqlite":
+        return SQLiteCacheBackend(path=CACHE_SQLITE_PATH, table=namespace, ttl=ttl, max_entries=max_entries, stats=stats)
+    elif backend == "cosmos":
+        return CosmosCacheBackend(namespace=namespace, ttl=ttl, stats=stats)
+    else:
+        logging.info(f"Cache backend '{backend}' for '{namespace}' is disabled.")
+        return None
+
+
+class JSONCache:
+    """A cache of JSON-serializable values on top of one of the backends, with hit/miss counters."""
+
+    def __init__(self, backend, stats=None):
+        self.backend = backend
+        self.stats = stats if stats is not None else (backend.stats if backend is not None else CacheStats())
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    @property
+    def max_entries(self):
+        """:return: The number of entries above which the backend evicts, None if it does not evict."""
+        return getattr(self.backend, "max_entries", None)
+
+    def get(self, key):
+        if self.backend is None:
+            return None
+
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            logging.warning(f"Cache read failed: {e}")
+            value = None
+
+        self.stats.increment("hits" if value is not None else "misses")
+        return value
+
+    def set(self, key, value, ttl=None):
+        if self.backend is None:
+            return
+
+        try:
+            self.backend.set(key, value, ttl=ttl)
+            self.stats.increment("sets")
+        except Exception as e:
+            logging.warning(f"Cache write failed: {e}")
+
+    def delete(self, key):
+        if self.backend is not None:
+            self.backend.delete(key)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def get_stats(self):
+        return self.stats.as_dict()
@@ -11,71 +11,306 @@ from azure.cosmos import CosmosClient, PartitionKey, exceptions
 from azure.identity import DefaultAzureCredential
 from azure.identity import ManagedIdentityCredential
 
+from azure.core import MatchConditions
+from azure.cosmos.documents import ConnectionPolicy, RetryOptions
+from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+import time
+import random
+import asyncio
+import weakref
+import threading
+
+from utils.cache_helpers import CacheStats, InMemoryCacheBackend
+from utils.cosmos_indexing import get_indexing_policy, normalize_indexing_policy
+
 from env_vars import COSMOS_URI, COSMOS_DB_NAME, COSMOS_CONTAINER_NAME, COSMOS_CATEGORYID
 
 logging.getLogger("azure.core.pipeline.policies.http_logging_policy").setLevel(logging.WARNING)
 
+
+# The read caches and the RU counters are shared by all the helpers of a container in the process,
+# so that a write through any of them invalidates what the others have cached
+container_read_caches = {}
+container_read_versions = {}
+container_stats = {}
+container_registry_lock = threading.Lock()
+# The containers whose indexing policy was already checked by this process
+checked_indexing_policies = set()
+
+
+class ReadVersions:
+    """
+    Write versions of the documents being read. A read started before a write can finish after the
+    write invalidated the cache: comparing the version of the document at both ends of the read
+    tells the read not to cache what may be the old document. Only the documents with reads in
+    flight are tracked.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> [version, reads in flight]
+        self.entries = {}
+
+    def begin(self, key):
+        """:return: The version of the document at the start of a read."""
+        with self.lock:
+            entry = self.entries.setdefault(key, [0, 0])
+            entry[1] += 1
+            return entry[0]
+
+    def bump(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[0] += 1
+
+    def end(self, key, version):
+        """:return: True if the document was not written since begin() returned the version."""
+        with self.lock:
+            entry = self.entries[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.entries[key]
+            return entry[0] == version
+
+
+def invalidate_read_cache(container_name, key):
+    """Drops a document from the read cache of its container, and from the reads in flight."""
+    read_versions = container_read_versions.get(container_name)
+    if read_versions is not None:
+        read_versions.bump(key)
+    read_cache = container_read_caches.get(container_name)
+    if read_cache is not None:
+        read_cache.delete(key)
+
+
+def get_container_stats(container_name):
+    stats = container_stats[container_name].as_dict()
+    for k in stats:
+        if k.endswith("request_charge"): stats[k] = round(stats[k], 2)
+    return stats
+
+
 class CosmosDBHelper:
-    def __init__(self, container_name=COSMOS_CONTAINER_NAME):
+    """
+    Helper around a Cosmos DB container. Point reads go through a read-through cache of recently
+    read documents: a cached document is served as is for a few seconds, then revalidated with its
+    etag (If-None-Match), which does not transfer the document again when it did not change. Writes
+    through the helper invalidate the cached document, and the request charges (RU) are counted.
+    """
+
+    def __init__(self, container_name=COSMOS_CONTAINER_NAME, default_ttl=None, read_cache_ttl=COSMOS_READ_CACHE_TTL, fresh_seconds=COSMOS_READ_CACHE_FRESH_SECONDS):
+        """
+        :param read_cache_ttl: How long read documents stay cached, 0 to disable the read cache for this container.
+        :param fresh_seconds: How long a cached document is served without revalidating its etag.
+        """
+        self.container_name = container_name
+        self.fresh_seconds = fresh_seconds
+
+        with container_registry_lock:
+            self.stats = container_stats.setdefault(container_name, CacheStats())
+            if read_cache_ttl and (container_name not in container_read_caches):
+                container_read_caches[container_name] = InMemoryCacheBackend(ttl=read_cache_ttl, max_entries=COSMOS_READ_CACHE_MAX_ENTRIES, stats=self.stats)
+            self.read_cache = container_read_caches.get(container_name) if read_cache_ttl else None
+            self.read_versions = container_read_versions.setdefault(container_name, ReadVersions())
+
         try:
             credential = DefaultAzureCredential()
             self.client = CosmosClient(url=COSMOS_URI, credential=credential)
             self.database = self.client.create_database_if_not_exists(id=COSMOS_DB_NAME)
+            indexing_policy, _ = get_indexing_policy(container_name)
             self.container = self.database.create_container_if_not_exists(
                 id=container_name,
                 partition_key=PartitionKey(path="/categoryId"),
-                indexing_policy={
-                    "includedPaths": [{"path": "/*"}],
-                    "excludedPaths": [{"path": "/_etag/?"}]
-                }
+                indexing_policy=indexing_policy,
+                default_ttl=default_ttl
             )
         except Exception as e:
             logging.error(f"Failed to initialize Cosmos DB: {e}")
             raise
 
+        if COSMOS_MANAGE_INDEXING_POLICY:
+            self.ensure_indexing_policy()
+
+    def ensure_indexing_policy(self):
+        """
+        Migrates a container created with an older indexing policy to the one of cosmos_indexing.py,
+        once per container and process. Cosmos rebuilds the index in the background: queries keep
+        working meanwhile, with the paths removed from the policy no longer served by the index.
+
+        :return: True if the policy was replaced.
+        """
+        with container_registry_lock:
+            if self.container_name in checked_indexing_policies:
+                return False
+            checked_indexing_policies.add(self.container_name)
+
+        indexing_policy, version = get_indexing_policy(self.container_name)
+        try:
+            properties = self.container.read()
+            if normalize_indexing_policy(properties.get("indexingPolicy", {})) == normalize_indexing_policy(indexing_policy):
+                return False
+
+            logging.info(f"Migrating the indexing policy of the Cosmos container {self.container_name} to version {version}.")
+            self.container = self.database.replace_container(
+                self.container,
+                partition_key=PartitionKey(path="/categoryId"),
+                indexing_policy=indexing_policy,
+                default_ttl=properties.get("defaultTtl")
+            )
+            return True
+        except exceptions.CosmosHttpResponseError as e:
+            # E.g. an identity with data plane roles only, which cannot change container settings
+            logging.warning(f"Could not migrate the indexing policy of the Cosmos container {self.container_name}: {e.message}")
+            return False
+
+    def charge_hook(self, operation):
+        """:return: A response_hook adding the request charge of the call to the RU counters."""
+        def hook(headers, _):
+            charge = float(headers.get("x-ms-request-charge", 0) or 0)
+            self.stats.increment("request_charge", charge)
+            self.stats.increment(f"{operation}_request_charge", charge)
+            self.stats.increment(f"{operation}_requests")
+        return hook
+
+    def invalidate(self, doc_id, partition_key):
+        # Also when this helper does not cache its own reads, for the other helpers of the container
+        invalidate_read_cache(self.container_name, (partition_key, doc_id))
+
     def get_all_documents(self):
         try:
-            return list(self.container.read_all_items())
+            return list(self.container.read_all_items(response_hook=self.charge_hook("query")))
         except Exception as e:
             logging.error(f"Error reading all documents: {e}")
             return []
 
     def read_document(self, doc_id, partition_key=COSMOS_CATEGORYID):
+        """
+        Point-reads a document, through the read cache. A cached document older than fresh_seconds
+        is revalidated with a conditional read, which only returns the document if its etag changed.
+
+        :return: A copy of the document, or None if it does not exist.
+        """
+        key = (partition_key, doc_id)
+        entry = self.read_cache.get(key) if self.read_cache is not None else None
+
+        if (entry is not None) and (time.time() - entry["validated_at"] < self.fresh_seconds):
+            self.stats.increment("hits")
+            return copy.deepcopy(entry["document"])
+
+        version = self.read_versions.begin(key)
         try:
-            return self.container.read_item(item=doc_id, partition_key=partition_key)
+            if entry is None:
+                self.stats.increment("misses")
+                document = self.container.read_item(item=doc_id, partition_key=partition_key, response_hook=self.charge_hook("read"))
+            else:
+                document = self.container.read_item(
+                    item=doc_id,
+                    partition_key=partition_key,
+                    etag=entry["document"]["_etag"],
+                    match_condition=MatchConditions.IfModified,
+                    response_hook=self.charge_hook("read")
+                )
+                # Not modified (304): the response has no body
+                if (not document) or ("id" not in document):
+                    self.stats.increment("hits")
+                    self.stats.increment("revalidations")
+                    document = entry["document"]
+                else:
+                    self.stats.increment("misses")
+
         except exceptions.CosmosResourceNotFoundError:
+            self.invalidate(doc_id, partition_key)
             logging.warning(f"Document with ID {doc_id} not found.")
             return None
         except Exception as e:
             logging.error(f"Error reading document {doc_id}: {e}")
             return None
+        finally:
+            unchanged = self.read_versions.end(key, version)
+
+        # Not cached if a write invalidated the document meanwhile: the read may predate the write
+        if unchanged and (self.read_cache is not None):
+            self.read_cache.set(key, {"document": document, "validated_at": time.time()})
+        return copy.deepcopy(document)
 
     def query_documents(self, query, parameters):
         try:
             return list(self.container.query_items(
                 query=query,
                 parameters=parameters,
-                enable_cross_partition_query=True
+                enable_cross_partition_query=True,
+                response_hook=self.charge_hook("query")
             ))
         except Exception as e:
             logging.error(f"Error querying documents: {e}")
             return []
 
+    def query_all(self, query, parameters, partition_key=None):
+        """
+        Runs a query and returns all its documents. Unlike query_documents, errors are raised, for the
+        callers that must not mistake a failed query for an empty result.
+
+        :param partition_key: Restricts the query to one logical partition instead of fanning out across all of them.
+        """
+        options = {"partition_key": partition_key} if partition_key is not None else {"enable_cross_partition_query": True}
+        return list(self.container.query_items(query=query, parameters=parameters, response_hook=self.charge_hook("query"), **options))
+
+    def query_page(self, query, parameters, page_size=100, continuation_token=None, partition_key=None):
+        """
+        Runs a query one page at a time, for paginated listings.
+
+        :param continuation_token: The token returned with the previous page, None for the first page.
+        :param partition_key: Restricts the query to one logical partition instead of fanning out across all of them.
+        :return: A tuple of the documents of the page and the continuation token of the next page, None after the last page.
+        """
+        options = {"partition_key": partition_key} if partition_key is not None else {"enable_cross_partition_query": True}
+        try:
+            pages = self.container.query_items(query=query, parameters=parameters, max_item_count=page_size, response_hook=self.charge_hook("query"), **options).by_page(continuation_token)
+            items = list(next(pages, []))
+            return items, pages.continuation_token
+        except exceptions.CosmosHttpResponseError as e:
+            if e.status_code == 400:
+                raise ValueError(f"Invalid query or continuation token: {e.message}") from e
+            logging.error(f"Error querying a page of documents: {e}")
+            raise
+
     def upsert_document(self, document):
         try:
-            return self.container.upsert_item(body=document)
+            return self.container.upsert_item(body=document, response_hook=self.charge_hook("write"))
         except Exception as e:
             logging.error(f"Error upserting document: {e}")
             return None
+        finally:
+            self.invalidate(document.get("id"), document.get("categoryId"))
+
+    def upsert_batch(self, documents, partition_key):
+        """
+        Upserts documents of the same logical partition as one transactional batch (at most 100
+        operations), in a single round-trip. Raises if the batch fails, in which case none of the
+        documents was written.
+        """
+        try:
+            return self.container.execute_item_batch(
+                batch_operations=[("upsert", (document,)) for document in documents],
+                partition_key=partition_key,
+                response_hook=self.charge_hook("write")
+            )
+        finally:
+            for document in documents:
+                self.invalidate(document.get("id"), partition_key)
 
     def delete_document(self, doc_id, partition_key=COSMOS_CATEGORYID):
         try:
-            self.container.delete_item(item=doc_id, partition_key=partition_key)
+            self.container.delete_item(item=doc_id, partition_key=partition_key, response_hook=self.charge_hook("write"))
             logging.info(f"Deleted document with ID {doc_id}")
         except exceptions.CosmosResourceNotFoundError:
             logging.warning(f"Document with ID {doc_id} not found.")
         except Exception as e:
             logging.error(f"Error deleting document {doc_id}: {e}")
+        finally:
+            self.invalidate(doc_id, partition_key)
 
     def clean_document(self, document, allowed_fields):
         clean_doc = {k: v for k, v in document.items() if k in allowed_fields}
@@ -86,16 +321,202 @@ class CosmosDBHelper:
         if document.get('categoryId') is None: document[COSMOS_CATEGORYID] = COSMOS_CATEGORYID_VALUE
 
         try:
-            return self.container.create_item(body=document)
+            return self.container.create_item(body=document, response_hook=self.charge_hook("write"))
         except Exception as e:
             logging.error(f"Error creating document: {e}")
             return None
+        finally:
+            self.invalidate(document["id"], document.get("categoryId"))
 
     def get_document_by_id(self, doc_id, category_id=COSMOS_CATEGORYID):
-        query = "SELECT * FROM c WHERE c.categoryId = @categoryId AND c.id = @id"
-        parameters = [
-            {"name": "@categoryId", "value": category_id},
-            {"name": "@id", "value": doc_id}
-        ]
-        results = self.query_documents(query, parameters)
-        return results[0] if results else None
+        # The id and the partition key identify a single document: a point read, instead of a query
+        return self.read_document(doc_id, partition_key=category_id)
+
+    def get_stats(self):
+        """:return: The read cache hit rate and the request charges (RU) of this container."""
+        return get_container_stats(self.container_name)
+
+
+# One async client per event loop, since its connection pool is bound to the loop it was created on.
+# Keyed by the loop itself, so that the entries of finished loops go away with them
+async_clients = weakref.WeakKeyDictionary()
+async_clients_lock = threading.Lock()
+
+
+def get_async_cosmos_client():
+    """
+    Returns the async Cosmos client of the running event loop, shared by all the AsyncCosmosDBHelpers.
+    The SDK's own throttling retries are turned off, since the bulk helpers back off on 429 themselves.
+    """
+    loop = asyncio.get_running_loop()
+
+    with async_clients_lock:
+        entry = async_clients.get(loop)
+        if entry is None:
+            connection_policy = ConnectionPolicy()
+            connection_policy.RetryOptions = RetryOptions(max_retry_attempt_count=0)
+            # The credential has its own HTTP session, which closing the client does not close
+            credential = AsyncDefaultAzureCredential()
+            entry = (AsyncCosmosClient(url=COSMOS_URI, credential=credential, connection_policy=connection_policy), credential)
+            async_clients[loop] = entry
+
+    return entry[0]
+
+
+async def close_async_cosmos_client():
+    """Closes the async Cosmos client of the running event loop and its credential, e.g. at the end of an import script."""
+    with async_clients_lock:
+        entry = async_clients.pop(asyncio.get_running_loop(), None)
+    if entry is not None:
+        client, credential = entry
+        await client.close()
+        await credential.close()
+
+
+def get_retry_after_seconds(error, attempt):
+    """:return: The x-ms-retry-after-ms delay of a throttled response, or an exponential backoff with jitter."""
+    retry_after_ms = (getattr(error, "headers", None) or {}).get("x-ms-retry-after-ms")
+    if retry_after_ms:
+        return float(retry_after_ms) / 1000.0
+    return min(30.0, 0.1 * (2 ** attempt)) * (0.5 + random.random() / 2)
+
+
+class AsyncCosmosDBHelper:
+    """
+    Async counterpart of CosmosDBHelper for bulk loads, such as customer imports and migrations.
+    Instead of one round-trip after the other, the bulk operations keep up to max_concurrency
+    requests in flight on the shared async client, back off on throttling (429) as long as
+    x-ms-retry-after-ms asks to, and add up the request charges (RU) of the whole operation.
+    The container must already exist, e.g. created by CosmosDBHelper.
+
+    Example:
+        cosmos = AsyncCosmosDBHelper()
+        summary = await cosmos.upsert_many(customers)
+        records = await cosmos.read_many([c["id"] for c in customers], partition_key="customers")
+        await close_async_cosmos_client()
+    """
+
+    def __init__(self, container_name=COSMOS_CONTAINER_NAME, max_concurrency=COSMOS_BULK_MAX_CONCURRENCY, max_retries=COSMOS_BULK_MAX_RETRIES):
+        self.container_name = container_name
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+
+        with container_registry_lock:
+            self.stats = container_stats.setdefault(container_name, CacheStats())
+
+    def get_container(self):
+        return get_async_cosmos_client().get_database_client(COSMOS_DB_NAME).get_container_client(self.container_name)
+
+    def invalidate(self, doc_id, partition_key):
+        # Keeps the read caches of the synchronous helpers of the same container consistent
+        invalidate_read_cache(self.container_name, (partition_key, doc_id))
+
+    async def call(self, operation, func, totals):
+        """
+        Runs one request, retrying it while it is throttled.
+
+        :param func: A callable taking the response_hook and returning the awaitable request.
+        :param totals: The CacheStats of the bulk operation, adding up its request charges.
+        """
+        def hook(headers, _):
+            charge = float(headers.get("x-ms-request-charge", 0) or 0)
+            for stats in [self.stats, totals]:
+                stats.increment("request_charge", charge)
+            self.stats.increment(f"{operation}_request_charge", charge)
+            self.stats.increment(f"{operation}_requests")
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await func(hook)
+            except exceptions.CosmosHttpResponseError as e:
+                if (e.status_code != 429) or (attempt == self.max_retries):
+                    raise
+                self.stats.increment("throttled")
+                totals.increment("throttled")
+                await asyncio.sleep(get_retry_after_seconds(e, attempt))
+
+    async def run_bulk(self, operation, funcs):
+        """
+        Runs the requests with at most max_concurrency of them in flight.
+
+        :return: A tuple of the results (or exceptions) in the order of the requests, and the totals of the operation.
+        """
+        totals = CacheStats()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        start = time.time()
+
+        async def run(func):
+            async with semaphore:
+                try:
+                    return await self.call(operation, func, totals)
+                except Exception as e:
+                    return e
+
+        results = await asyncio.gather(*[run(func) for func in funcs])
+
+        totals = totals.as_dict()
+        summary = {
+            "request_charge": round(totals.get("request_charge", 0.0), 2),
+            "throttled": totals.get("throttled", 0),
+            "seconds": round(time.time() - start, 3),
+        }
+        logging.info(f"Cosmos bulk {operation} of {len(funcs)} documents: {summary}")
+        return results, summary
+
+    def summarize(self, ids, results, summary):
+        failed = {doc_id: str(result) for doc_id, result in zip(ids, results) if isinstance(result, Exception)}
+        return {"succeeded": len(ids) - len(failed), "failed": failed, **summary}
+
+    async def upsert_many(self, documents):
+        """
+        Upserts the documents concurrently.
+
+        :return: A summary with the number of documents upserted, the errors by document id, the total request charge, the throttled requests and the duration.
+        """
+        container = self.get_container()
+        funcs = [lambda hook, document=document: container.upsert_item(body=document, response_hook=hook) for document in documents]
+        results, summary = await self.run_bulk("write", funcs)
+
+        for document in documents:
+            self.invalidate(document.get("id"), document.get("categoryId"))
+
+        return self.summarize([document.get("id") for document in documents], results, summary)
+
+    async def read_many(self, ids, partition_key=COSMOS_CATEGORYID_VALUE):
+        """
+        Point-reads the documents concurrently.
+
+        :param ids: The document ids, all in the given logical partition.
+        :return: The documents in the order of the ids, with None for the documents that do not exist or could not be read.
+        """
+        container = self.get_container()
+        funcs = [lambda hook, doc_id=doc_id: container.read_item(item=doc_id, partition_key=partition_key, response_hook=hook) for doc_id in ids]
+        results, _ = await self.run_bulk("read", funcs)
+
+        documents = []
+        for doc_id, result in zip(ids, results):
+            if isinstance(result, Exception):
+                if not isinstance(result, exceptions.CosmosResourceNotFoundError):
+                    logging.error(f"Error reading document {doc_id}: {result}")
+                result = None
+            documents.append(result)
+        return documents
+
+    async def delete_many(self, ids, partition_key=COSMOS_CATEGORYID_VALUE):
+        """
+        Deletes the documents concurrently. Documents that do not exist count as deleted.
+
+        :return: The same summary as upsert_many.
+        """
+        container = self.get_container()
+        funcs = [lambda hook, doc_id=doc_id: container.delete_item(item=doc_id, partition_key=partition_key, response_hook=hook) for doc_id in ids]
+        results, summary = await self.run_bulk("write", funcs)
+
+        for doc_id in ids:
+            self.invalidate(doc_id, partition_key)
+
+        results = [None if isinstance(result, exceptions.CosmosResourceNotFoundError) else result for result in results]
+        return self.summarize(ids, results, summary)
+
+    def get_stats(self):
+        return get_container_stats(self.container_name)
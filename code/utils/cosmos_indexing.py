@@ -0,0 +1,93 @@
+from env_vars import *
+
+
+def composite_index(*paths):
+    """Builds a composite index from (path, order) tuples, e.g. composite_index(("/type", "ascending"), ("/index", "ascending"))."""
+    return [{"path": path, "order": order} for path, order in paths]
+
+
+# The previous policy of every container, which indexes every path of every document. It is kept
+# for the containers without a tuned policy, and as the baseline of cosmos_index_benchmark.py
+index_everything_policy = {
+    "indexingMode": "consistent",
+    "includedPaths": [{"path": "/*"}],
+    "excludedPaths": [{"path": "/_etag/?"}],
+}
+
+
+# The indexing policies managed by CosmosDBHelper, by container. Only the paths that the queries
+# filter or sort on are indexed: every indexed path costs RU on each write, and the customer
+# documents are mostly long strings (MRZ codes, addresses, additional attributes) that are only
+# ever read by id. The id is always indexed by Cosmos. Bump the version with every change; version 1
+# is the index-everything policy the containers were created with.
+indexing_policies = {
+    # Customer records: point reads by id, and the customer listing with its STARTSWITH prefix
+    # search on the names. The listing is not sorted, so it needs no composite index
+    COSMOS_CONTAINER_NAME: {
+        "version": 2,
+        "policy": {
+            "indexingMode": "consistent",
+            "includedPaths": [{"path": "/first_name/?"}, {"path": "/last_name/?"}],
+            "excludedPaths": [{"path": "/*"}],
+        },
+    },
+    # Batch jobs: the items of a job, optionally filtered by status, in manifest order. The queries
+    # filter on the partition key, so it leads the composite indexes of their ORDER BY
+    BATCH_JOBS_CONTAINER: {
+        "version": 2,
+        "policy": {
+            "indexingMode": "consistent",
+            "includedPaths": [{"path": "/categoryId/?"}, {"path": "/type/?"}, {"path": "/status/?"}, {"path": "/index/?"}],
+            "excludedPaths": [{"path": "/*"}],
+            "compositeIndexes": [
+                composite_index(("/categoryId", "ascending"), ("/type", "ascending"), ("/index", "ascending")),
+                composite_index(("/categoryId", "ascending"), ("/type", "ascending"), ("/status", "ascending"), ("/index", "ascending")),
+            ],
+        },
+    },
+    # Analysis logs of a customer (one partition per customer): the latest ones first, by type
+    COSMOS_LOG_CONTAINER: {
+        "version": 2,
+        "policy": {
+            "indexingMode": "consistent",
+            "includedPaths": [{"path": "/categoryId/?"}, {"path": "/type/?"}, {"path": "/timestamp/?"}],
+            "excludedPaths": [{"path": "/*"}],
+            "compositeIndexes": [
+                composite_index(("/categoryId", "ascending"), ("/type", "ascending"), ("/timestamp", "descending")),
+            ],
+        },
+    },
+    # Shared cache entries: point reads only
+    CACHE_COSMOS_CONTAINER: {
+        "version": 2,
+        "policy": {
+            "indexingMode": "consistent",
+            "includedPaths": [],
+            "excludedPaths": [{"path": "/*"}],
+        },
+    },
+}
+
+
+def get_indexing_policy(container_name):
+    """:return: A tuple of the indexing policy of the container and its version (1 for the index-everything policy)."""
+    entry = indexing_policies.get(container_name)
+    if entry is None:
+        return index_everything_policy, 1
+    return entry["policy"], entry["version"]
+
+
+def normalize_indexing_policy(policy):
+    """
+    Reduces an indexing policy to what it indexes, to compare the policy of a container, as Cosmos
+    returns it (with its own defaults and the system paths), to a policy of this module.
+    """
+    def paths(key):
+        return sorted([p["path"] for p in policy.get(key, []) if "_etag" not in p["path"]])
+
+    return {
+        "indexingMode": policy.get("indexingMode", "consistent").lower(),
+        "includedPaths": paths("includedPaths"),
+        "excludedPaths": paths("excludedPaths"),
+        "compositeIndexes": sorted([[(p["path"], p.get("order", "ascending").lower()) for p in index] for index in policy.get("compositeIndexes", [])]),
+    }
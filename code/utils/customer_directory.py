@@ -0,0 +1,75 @@
+import threading
+
+from utils.cache_helpers import *
+
+from env_vars import *
+
+
+class CustomerDirectory:
+    """
+    Paginated listing of the customers for the customer pickers of the UIs. It only projects the
+    id and the names of the customer partition, page by page with Cosmos continuation tokens,
+    instead of reading every full document across all partitions. Pages are cached for a few
+    seconds; invalidate() is called on every customer update, and bumps a generation number so
+    that a page read before the update cannot be cached after it.
+    """
+
+    query = "SELECT c.id, c.first_name, c.last_name FROM c"
+    prefix_filter = " WHERE STARTSWITH(c.id, @prefix, true) OR STARTSWITH(c.first_name, @prefix, true) OR STARTSWITH(c.last_name, @prefix, true)"
+
+    def __init__(self, cosmos, category_id=COSMOS_CATEGORYID_VALUE, ttl=CUSTOMER_LIST_CACHE_TTL, max_entries=1000):
+        self.cosmos = cosmos
+        self.category_id = category_id
+        self.cache = JSONCache(InMemoryCacheBackend(ttl=ttl, max_entries=max_entries))
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    @staticmethod
+    def to_entry(customer):
+        full_name = f"{customer.get('first_name') or ''} {customer.get('last_name') or ''}".strip()
+        return {"id": customer.get("id"), "name": full_name}
+
+    def get_page(self, prefix=None, page_size=CUSTOMER_LIST_PAGE_SIZE, continuation_token=None):
+        """
+        :param prefix: Only lists the customers whose id, first name or last name starts with it, case-insensitively.
+        :param continuation_token: The token of the previous page, None for the first page.
+        :return: A dict with the 'customers' of the page, as id and name, and the 'continuation_token' of the next page.
+        """
+        key = make_cache_key("customers", self.generation, prefix or "", page_size, continuation_token or "")
+        page = self.cache.get(key)
+        if page is not None:
+            return page
+
+        query = self.query
+        parameters = []
+        if prefix:
+            query += self.prefix_filter
+            parameters.append({"name": "@prefix", "value": prefix})
+
+        customers, next_token = self.cosmos.query_page(query, parameters, page_size=page_size, continuation_token=continuation_token, partition_key=self.category_id)
+        page = {"customers": [self.to_entry(customer) for customer in customers], "continuation_token": next_token}
+
+        self.cache.set(key, page)
+        return page
+
+    def get_all(self, prefix=None, page_size=1000):
+        """Lists all the customers, following the continuation tokens, for the clients that need the whole list."""
+        customers = []
+        continuation_token = None
+
+        while True:
+            page = self.get_page(prefix=prefix, page_size=page_size, continuation_token=continuation_token)
+            customers += page["customers"]
+            continuation_token = page["continuation_token"]
+            if not continuation_token:
+                return customers
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+        self.cache.clear()
+
+    def get_stats(self):
+        stats = self.cache.get_stats()
+        stats["generation"] = self.generation
+        return stats
@@ -0,0 +1,151 @@
+import io
+import os
+import base64
+import hashlib
+import mimetypes
+import threading
+
+import cv2
+import numpy as np
+from pdf2image import convert_from_bytes
+
+from env_vars import *
+
+
+image_extensions = [".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif"]
+
+
+def guess_content_type(name, data):
+    """Guesses the MIME type of a document from its magic bytes, then from its file name."""
+    if data[:4] == b"%PDF":
+        return "application/pdf"
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if (data[:4] == b"RIFF") and (data[8:12] == b"WEBP"):
+        return "image/webp"
+
+    content_type, _ = mimetypes.guess_type(name)
+    return content_type or "application/octet-stream"
+
+
+class DocumentBuffer:
+    """
+    A document held in memory for the whole analysis pipeline, so that the OpenAI, Blob and Face
+    steps all work from the same bytes instead of writing and re-reading temporary files. The
+    decoded pixels, the hashes and the rasterized PDF pages are computed lazily, once, and shared
+    by all the stages.
+    """
+
+    def __init__(self, name, data, content_type=None, sha256=None):
+        """
+        :param sha256: The hex SHA-256 of the data, when the caller already hashed it, e.g. while receiving it.
+        """
+        self.name = os.path.basename(name) if name else "document"
+        self.data = bytes(data)
+        self.content_type = content_type or guess_content_type(self.name, self.data)
+
+        self.lock = threading.Lock()
+        self._pixels = None
+        self._pages = None
+        self._sha256 = sha256
+        self._md5 = None
+
+    @classmethod
+    def from_file(cls, file_path, content_type=None):
+        with open(file_path, "rb") as f:
+            return cls(file_path, f.read(), content_type=content_type)
+
+    @classmethod
+    def from_base64(cls, name, data_base64, content_type=None):
+        return cls(name, base64.b64decode(data_base64), content_type=content_type)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return f"DocumentBuffer(name={self.name!r}, content_type={self.content_type!r}, size={len(self.data)})"
+
+    @property
+    def extension(self):
+        return os.path.splitext(self.name)[1].lower()
+
+    @property
+    def is_pdf(self):
+        return self.content_type == "application/pdf"
+
+    @property
+    def is_image(self):
+        return self.content_type.startswith("image/") or (self.extension in image_extensions)
+
+    @property
+    def sha256(self):
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.data).hexdigest()
+        return self._sha256
+
+    @property
+    def md5(self):
+        if self._md5 is None:
+            self._md5 = hashlib.md5(self.data).hexdigest()
+        return self._md5
+
+    @property
+    def pixels(self):
+        """
+        The decoded BGR image, as cv2.imread would return it. The array is shared between the
+        stages and is read-only: copy it before drawing on it.
+        """
+        with self.lock:
+            if self._pixels is None:
+                pixels = cv2.imdecode(np.frombuffer(self.data, np.uint8), cv2.IMREAD_COLOR)
+                if pixels is None:
+                    raise ValueError(f"Could not decode {self.name} as an image.")
+                pixels.setflags(write=False)
+                self._pixels = pixels
+            return self._pixels
+
+    @property
+    def pages(self):
+        """
+        The document as a list of image buffers: the PDF pages rasterized at PDF_RASTER_DPI, or
+        the document itself when it is already an image.
+        """
+        if not self.is_pdf:
+            return [self]
+
+        with self.lock:
+            if self._pages is None:
+                stem = os.path.splitext(self.name)[0]
+                self._pages = []
+                for i, page in enumerate(convert_from_bytes(self.data, dpi=PDF_RASTER_DPI)):
+                    buffer = io.BytesIO()
+                    page.save(buffer, format="PNG")
+                    self._pages.append(DocumentBuffer(f"{stem}_page_{i + 1}.png", buffer.getvalue(), content_type="image/png"))
+            return self._pages
+
+
+def as_document_buffer(document):
+    """Wraps a file path or raw bytes in a DocumentBuffer, and passes DocumentBuffers through."""
+    if isinstance(document, DocumentBuffer):
+        return document
+    if isinstance(document, (bytes, bytearray)):
+        return DocumentBuffer("document", document)
+    return DocumentBuffer.from_file(document)
+
+
+def encode_png(pixels):
+    """Encodes a BGR image array as PNG bytes, without going through the disk."""
+    success, encoded = cv2.imencode(".png", pixels)
+    if not success:
+        raise ValueError("Could not encode the image as PNG.")
+    return encoded.tobytes()
+
+
+def encode_jpeg(pixels, quality=95):
+    """Encodes a BGR image array as JPEG bytes, e.g. for uploads where PNG would be needlessly large."""
+    success, encoded = cv2.imencode(".jpg", pixels, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not success:
+        raise ValueError("Could not encode the image as JPEG.")
+    return encoded.tobytes()
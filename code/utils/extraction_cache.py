@@ -0,0 +1,55 @@
+import json
+
+from utils.cache_helpers import *
+
+from env_vars import *
+
+
+class ExtractionCache:
+    """
+    Cache of the IDDocument extracted by the vision model. Extraction does not depend on
+    the customer record, so entries are keyed by the document content hash, the hash of the
+    extraction prompt, the deployments serving the call and the IDDocument schema. Editing a
+    customer record only reruns the comparison, while changing the prompt, the model or the schema
+    naturally invalidates the cached extractions.
+
+    The entries hold the personal data of the documents (names, dates of birth, document numbers,
+    MRZ), so the cache is in memory by default: the "sqlite" and "cosmos" backends store them at
+    rest, unencrypted by this module. A hit also reuses the file_url of the first upload, since the
+    document is not uploaded again: the blob is named after the content hash, so it is the same
+    document, as long as the blob was not deleted meanwhile.
+    """
+
+    def __init__(self, backend="memory", ttl=EXTRACTION_CACHE_TTL, max_entries=EXTRACTION_CACHE_MAX_ENTRIES):
+        self.cache = JSONCache(create_cache_backend(backend, "extractions", ttl=ttl, max_entries=max_entries))
+        self.text_hashes = {}
+
+    def hash_once(self, text):
+        if text not in self.text_hashes:
+            self.text_hashes[text] = hash_text(text)
+        return self.text_hashes[text]
+
+    def make_key(self, content_hash, prompt_template, deployments, response_format):
+        schema = json.dumps(response_format.schema(), sort_keys=True)
+        return make_cache_key("extraction", content_hash, self.hash_once(prompt_template), ",".join(deployments), self.hash_once(schema))
+
+    def get(self, key):
+        """:return: The cached IDDocument as a dict, or None."""
+        return self.cache.get(key)
+
+    def set(self, key, id_doc_dict):
+        self.cache.set(key, id_doc_dict)
+
+    @property
+    def enabled(self):
+        return self.cache.enabled
+
+    @property
+    def max_entries(self):
+        return self.cache.max_entries
+
+    def get_stats(self):
+        return self.cache.get_stats()
+
+
+extraction_cache = ExtractionCache(backend=EXTRACTION_CACHE_BACKEND)
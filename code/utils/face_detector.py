@@ -1,29 +1,175 @@
+import logging
+import threading
+
 import cv2
-from ultralytics import YOLO
-import matplotlib.pyplot as plt
+
+from env_vars import *
+
+
+def score_face_quality(image, box, confidence):
+    """
+    Scores how usable a detected face is for recognition, from 0 to 1, from the detector
+    confidence, the sharpness (variance of the Laplacian), the size and the exposure of the face.
+
+    :param image: The BGR image the face was detected in.
+    :param box: The (x1, y1, x2, y2) face box.
+    :param confidence: The detector confidence.
+    :return: A dict with the overall quality and its components.
+    """
+    x1, y1, x2, y2 = box
+    face = image[y1:y2, x1:x2]
+    if face.size == 0:
+        return {"quality": 0.0, "sharpness": 0.0, "size": 0.0, "exposure": 0.0}
+
+    gray = cv2.cvtColor(face, cv2.COLOR_BGR2GRAY) if face.ndim == 3 else face
+    sharpness = min(1.0, float(cv2.Laplacian(gray, cv2.CV_64F).var()) / 500.0)
+    # The Face API recommends faces of at least 200 pixels for recognition
+    size = min(1.0, (y2 - y1) / 200.0)
+    exposure = 1.0 - abs(float(gray.mean()) - 128.0) / 128.0
+
+    quality = float(confidence) * (0.5 * sharpness + 0.3 * size + 0.2 * exposure)
+    return {"quality": round(quality, 4), "sharpness": round(sharpness, 4), "size": round(size, 4), "exposure": round(exposure, 4)}
+
 
 class FaceDetector:
-    def __init__(self, model_path='yolov8n.pt'):
-        # Load the YOLOv8 model
-        self.model = YOLO(model_path)  # You can also use 'yolov8n.pt' for a nano model
-
-    def detect_faces(self, image_path, confidence_threshold=0.01):
-        # Read the image
-        image = cv2.imread(image_path)
-        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)  # Convert to RGB for visualization
-
-        # Run inference
-        results = self.model(image_rgb,  conf=confidence_threshold)
-        detected_faces = [res for res in results[0].boxes.data.tolist() if res[5] == 0]  # Assuming class_id 0 is for 'person'
-        print(detected_faces)
-
-        # Draw bounding boxes
-        if len(detected_faces) > 0:
-            x1, y1, x2, y2, confidence, class_id = detected_faces[0]
-            if class_id == 0:  # Assuming class_id 0 is for 'person'
-                cv2.rectangle(image, (int(x1), int(y1)), (int(x2), int(y2)), (255, 0, 0), 3)
-
-        # Display the results
-        plt.axis('off')
-        plt.imshow(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))  # Convert back to RGB for displaying
-        plt.show()
+    """
+    Base class of the local CPU face detectors. A backend implements detect_boxes_batch, and gets
+    quality scoring, best face selection and cropping from this class. Faces are dicts with the
+    'box' (x1, y1, x2, y2), the detector 'confidence' and the quality scores.
+    """
+
+    def __init__(self, confidence_threshold=LOCAL_FACE_MIN_CONFIDENCE):
+        self.confidence_threshold = confidence_threshold
+        self.lock = threading.Lock()
+
+    def detect_boxes_batch(self, images):
+        """:return: For each BGR image, a list of ((x1, y1, x2, y2), confidence) tuples."""
+        raise NotImplementedError
+
+    def detect_batch(self, images):
+        """
+        Detects and scores the faces of several BGR images in a single inference call.
+
+        :return: For each image, its faces sorted from the highest to the lowest quality.
+        """
+        with self.lock:
+            boxes_batch = self.detect_boxes_batch(images)
+
+        faces_batch = []
+        for image, boxes in zip(images, boxes_batch):
+            height, width = image.shape[:2]
+            faces = []
+            for (x1, y1, x2, y2), confidence in boxes:
+                if confidence < self.confidence_threshold: continue
+                box = (max(0, int(x1)), max(0, int(y1)), min(width, int(x2)), min(height, int(y2)))
+                faces.append({"box": box, "confidence": round(float(confidence), 4), **score_face_quality(image, box, confidence)})
+            faces_batch.append(sorted(faces, key=lambda f: f["quality"], reverse=True))
+
+        return faces_batch
+
+    def detect(self, image):
+        return self.detect_batch([image])[0]
+
+    def select_best_face(self, images):
+        """
+        Picks the best face across several images, e.g. the pages of a PDF.
+
+        :return: A tuple of (image index, face), or (None, None) if there is no face at all.
+        """
+        best = (None, None)
+        for i, faces in enumerate(self.detect_batch(images)):
+            if (len(faces) > 0) and ((best[1] is None) or (faces[0]["quality"] > best[1]["quality"])):
+                best = (i, faces[0])
+        return best
+
+    @staticmethod
+    def crop_face(image, face, margin=0.6):
+        """Crops the face with a margin around it, keeping enough context for the Face API."""
+        height, width = image.shape[:2]
+        x1, y1, x2, y2 = face["box"]
+        margin_x, margin_y = int((x2 - x1) * margin), int((y2 - y1) * margin)
+        return image[max(0, y1 - margin_y):min(height, y2 + margin_y), max(0, x1 - margin_x):min(width, x2 + margin_x)]
+
+    @staticmethod
+    def draw_faces(image, faces, color=(255, 0, 0)):
+        """Returns a copy of the image with the face boxes drawn, e.g. to display it in a notebook."""
+        image = image.copy()
+        for face in faces:
+            x1, y1, x2, y2 = face["box"]
+            cv2.rectangle(image, (x1, y1), (x2, y2), color, 3)
+        return image
+
+
+class YOLOFaceDetector(FaceDetector):
+    """
+    YOLO detector running on the CPU. It needs weights trained on faces (e.g. a YOLOv8 face model),
+    whose face class is face_class_id: the generic COCO weights only know about whole persons.
+    """
+
+    def __init__(self, model_path=LOCAL_YOLO_MODEL_PATH, confidence_threshold=LOCAL_FACE_MIN_CONFIDENCE, face_class_id=0, device="cpu"):
+        super().__init__(confidence_threshold=confidence_threshold)
+        from ultralytics import YOLO
+
+        self.model = YOLO(model_path)
+        self.face_class_id = face_class_id
+        self.device = device
+
+    def detect_boxes_batch(self, images):
+        # Ultralytics takes BGR arrays, as decoded by OpenCV
+        results = self.model(list(images), conf=self.confidence_threshold, device=self.device, verbose=False)
+        return [
+            [((x1, y1, x2, y2), confidence) for x1, y1, x2, y2, confidence, class_id in result.boxes.data.tolist() if int(class_id) == self.face_class_id]
+            for result in results
+        ]
+
+
+class YuNetFaceDetector(FaceDetector):
+    """
+    OpenCV YuNet detector (cv2.FaceDetectorYN), a small CPU face model that only needs OpenCV
+    and its ONNX weights (face_detection_yunet_2023mar.onnx from the OpenCV model zoo).
+    """
+
+    def __init__(self, model_path=LOCAL_YUNET_MODEL_PATH, confidence_threshold=LOCAL_FACE_MIN_CONFIDENCE):
+        super().__init__(confidence_threshold=confidence_threshold)
+        self.model = cv2.FaceDetectorYN.create(model_path, "", (320, 320), score_threshold=confidence_threshold)
+
+    def detect_boxes_batch(self, images):
+        # YuNet takes one image at a time, at its own input size
+        boxes_batch = []
+        for image in images:
+            if image.ndim == 2:
+                image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+            height, width = image.shape[:2]
+            self.model.setInputSize((width, height))
+            _, faces = self.model.detect(image)
+            faces = faces if faces is not None else []
+            boxes_batch.append([((x, y, x + w, y + h), score) for x, y, w, h, *_, score in faces])
+        return boxes_batch
+
+
+face_detector_backends = {
+    "yolo": YOLOFaceDetector,
+    "yunet": YuNetFaceDetector,
+}
+
+face_detector = None
+face_detector_lock = threading.Lock()
+
+
+def get_face_detector(backend=LOCAL_FACE_DETECTOR):
+    """
+    Returns the process-wide local face detector, loading its model on the first call (the API
+    loads it at startup). The backend is "yolo", "yunet" or "none", which disables local detection.
+
+    :return: The FaceDetector, or None when local detection is disabled.
+    """
+    global face_detector
+
+    if backend.lower() not in face_detector_backends:
+        return None
+
+    with face_detector_lock:
+        if face_detector is None:
+            logging.info(f"Loading the local '{backend}' face detector.")
+            face_detector = face_detector_backends[backend.lower()]()
+        return face_detector
@@ -19,6 +19,7 @@ import uuid
 from pydantic import BaseModel
 
 from utils.storage_helpers import *
+from utils.async_helpers import *
 from env_vars import *
 
 class LivenessSessionRequest(BaseModel):
@@ -36,7 +37,8 @@ class FaceLivenessDetectionService:
     async def startLivenessDetection(self, live_session_content=None, verify_image_content=None):
         if verify_image_content is not None:
             # Create liveness session with verification
-            created_session = self.face_session_client.create_liveness_with_verify_session(
+            created_session = await run_blocking(
+                self.face_session_client.create_liveness_with_verify_session,
                 CreateLivenessWithVerifySessionContent(
                     liveness_operation_mode=live_session_content.livenessOperationMode,
                     device_correlation_id=live_session_content.deviceCorrelationId,
@@ -47,7 +49,8 @@ class FaceLivenessDetectionService:
             )
         else:
             # Create liveness session without verification
-            created_session = self.face_session_client.create_liveness_session(
+            created_session = await run_blocking(
+                self.face_session_client.create_liveness_session,
                 CreateLivenessSessionContent(
                     liveness_operation_mode=live_session_content.livenessOperationMode,
                     device_correlation_id=live_session_content.deviceCorrelationId,
@@ -64,7 +67,7 @@ class FaceLivenessDetectionService:
 
     async def queryLivenessDetectionResults(self, session_id):
         try:
-            liveness_result = self.face_session_client.get_liveness_session_result(session_id)
+            liveness_result = await run_blocking(self.face_session_client.get_liveness_session_result, session_id)
             print(f"Session id: {liveness_result.id}")
             print(f"Session status: {liveness_result.status}")
             print(f"Liveness status: {liveness_result.liveness_result.liveness_assessment}")
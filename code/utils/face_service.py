@@ -14,30 +14,41 @@ import uuid
 
 
 from utils.storage_helpers import *
+from utils.document_buffer import DocumentBuffer, as_document_buffer, encode_png, encode_jpeg
+from utils.async_helpers import run_concurrently, run_in_background
+from utils.reference_face_cache import reference_face_cache
+from utils.face_detector import FaceDetector, get_face_detector
 from env_vars import *
 
 storage_helper = BlobStorageHelper()
 
+# The Face API models of all the detections, also recorded with each analysis
+face_detection_model = FaceDetectionModel.DETECTION03
+face_recognition_model = FaceRecognitionModel.RECOGNITION04
+
 
 class FaceRecognitionService:
-    def __init__(self, endpoint = FACE_API_ENDPOINT, key = FACE_API_KEY, face_id_time_to_live=120, buffer=10):
+    def __init__(self, endpoint = FACE_API_ENDPOINT, key = FACE_API_KEY, face_id_time_to_live=120, buffer=10, face_detector=None):
         self.buffer = buffer
-        self.work_dir = 'temp_imgs'
-        os.makedirs(self.work_dir, exist_ok=True)
         # self.credential = DefaultAzureCredential()
         self.face_client = FaceClient(endpoint=endpoint, credential=AzureKeyCredential(key))
         # self.face_client = FaceClient(endpoint=endpoint, credential=self.credential)
         self.face_id_time_to_live = face_id_time_to_live
+        # Local CPU detector pre-screening the documents, None when disabled (LOCAL_FACE_DETECTOR)
+        self.face_detector = face_detector if face_detector is not None else get_face_detector()
 
-    def detect_faces(self, sample_file_path, display_image=False, print_results=False):
-        """Detect faces in an image and optionally display results."""
-        with open(sample_file_path, "rb") as fd:
-            file_content = fd.read()
+    def detect_faces(self, image, display_image=False, print_results=False, annotate=False):
+        """
+        Detect faces in an image (a DocumentBuffer, bytes or a file path) and optionally display results.
+        By default only the face metadata is returned: with annotate=True, an image with the rectangle
+        of each face is also rendered and uploaded in the background (see annotate_faces).
+        """
+        image = as_document_buffer(image)
 
         result = self.face_client.detect(
-            file_content,
-            detection_model=FaceDetectionModel.DETECTION03,
-            recognition_model=FaceRecognitionModel.RECOGNITION04,
+            image.data,
+            detection_model=face_detection_model,
+            recognition_model=face_recognition_model,
             return_face_id=True,
             return_face_attributes=[
                 FaceAttributeTypeDetection03.HEAD_POSE,
@@ -52,17 +63,16 @@ class FaceRecognitionService:
 
         face_ids = [face.face_id for face in result]
 
-        if print_results: print(f"Detected faces from the file: {sample_file_path}")
-        rectangled_images = []
+        if print_results: print(f"Detected faces from the document: {image.name}")
 
         for idx, face in enumerate(result):
             if print_results: 
                 print(f"----- Detection result: #{idx + 1} -----")
                 print(f"Face: {face.as_dict()}")
 
-            output_path = self._draw_face_rectangle(sample_file_path, face, display_image=display_image)
-            blob_output_path = storage_helper.upload_document(output_path) 
-            rectangled_images.append(blob_output_path)
+            if display_image: self._draw_face_rectangle(image, face, display_image=True)
+
+        rectangled_images = self.annotate_faces(image, result) if annotate else []
         
         return {
             "face_ids": face_ids, 
@@ -75,9 +85,71 @@ class FaceRecognitionService:
         verify_result = self.face_client.verify_face_to_face(face_id1=face_id1, face_id2=face_id2)
         return verify_result
 
-    def _draw_face_rectangle(self, image_path, face, isIdentical = False, display_image = False):
-        """Draw rectangle around the detected face and display the image."""
-        image = cv2.imread(image_path)
+    def _upload_png(self, data, prefix):
+        return storage_helper.upload_bytes(data, f"{prefix}_{uuid.uuid4()}.png", content_type="image/png")
+
+    def _load_image(self, image):
+        """Loads a blob URL into memory, and wraps file paths and bytes in a DocumentBuffer."""
+        if isinstance(image, str) and image.startswith("http") and (".blob.core.windows.net" in image):
+            data = storage_helper.download_blob_bytes_by_url(image)
+            return DocumentBuffer(urllib.parse.urlparse(image).path, data)
+        return as_document_buffer(image)
+
+    def _load_and_detect_faces(self, image, display_image=False, print_results=False):
+        image = self._load_image(image)
+        return image, self.detect_faces(image, display_image=display_image, print_results=print_results)
+
+    def load_reference_faces(self, photo_url, customer_id=None, display_image=False, print_results=False):
+        """
+        Loads and detects the stored reference photo of a customer through the reference face cache.
+        Only the blob etag is fetched while the cached entry is current, and once its face ids are
+        about to expire, they are refreshed by re-detecting from the cached bytes.
+
+        :return: A tuple of the image and the detect_faces results.
+        """
+        if not (isinstance(photo_url, str) and photo_url.startswith("http") and (".blob.core.windows.net" in photo_url)):
+            return self._load_and_detect_faces(photo_url, display_image=display_image, print_results=print_results)
+
+        key = reference_face_cache.make_key(customer_id, photo_url, storage_helper.get_blob_etag_by_url(photo_url))
+        entry = reference_face_cache.get(key)
+
+        if entry is None:
+            image, detection = self._load_and_detect_faces(photo_url, display_image=display_image, print_results=print_results)
+        elif reference_face_cache.face_ids_expired(entry):
+            image = entry["image"]
+            detection = self.detect_faces(image, display_image=display_image, print_results=print_results)
+            reference_face_cache.stats.increment("face_id_refreshes")
+        else:
+            return entry["image"], entry["detection"]
+
+        reference_face_cache.set(key, image, detection, self.face_id_time_to_live)
+        return image, detection
+
+    def annotate_faces(self, image, faces, isIdentical = False):
+        """
+        Opt-in annotation stage: renders the rectangle of each face from the already decoded image
+        and uploads the annotated images in the background.
+
+        :return: The URLs the annotated images will be available at.
+        """
+        image = as_document_buffer(image)
+        return [self._annotate_in_background(image, face, isIdentical=isIdentical) for face in faces]
+
+    def _annotate_in_background(self, image, face, isIdentical = False):
+        """
+        Draws the face rectangle and uploads the annotated image in the background.
+
+        :return: The URL the annotated image will be available at once uploaded.
+        """
+        blob_name = f"face_rectangle_{uuid.uuid4()}.png"
+        run_in_background(
+            lambda: storage_helper.upload_bytes(self._draw_face_rectangle(image, face, isIdentical=isIdentical), blob_name, content_type="image/png")
+        )
+        return storage_helper.get_document_url(blob_name)
+
+    def _draw_face_rectangle(self, image, face, isIdentical = False, display_image = False):
+        """Draw rectangle around the detected face on a copy of the image, and return it as PNG bytes."""
+        image = image.pixels.copy()
         fd = face.as_dict()
         
         
@@ -90,8 +162,6 @@ class FaceRecognitionService:
         color = (0, 255, 0) if isIdentical else (0, 0, 255)
 
         cv2.rectangle(image, (x1, y1), (x2, y2), color, 3)
-        output_path = os.path.join(self.work_dir, f"face_rectangle_{uuid.uuid4()}.png")
-        cv2.imwrite(output_path, image)
 
         if display_image:
             # Display the image
@@ -99,7 +169,7 @@ class FaceRecognitionService:
             plt.imshow(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
             plt.show()
 
-        return output_path
+        return encode_png(image)
 
 
 
@@ -110,24 +180,56 @@ class FaceRecognitionService:
             results = photo_analysis_ret_dict['results']
 
             if len(face_ids) > 0:                                  
-                im_fn = self.extract_and_save_cropped_face(im, results)     
-                print(f"Uploading face image to blob storage: {im_fn}")
-                id_doc.photo = storage_helper.upload_document(im_fn)                                        
+                cropped_face = self.extract_cropped_face(im, results)     
+                print("Uploading face image to blob storage.")
+                id_doc.photo = self._upload_png(cropped_face, "face")
                 break
 
         return id_doc
     
 
-    def compare_document_photos(self, file_path_1, file_path_2, display_image=False, print_results=False):
-
-        if file_path_1.startswith("http") and (".blob.core.windows.net" in file_path_1):
-            file_path_1 = storage_helper.download_blob_by_url(file_path_1)
-
-        if file_path_2.startswith("http") and (".blob.core.windows.net" in file_path_2):
-            file_path_2 = storage_helper.download_blob_by_url(file_path_2)
-
-        ret_dict_1 = self.detect_faces(file_path_1, display_image=display_image, print_results=print_results)
-        ret_dict_2 = self.detect_faces(file_path_2, display_image=display_image, print_results=print_results)
+    def prescreen_document(self, images):
+        """
+        Pre-screens the document images (e.g. the pages of a PDF) with the local face detector,
+        in a single batch, before any Face API round-trip.
+
+        :return: A tuple of the image to send to the Face API and the local face found on it. The image
+                 is a crop around the best face, or None if there is no face at all. Without a local
+                 detector, the first image is returned as is.
+        """
+        images = [self._load_image(image) for image in images]
+        if self.face_detector is None:
+            return images[0], None
+
+        index, face = self.face_detector.select_best_face([image.pixels for image in images])
+        if face is None:
+            return None, None
+
+        crop = FaceDetector.crop_face(images[index].pixels, face)
+        return DocumentBuffer(f"face_{os.path.splitext(images[index].name)[0]}.jpg", encode_jpeg(crop), content_type="image/jpeg"), face
+
+    def compare_document_photos(self, file_path_1, file_path_2, display_image=False, print_results=False, customer_id=None):
+        """
+        Compares the faces of two images. Each image can be a DocumentBuffer, bytes, a file path
+        or a blob URL, which is downloaded into memory. The first image can also be a list of
+        document pages, pre-screened by the local face detector. The second image is the customer
+        reference photo, and goes through the reference face cache.
+        """
+        # Documents without any face are rejected before calling the Face API, and only the best
+        # face crop is sent to it
+        file_path_1, local_face = self.prescreen_document(file_path_1 if isinstance(file_path_1, list) else [file_path_1])
+        if file_path_1 is None:
+            print("No face found on the document.")
+            return {
+                "error": "No face found on the document.",
+                'isIdentical': False, 
+                'confidence': -1
+            }
+        # The two downloads and detections are independent round-trips, so they run side by side
+        (file_path_1, ret_dict_1), (file_path_2, ret_dict_2) = run_concurrently([
+            lambda: self._load_and_detect_faces(file_path_1, display_image=display_image, print_results=print_results),
+            lambda: self.load_reference_faces(file_path_2, customer_id=customer_id, display_image=display_image, print_results=print_results),
+        ], max_concurrency=2)
 
         face_ids_0 = ret_dict_1['face_ids']
         face_ids_1 = ret_dict_2['face_ids']
@@ -144,16 +246,13 @@ class FaceRecognitionService:
             face_1 = self.find_highest_quality_face(ret_dict_1['results'])
             face_2 = self.find_highest_quality_face(ret_dict_2['results'])
 
-            verify_result = self.verify_faces(face_1['faceId'], face_2['faceId'])
-
-            im_fn_1 = self._draw_face_rectangle(file_path_1, face_1, isIdentical=verify_result['isIdentical'])     
-            photo_1 = storage_helper.upload_document(im_fn_1)   
-
-            im_fn_2 = self._draw_face_rectangle(file_path_2, face_2, isIdentical=verify_result['isIdentical'])     
-            photo_2 = storage_helper.upload_document(im_fn_2)   
+            # Plain dict, so the result is JSON-serializable
+            verify_result = self.verify_faces(face_1['faceId'], face_2['faceId']).as_dict()
 
-            verify_result['photo_1'] = photo_1
-            verify_result['photo_2'] = photo_2
+            # The annotated images are drawn and uploaded after the verdict is returned
+            verify_result['photo_1'] = self._annotate_in_background(file_path_1, face_1, isIdentical=verify_result['isIdentical'])
+            verify_result['photo_2'] = self._annotate_in_background(file_path_2, face_2, isIdentical=verify_result['isIdentical'])
+            if local_face is not None: verify_result['document_face_quality'] = local_face
             print(f"Verify face to face: {verify_result}")
 
         return verify_result
@@ -168,29 +267,21 @@ class FaceRecognitionService:
         
         return face
 
-    def extract_and_save_cropped_face(self, image_path, faces):
-        """Extract the cropped face from the image and save it as a new image file."""
+    def extract_cropped_face(self, image, faces):
+        """Extract the cropped face from the image, and return it as PNG bytes."""
 
         face = self.find_highest_quality_face(faces)
         
-        image = cv2.imread(image_path)
+        image = as_document_buffer(image).pixels
         fd = face.as_dict()
 
         # Extract face rectangle coordinates
-        x1 = fd['faceRectangle']['left'] - self.buffer
-        y1 = fd['faceRectangle']['top'] - self.buffer
+        x1 = max(0, fd['faceRectangle']['left'] - self.buffer)
+        y1 = max(0, fd['faceRectangle']['top'] - self.buffer)
         x2 = x1 + fd['faceRectangle']['width'] + 2*self.buffer
         y2 = y1 + fd['faceRectangle']['height'] + 2*self.buffer
 
         # Crop the face from the image
         cropped_face = image[y1:y2, x1:x2]
 
-        # Generate a unique filename for the cropped face image
-        file_name = f"{uuid.uuid4()}.png"
-        file_path = os.path.join(self.work_dir, file_name)
-
-        # Save the cropped face image
-        cv2.imwrite(file_path, cropped_face)
-
-        print(f"Cropped face saved at: {file_path}")
-        return file_path    
\ No newline at end of file
+        return encode_png(cropped_face)
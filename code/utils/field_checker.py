@@ -1,4 +1,7 @@
 import os
+import logging
+
+from pydantic import ValidationError
 
 from data_models.id_document import *
 from data_models.name_check import *
@@ -7,6 +10,7 @@ from data_models.field_check import *
 
 from utils.general_helpers import *
 from utils.cosmos_helpers import *
+from utils.verdict_cache import verdict_cache as shared_verdict_cache
 
 from rich.console import Console
 console = Console()
@@ -17,25 +21,142 @@ module_directory = os.path.dirname(os.path.abspath(__file__))
 
 address_check_prompt_template = read_file(os.path.join(module_directory, "../prompts/address_comparison_prompt.txt"))
 field_check_prompt_template = read_file(os.path.join(module_directory, "../prompts/field_comparison_prompt.txt"))
-name_check_prompt_template = read_file(os.path.join(module_directory, "../prompts/name_comparison_prompt.txt"))  
+name_check_prompt_template = read_file(os.path.join(module_directory, "../prompts/name_comparison_prompt.txt"))
+field_batch_check_prompt_template = read_file(os.path.join(module_directory, "../prompts/field_batch_comparison_prompt.txt"))
 
 
 class FieldChecker:
 
-    def __init__(self):
-        pass
+    def __init__(self, verdict_cache = None):
+        self.verdict_cache = verdict_cache if verdict_cache is not None else shared_verdict_cache
+
+    def cached_check(self, key, ask_llm, build_result):
+        """
+        Returns the cached verdict for the key if there is one, otherwise asks the LLM and caches its verdict.
+
+        :param key: The verdict cache key.
+        :param ask_llm: A zero-argument callable returning the LLM comparison result.
+        :param build_result: A callable building the comparison result from a cached verdict.
+        """
+        verdict = self.verdict_cache.get(key)
+        if verdict is not None:
+            return build_result(verdict)
+
+        check = ask_llm()
+        self.verdict_cache.set(key, check.result)
+        return check
+
+    def result_factory(self, check_type, field1, field2):
+        """:return: A callable building the comparison result of the pair from a verdict, of the result type of its check type."""
+        if check_type == "name":
+            return lambda verdict: NameComparisonResult(name1=field1, name2=field2, result=verdict)
+        elif check_type == "address":
+            return lambda verdict: AddressComparisonResult(address1=field1, address2=field2, result=verdict)
+        else:
+            return lambda verdict: FieldComparisonResult(field1=field1, field2=field2, result=verdict)
+
+    def prepare_check(self, check_type, field_name, field1, field2):
+        """
+        Builds a single comparison without running it, so that it can either be sent right away
+        or written to an offline OpenAI batch.
+
+        :return: A tuple of the verdict cache key, the prompt, the response format and a callable building the comparison result from a verdict.
+        """
+        if check_type == "name":
+            prompt = name_check_prompt_template.format(name1=field1, name2=field2)
+            key = self.verdict_cache.make_key("name", name_check_prompt_template, field1, field2)
+            return key, prompt, NameComparisonResult, self.result_factory(check_type, field1, field2)
+        elif check_type == "address":
+            prompt = address_check_prompt_template.format(address1=field1, address2=field2)
+            key = self.verdict_cache.make_key("address", address_check_prompt_template, field1, field2)
+            return key, prompt, AddressComparisonResult, self.result_factory(check_type, field1, field2)
+        else:
+            prompt = field_check_prompt_template.format(field_name=field_name, field1=field1, field2=field2)
+            key = self.verdict_cache.make_key("field", field_check_prompt_template, field1, field2, field_name=field_name)
+            return key, prompt, FieldComparisonResult, self.result_factory(check_type, field1, field2)
 
     def check_address(self, address1, address2):
-        prompt = address_check_prompt_template.format(address1=address1, address2=address2)
-        address_check = ask_LLM_with_structured_outputs(prompt, response_format=AddressComparisonResult)
-        return address_check
-    
+        return self.check("address", None, address1, address2)
+
     def check_field(self, field_name, field1, field2):
-        prompt = field_check_prompt_template.format(field_name=field_name, field1=field1, field2=field2)
-        field_check = ask_LLM_with_structured_outputs(prompt, response_format=FieldComparisonResult)
-        return field_check
-    
+        return self.check("field", field_name, field1, field2)
+
     def check_name(self, name1, name2):
-        prompt = name_check_prompt_template.format(name1=name1, name2=name2)
-        name_check = ask_LLM_with_structured_outputs(prompt, response_format=NameComparisonResult)
-        return name_check
\ No newline at end of file
+        return self.check("name", None, name1, name2)
+
+    def check(self, check_type, field_name, field1, field2):
+        """Runs a single comparison with the prompt matching its type ('name', 'address' or 'field')."""
+        key, prompt, response_format, build_result = self.prepare_check(check_type, field_name, field1, field2)
+        return self.cached_check(
+            key,
+            lambda: ask_LLM_with_structured_outputs(prompt, response_format=response_format),
+            build_result
+        )
+
+    def prepare_fields_batch(self, field_pairs):
+        """
+        Builds the single request comparing several field pairs, without running it. Pairs with a
+        cached verdict are decided right away and left out of the prompt.
+
+        :param field_pairs: A dict of field name to a (check_type, field1, field2) tuple.
+        :return: A tuple of the cached checks, the verdict cache keys, the pairs left to send and the prompt (None if there is nothing to send).
+        """
+        checks = {}
+        keys = {}
+
+        for field_name, (check_type, field1, field2) in field_pairs.items():
+            keys[field_name] = self.verdict_cache.make_key(f"batch-{check_type}", field_batch_check_prompt_template, field1, field2, field_name=field_name)
+            verdict = self.verdict_cache.get(keys[field_name])
+            if verdict is not None:
+                checks[field_name] = self.result_factory(check_type, field1, field2)(verdict)
+
+        field_pairs = {k: v for k, v in field_pairs.items() if k not in checks}
+        if len(field_pairs) == 0:
+            return checks, keys, field_pairs, None
+
+        fields = "\n".join([
+            f"{i + 1}.\nField Name: {field_name}\nCheck Type: {check_type}\nField 1: {field1}\nField 2: {field2}\n"
+            for i, (field_name, (check_type, field1, field2)) in enumerate(field_pairs.items())
+        ])
+
+        return checks, keys, field_pairs, field_batch_check_prompt_template.format(fields=fields)
+
+    def apply_fields_batch(self, batch_check, field_pairs, keys):
+        """
+        Maps a FieldBatchComparisonResult back onto the field pairs it was asked about, and caches the verdicts.
+
+        :return: A dict of field name to comparison result, of the same type as a single check of the pair would return.
+        """
+        checks = {}
+
+        for item in batch_check.results:
+            if item.field_name not in field_pairs: continue
+            check_type, field1, field2 = field_pairs[item.field_name]
+            try:
+                checks[item.field_name] = self.result_factory(check_type, field1, field2)(item.result)
+            except ValidationError:
+                # e.g. 'ToBeChecked' for an address, which a single address check never returns
+                logging.warning(f"Batched {check_type} check of field {item.field_name} returned '{item.result}', leaving it out.")
+                continue
+            self.verdict_cache.set(keys[item.field_name], item.result)
+
+        return checks
+
+    def check_fields_batch(self, field_pairs):
+        """
+        Compares all the field pairs in a single structured-output request, so that the
+        few-shot prompt is paid once per document instead of once per field. Pairs with
+        a cached verdict are not sent.
+
+        :param field_pairs: A dict of field name to a (check_type, field1, field2) tuple.
+        :return: A dict of field name to comparison result (NameComparisonResult, AddressComparisonResult or FieldComparisonResult,
+            as check() returns). Fields the model did not return a verdict for are left out.
+        """
+        checks, keys, field_pairs, prompt = self.prepare_fields_batch(field_pairs)
+        if prompt is None:
+            return checks
+
+        batch_check = ask_LLM_with_structured_outputs(prompt, response_format=FieldBatchComparisonResult)
+        checks.update(self.apply_fields_batch(batch_check, field_pairs, keys))
+
+        return checks
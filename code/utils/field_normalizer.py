@@ -0,0 +1,174 @@
+import re
+import unicodedata
+from datetime import date
+
+from data_models.field_check import *
+
+
+identifier_fields = ['passport_number', 'license_number', 'national_id_number', 'social_security_number', 'passport_mrz_code']
+
+gender_values = {
+    'm': 'male', 'male': 'male', 'man': 'male',
+    'f': 'female', 'female': 'female', 'woman': 'female',
+    'x': 'unspecified', 'unspecified': 'unspecified',
+}
+
+month_names = {
+    'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+    'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12,
+}
+
+iso_date_re = re.compile(r"^(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})$")
+numeric_date_re = re.compile(r"^(\d{1,2})([-/.])(\d{1,2})\2(\d{4})$")
+day_month_year_re = re.compile(r"^(\d{1,2})(?:st|nd|rd|th)?\s+([a-z]+)\.?,?\s+(\d{4})$")
+month_day_year_re = re.compile(r"^([a-z]+)\.?\s+(\d{1,2})(?:st|nd|rd|th)?,?\s+(\d{4})$")
+
+
+def strip_diacritics(text):
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+def normalize_text(text):
+    """Case, diacritic, quote and whitespace insensitive form of a field value."""
+    text = strip_diacritics(str(text)).casefold().strip().strip("'\"").strip()
+    return re.sub(r"\s+", " ", text)
+
+
+def normalize_words(text):
+    """Like normalize_text, but also drops punctuation, keeping only the words."""
+    return re.sub(r"[^\w]+", " ", normalize_text(text)).split()
+
+
+def normalize_identifier(text):
+    """Keeps only the letters and digits of an identifier, e.g. 'DL-987654' -> 'DL987654'."""
+    return re.sub(r"[^0-9A-Za-z]", "", strip_diacritics(str(text))).upper()
+
+
+def safe_date(year, month, day):
+    try:
+        return date(int(year), int(month), int(day))
+    except ValueError:
+        return None
+
+
+def parse_date_candidates(text):
+    """
+    Parses a date string into the set of dates it can represent.
+
+    :return: A tuple of (set of dates, numeric layout). The set has a single date when the
+             value is unambiguous, two dates when day and month could be swapped (e.g. 06/08/1946),
+             and is empty if the value could not be parsed. The numeric layout is
+             (first number, separator, second number) for DD?MM?YYYY-style values, else None.
+    """
+    text = normalize_text(text)
+
+    m = iso_date_re.match(text)
+    if m:
+        d = safe_date(m.group(1), m.group(2), m.group(3))
+        return ({d} if d else set()), None
+
+    m = numeric_date_re.match(text)
+    if m:
+        a, sep, b, year = int(m.group(1)), m.group(2), int(m.group(3)), m.group(4)
+        candidates = {safe_date(year, b, a), safe_date(year, a, b)} - {None}
+        return candidates, (a, sep, b)
+
+    m = day_month_year_re.match(text)
+    if m and (m.group(2)[:3] in month_names):
+        d = safe_date(m.group(3), month_names[m.group(2)[:3]], m.group(1))
+        return ({d} if d else set()), None
+
+    m = month_day_year_re.match(text)
+    if m and (m.group(1)[:3] in month_names):
+        d = safe_date(m.group(3), month_names[m.group(1)[:3]], m.group(2))
+        return ({d} if d else set()), None
+
+    return set(), None
+
+
+class FieldNormalizer:
+    """
+    Rule-based comparison of field pairs, run before the LLM FieldChecker. It only returns a
+    verdict when the answer is certain, and returns None to escalate the pair to the LLM.
+    """
+
+    def __init__(self):
+        pass
+
+    def result(self, field1, field2, result):
+        return FieldComparisonResult(field1=str(field1), field2=str(field2), result=result)
+
+    def compare(self, check_type, field_name, field1, field2):
+        """
+        :param check_type: One of 'name', 'address' or 'field'.
+        :param field_name: The name of the IDDocument field.
+        :return: A FieldComparisonResult if the pair could be decided locally, else None.
+        """
+        if normalize_text(field1) == normalize_text(field2):
+            return self.result(field1, field2, "Same")
+
+        if normalize_words(field1) == normalize_words(field2):
+            return self.result(field1, field2, "Same")
+
+        if check_type == "name":
+            return self.compare_names(field1, field2)
+
+        if check_type == "address":
+            return None
+
+        if field_name in identifier_fields:
+            return self.compare_identifiers(field1, field2)
+
+        if field_name == "gender":
+            return self.compare_genders(field1, field2)
+
+        if ("date" in field_name) or ("expiry" in field_name):
+            return self.compare_dates(field1, field2)
+
+        return None
+
+    def compare_names(self, name1, name2):
+        # Same words in a different order, e.g. "Doe John" vs "John Doe"
+        if sorted(normalize_words(name1)) == sorted(normalize_words(name2)):
+            return self.result(name1, name2, "Same")
+        return None
+
+    def compare_identifiers(self, id1, id2):
+        id1_norm, id2_norm = normalize_identifier(id1), normalize_identifier(id2)
+        if (len(id1_norm) == 0) or (len(id2_norm) == 0):
+            return None
+        return self.result(id1, id2, "Same" if id1_norm == id2_norm else "Different")
+
+    def compare_genders(self, gender1, gender2):
+        g1, g2 = gender_values.get(normalize_text(gender1)), gender_values.get(normalize_text(gender2))
+        if (g1 is None) or (g2 is None):
+            return None
+        return self.result(gender1, gender2, "Same" if g1 == g2 else "Different")
+
+    def compare_dates(self, date1, date2):
+        candidates1, layout1 = parse_date_candidates(date1)
+        candidates2, layout2 = parse_date_candidates(date2)
+
+        if (len(candidates1) == 0) or (len(candidates2) == 0):
+            return None
+
+        # No reading of either value can make them equal
+        if candidates1.isdisjoint(candidates2):
+            return self.result(date1, date2, "Different")
+
+        if (len(candidates1) == 1) and (len(candidates2) == 1):
+            return self.result(date1, date2, "Same")
+
+        if (layout1 is not None) and (layout2 is not None):
+            a1, sep1, b1 = layout1
+            a2, sep2, b2 = layout2
+
+            # Same numbers in the same order, e.g. 06.08.1946 vs 06/08/1946
+            if (a1, b1) == (a2, b2):
+                return self.result(date1, date2, "Same")
+
+            # Day and month swapped with the same separator, e.g. 06.08.1946 vs 08.06.1946
+            if ((a1, b1) == (b2, a2)) and (sep1 == sep2):
+                return self.result(date1, date2, "ToBeChecked")
+
+        return None
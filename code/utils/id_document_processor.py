@@ -1,8 +1,8 @@
 import os
 import json
+import functools
+import contextlib
 
-import tempfile 
-from pdf2image import convert_from_path
 import PIL
 from PIL import Image
 import uuid
@@ -16,6 +16,13 @@ from utils.general_helpers import *
 from utils.cosmos_helpers import *
 from utils.face_service import *
 from utils.field_checker import FieldChecker
+from utils.field_normalizer import FieldNormalizer
+from utils.async_helpers import run_concurrently
+from utils.pipeline_helpers import StageGraph
+from utils.document_buffer import DocumentBuffer
+from utils.extraction_cache import extraction_cache
+from utils.analysis_memo import analysis_memo
+from utils.analysis_log import analysis_log
 
 import logging
 
@@ -31,52 +38,64 @@ blob_helper = BlobStorageHelper()
 module_directory = os.path.dirname(os.path.abspath(__file__))
 
 
-class IDDocumentProcessor():
+def service_limit(limiter, service):
+    """:return: A context manager holding the limit of the service for a single call, or doing nothing without a limiter."""
+    return limiter.limit(service) if limiter is not None else contextlib.nullcontext()
+
 
-    def __init__(self, customer_id = None, doc_path = None):
+class IDDocumentProcessor():
 
-        self.work_dir = 'temp_imgs'
-        os.makedirs(self.work_dir, exist_ok=True)
+    def __init__(self, customer_id = None, doc_path = None, document = None):
 
         self.customer_id = customer_id
         self.prompt_template = read_file(os.path.join(module_directory, "../prompts/id_document_extraction.txt"))
-        self.extract_document(doc_path)
+        self.extract_document(doc_path, document)
         self.field_checker = FieldChecker()
+        self.field_normalizer = FieldNormalizer()
 
 
-    def extract_document(self, doc_path):
-        logger.info(f"Extracting information from document: {doc_path}")
-        if doc_path.endswith(".pdf"):
-            pdf_images = convert_from_path(doc_path)
-            self.images = []
+    def extract_document(self, doc_path = None, document = None):
+        """
+        Loads the document to analyze, either from a file path or from an in-memory DocumentBuffer.
+        PDF pages are rasterized in memory, and self.images holds the page buffers shared by all the stages.
+        """
+        if document is None:
+            if doc_path is None:
+                raise ValueError("Provide either a document path or a DocumentBuffer.")
+            document = DocumentBuffer.from_file(doc_path)
 
-            for pdf_image in pdf_images:
-                fn = os.path.join(self.work_dir, str(uuid.uuid4()))
-                pdf_image.save(fn)
-                self.images.append(fn)
+        logger.info(f"Extracting information from document: {document.name}")
+        if not (document.is_pdf or document.is_image):
+            raise ValueError(f"Provide either a PDF or an image.\n{document.name}")
 
-            self.doc_path = doc_path
-
-        elif doc_path.endswith(".jpg") or doc_path.endswith(".png") or doc_path.endswith(".jpeg"):
-            # self.images = [cv2.imread(doc_path)]
-            self.images = [doc_path]
-            self.doc_path = doc_path
-        else:
-            raise ValueError(f"Provide either a PDF path or an image path.\n{doc_path}")
+        self.document = document
+        self.doc_path = document.name
+        self.images = document.pages
 
 
-    def process_document(self, doc_path = None):
+    def process_document(self, doc_path = None, document = None, limiter = None):
+        """
+        :param limiter: An optional ServiceLimiter, held around the LLM call and the upload only, so that
+            the image encoding does not keep an OpenAI slot.
+        """
         photo_analysis_ret_dict = {}
 
-        if doc_path is not None:
-            self.extract_document(doc_path)
-            self.doc_path = doc_path
+        if (doc_path is not None) or (document is not None):
+            self.extract_document(doc_path, document)
 
-        doc_explanation = "Please check attached image."
-        extracted = "No extracted information."
-        prompt = self.prompt_template.format(document=doc_explanation, extracted=extracted)
-        id_doc = ask_LLM_with_structured_outputs(prompt,  self.images, response_format=IDDocument)
-        id_doc.file_url = blob_helper.upload_document(self.doc_path) 
+        # Extraction does not depend on the customer record, so it is cached per document content
+        # (along with the upload, whose blob is named after the same hash)
+        key = self.extraction_cache_key()
+        cached_id_doc = extraction_cache.get(key)
+
+        if cached_id_doc is not None:
+            logger.info(f"Using the cached extraction of document {self.document.name}")
+            id_doc = IDDocumentProcessor.dict_to_IDDocument(cached_id_doc)
+        else:
+            messages = build_structured_output_messages(self.build_extraction_prompt(), self.images)
+            with service_limit(limiter, "openai"):
+                id_doc = ask_LLM_with_structured_outputs(messages, response_format=IDDocument)
+            self.store_extraction(key, id_doc, limiter=limiter)
         
         # if id_doc.photo == 'True':
         #     id_doc = self.rectangle_faces(id_doc)
@@ -87,6 +106,31 @@ class IDDocumentProcessor():
         }
 
 
+    def build_extraction_prompt(self):
+        doc_explanation = "Please check attached image."
+        extracted = "No extracted information."
+        return self.prompt_template.format(document=doc_explanation, extracted=extracted)
+
+
+    def extraction_cache_key(self):
+        return extraction_cache.make_key(self.document.sha256, self.prompt_template, openai_router.get_deployments(), IDDocument)
+
+
+    def store_extraction(self, key, id_doc, limiter = None):
+        """
+        Uploads the document and caches its extraction, whether the IDDocument comes from a
+        synchronous call or from an offline batch.
+
+        :param limiter: An optional ServiceLimiter, whose "blob" limit is held during the upload.
+        """
+        # Stored by content hash, so resubmissions and same-named uploads of other customers do not clash
+        blob_name = f"{self.document.sha256}{self.document.extension}"
+        with service_limit(limiter, "blob"):
+            id_doc.file_url = blob_helper.upload_bytes(self.document.data, blob_name, content_type=self.document.content_type)
+        extraction_cache.set(key, IDDocumentProcessor.IDDocument_to_dict(id_doc))
+        return id_doc
+
+
     def rectangle_faces(self, id_doc, images):
         if images is None: images = self.images
 
@@ -98,9 +142,9 @@ class IDDocumentProcessor():
             results = photo_analysis_ret_dict['results']
 
             if len(face_ids) > 0:                                  
-                im_fn, face_index = face_service.extract_and_save_cropped_face(im, results)     
-                print(f"Uploading face image to blob storage: {im_fn}")
-                id_doc.photo = blob_helper.upload_document(im_fn)                                        
+                cropped_face = face_service.extract_cropped_face(im, results)     
+                print("Uploading face image to blob storage.")
+                id_doc.photo = blob_helper.upload_bytes(cropped_face, f"{uuid.uuid4()}.png", content_type="image/png")
                 break
 
         return id_doc
@@ -114,27 +158,18 @@ class IDDocumentProcessor():
         return IDDocument(**id_doc_dict)
     
         
-    def compare_document_to_database(self, customer_id = None, categoryId = COSMOS_CATEGORYID_VALUE):
-
-        if customer_id is None: customer_id = self.customer_id
-
-        red_dict = self.process_document()
-        id_doc = red_dict['id_doc']
-        photo_analysis_ret_dict = red_dict['photo_analysis_ret_dict']
-        id_doc_dict = IDDocumentProcessor.IDDocument_to_dict(id_doc)
-        id_doc_from_db = cosmos.read_document(customer_id, partition_key=categoryId)
-
-        console.print(40*"-")
-        print("-- Extracted Document --")
-        console.print(id_doc_dict)
-        console.print(40*"-")
-        print("-- Database Document --")
-        console.print(id_doc_from_db)
-        console.print(40*"-")
-
+    def collect_field_checks(self, id_doc_dict, id_doc_from_db):
+        """
+        Compares the extracted fields to the database record. Fields that match exactly, or that
+        the rule-based FieldNormalizer can decide with certainty, are decided right away, while
+        the remaining mismatching ones are collected as pending LLM checks.
+
+        :return: A tuple of the decided checks and a dict of field name to a (check_type, field1, field2) tuple for the LLM.
+        """
         name_check = False
 
         checks = {}
+        pending_checks = {}
         
         for k in list(IDDocument.__fields__.keys()):
             if id_doc_dict[k] is None: continue
@@ -146,41 +181,141 @@ class IDDocumentProcessor():
                 continue
                    
             if id_doc_dict[k] != id_doc_from_db[k]:
-                print(f"Field {k} does not match. Document: {id_doc_dict[k]}. Database: {id_doc_from_db[k]}. Calling LLM for comparison.")
+                print(f"Field {k} does not match. Document: {id_doc_dict[k]}. Database: {id_doc_from_db[k]}.")
 
                 if k in names_fields:
-                    if not name_check:
-                        name1 = f"{id_doc_dict['first_name']} {id_doc_dict['middle_name']} {id_doc_dict['last_name']}"
-                        name2 = f"{id_doc_from_db['first_name']} {id_doc_from_db['middle_name']} {id_doc_from_db['last_name']}"
-                        check = self.field_checker.check_name(name1, name2)
-                        name_check = True
-                        checks[k] = check
-                        print(f">>> Name Matching Result: {check}")
+                    # The full name is compared only once, under the first mismatching name field
+                    if name_check: continue
+                    name1 = " ".join([str(id_doc_dict.get(n)) for n in names_fields if id_doc_dict.get(n)])
+                    name2 = " ".join([str(id_doc_from_db.get(n)) for n in names_fields if id_doc_from_db.get(n)])
+                    pending_check = ("name", name1, name2)
+                    name_check = True
                 
                 elif k == 'address':
-                    check = self.field_checker.check_address(id_doc_dict[k], id_doc_from_db[k])
-                    checks[k] = check
-                    print(f">> Address Matching Result: {check}")
+                    pending_check = ("address", id_doc_dict[k], id_doc_from_db[k])
+
+                else:
+                    pending_check = ("field", id_doc_dict[k], id_doc_from_db[k])
+
+                check_type, field1, field2 = pending_check
+                local_check = self.field_normalizer.compare(check_type, k, field1, field2) if FIELD_NORMALIZER_ENABLED else None
 
+                if local_check is not None:
+                    print(f">> Field {k} decided locally. Matching Result: {local_check}")
+                    checks[k] = local_check
                 else:
-                    check = self.field_checker.check_field(k, id_doc_dict[k], id_doc_from_db[k])  
-                    checks[k] = check
-                    print(f">> Field {k} Matching Result: {check}")
+                    print(f"Field {k} needs the LLM for comparison.")
+                    pending_checks[k] = pending_check
                 
             else:
                 print(f"Field {k} matches. Document: {id_doc_dict[k]}. Database: {id_doc_from_db[k]}")
                 checks[k] = FieldComparisonResult(match=True, field1=id_doc_dict[k], field2=id_doc_from_db[k], result="Same")
+
+        return checks, pending_checks
+
+
+    def run_field_checks(self, pending_checks, mode=FIELD_CHECK_MODE, max_concurrency=FIELD_CHECK_MAX_CONCURRENCY):
+        """
+        Runs the pending LLM field checks. In "batch" mode, all of them are sent in a single
+        request; any field left without a verdict falls back to the "parallel" mode, where the
+        checks run concurrently so that the latency is bounded by the slowest one.
+
+        :param pending_checks: A dict of field name to a (check_type, field1, field2) tuple.
+        :param mode: Either "parallel" or "batch".
+        :param max_concurrency: Maximum number of LLM checks in flight for this document.
+        :return: A dict of field name to check result.
+        """
+        checks = {}
+
+        if (mode == "batch") and (len(pending_checks) > 1):
+            try:
+                checks = self.field_checker.check_fields_batch(pending_checks)
+            except Exception as e:
+                logger.warning(f"Batched field check failed, falling back to parallel checks: {e}")
+
+            for k in checks:
+                print(f">> Field {k} Matching Result: {checks[k]}")
+
+            pending_checks = {k: v for k, v in pending_checks.items() if k not in checks}
+
+        funcs = [
+            functools.partial(self.field_checker.check, check_type, k, field1, field2)
+            for k, (check_type, field1, field2) in pending_checks.items()
+        ]
+        results = run_concurrently(funcs, max_concurrency=max_concurrency)
+
+        for k, check in zip(pending_checks.keys(), results):
+            checks[k] = check
+            print(f">> Field {k} Matching Result: {check}")
+
+        return checks
+
+        
+    def compare_fields(self, id_doc_dict, id_doc_from_db):
+        """
+        Compares the extracted fields to the database record.
+
+        :return: A tuple of the checks, in the order of the document fields, and the overall status.
+        """
+        console.print(40*"-")
+        print("-- Extracted Document --")
+        console.print(id_doc_dict)
+        console.print(40*"-")
+        print("-- Database Document --")
+        console.print(id_doc_from_db)
+        console.print(40*"-")
+
+        checks, pending_checks = self.collect_field_checks(id_doc_dict, id_doc_from_db)
+        checks.update(self.run_field_checks(pending_checks))
+
+        # Merge the results back in the order of the document fields
+        checks = {k: checks[k] for k in IDDocument.__fields__.keys() if k in checks}
         
         status = all([checks[check].result == "Same" for check in checks])
+        return checks, status
+
 
+    def compare_photos(self, id_doc_from_db):
+        """
+        Compares the face on the document to the reference photo of the database record.
+
+        :return: A tuple of the photo comparison result and the photo status.
+        """
         face_service = FaceRecognitionService()
-        photo_comparison_result = face_service.compare_document_photos(self.images[0], id_doc_from_db['photo'])
+        photo_comparison_result = face_service.compare_document_photos(self.images, id_doc_from_db['photo'], customer_id=id_doc_from_db.get('id'))
 
         if "error" in photo_comparison_result:
             photo_status = False
         else: 
             photo_status = photo_comparison_result["isIdentical"]
 
+        return photo_comparison_result, photo_status
+
+
+    def compare_document_to_database(self, customer_id = None, categoryId = COSMOS_CATEGORYID_VALUE, id_doc_from_db = None, limiter = None):
+        """
+        :param limiter: An optional ServiceLimiter, bounding the concurrency of each stage by the service it calls.
+        """
+
+        if customer_id is None: customer_id = self.customer_id
+        limited = limiter.wrap if limiter is not None else (lambda service, func: func)
+
+        # The stages run as a dependency graph: the photo comparison only needs the database record
+        # and the document image, so it runs alongside the extraction and the field checks
+        graph = StageGraph()
+        # The extraction holds the "openai" and "blob" limits itself, around its calls only
+        graph.add("extract", lambda: self.process_document(limiter=limiter))
+        # The caller may already have read the record, e.g. for its etag
+        graph.add("record", limited("cosmos", lambda: id_doc_from_db if id_doc_from_db is not None else cosmos.read_document(customer_id, partition_key=categoryId)))
+        graph.add("fields", limited("openai", lambda extract, record: self.compare_fields(IDDocumentProcessor.IDDocument_to_dict(extract['id_doc']), record)), depends_on=["extract", "record"])
+        graph.add("photo", limited("face", lambda record: self.compare_photos(record)), depends_on=["record"])
+        stages = graph.run()
+
+        id_doc_dict = IDDocumentProcessor.IDDocument_to_dict(stages['extract']['id_doc'])
+        photo_analysis_ret_dict = stages['extract']['photo_analysis_ret_dict']
+        checks, status = stages['fields']
+        photo_comparison_result, photo_status = stages['photo']
+
         # Define the structure for log checks
         log_checks = []
 
@@ -219,9 +354,34 @@ class IDDocumentProcessor():
             "data_fields_status": status,
             "photo_comparison_result": photo_comparison_result,
             "photo_comparison_status": photo_status,
-            "log_checks": log_checks
+            "log_checks": log_checks,
+            "stage_timings": graph.timings
         }
 
 
 
+def analyze_document(customer_id, document, categoryId = COSMOS_CATEGORYID_VALUE, limiter = None):
+    """
+    Analyzes a document against the customer record, the entry point shared by /api/analyze and the
+    batch jobs. Results are memoized by document content and record version: resubmissions are served
+    from the memo and concurrent identical submissions share a single run.
+
+    :param customer_id: The id of the customer record.
+    :param document: The DocumentBuffer of the ID document.
+    :param limiter: An optional ServiceLimiter, bounding the concurrency per downstream service.
+    :return: The compare_document_to_database result, also queued to the analysis log.
+    """
+    with service_limit(limiter, "cosmos"):
+        customer_record = cosmos.read_document(customer_id, partition_key=categoryId)
+
+    memo_key = analysis_memo.make_key(document.sha256, customer_id, (customer_record or {}).get("_etag"))
+
+    def analyze():
+        doc_processor = IDDocumentProcessor(customer_id=customer_id, document=document)
+        return doc_processor.compare_document_to_database(categoryId=categoryId, id_doc_from_db=customer_record, limiter=limiter)
+
+    result = analysis_memo.get_or_compute(memo_key, analyze)
 
+    # Every analysis is logged, memoized ones included, by the background writer
+    analysis_log.record(customer_id, document, result)
+    return result
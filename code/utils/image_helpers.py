@@ -0,0 +1,150 @@
+import io
+import base64
+import logging
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+from env_vars import *
+
+
+image_mime_types = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+    "GIF": "image/gif",
+    "BMP": "image/bmp",
+}
+
+
+def load_image_bytes(image):
+    """Returns the raw bytes of an image given as a file path, as bytes or as a DocumentBuffer."""
+    if isinstance(image, (bytes, bytearray)):
+        return bytes(image)
+
+    if hasattr(image, "data"):
+        return image.data
+
+    with open(image, "rb") as image_file:
+        return image_file.read()
+
+
+def auto_orient(img):
+    """Applies the EXIF orientation of phone photos, so the document is upright."""
+    return ImageOps.exif_transpose(img)
+
+
+def crop_to_document(img, min_area_ratio=0.2, margin_ratio=0.02, aspect_ratios=(1.3, 1.8)):
+    """
+    Crops the image to the largest quadrilateral contour with the proportions of an ID card,
+    which for a photo of a card on a table is the card itself. The image is returned untouched
+    when no convincing document outline is found, e.g. for scans that are already cropped.
+    """
+    width, height = img.size
+    scale = 800.0 / max(width, height) if max(width, height) > 800 else 1.0
+
+    small = np.array(img.convert("L").resize((max(1, int(width * scale)), max(1, int(height * scale)))))
+    edges = cv2.Canny(cv2.GaussianBlur(small, (5, 5), 0), 50, 150)
+    edges = cv2.dilate(edges, np.ones((5, 5), np.uint8), iterations=2)
+
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if len(contours) == 0:
+        return img
+
+    contour = max(contours, key=cv2.contourArea)
+    polygon = cv2.approxPolyDP(contour, 0.02 * cv2.arcLength(contour, True), True)
+    x, y, w, h = cv2.boundingRect(contour)
+    area_ratio = (w * h) / float(small.shape[0] * small.shape[1])
+    aspect_ratio = max(w, h) / float(max(1, min(w, h)))
+
+    # Only a four-cornered outline shaped like a card is trusted, otherwise we may cut off text
+    if (len(polygon) != 4) or not (aspect_ratios[0] <= aspect_ratio <= aspect_ratios[1]):
+        return img
+
+    # Too small is probably not the document, and almost the whole image is not worth cropping
+    if (area_ratio < min_area_ratio) or (area_ratio > 0.95):
+        return img
+
+    margin_x, margin_y = int(w * margin_ratio), int(h * margin_ratio)
+    box = (
+        max(0, int((x - margin_x) / scale)),
+        max(0, int((y - margin_y) / scale)),
+        min(width, int((x + w + margin_x) / scale)),
+        min(height, int((y + h + margin_y) / scale)),
+    )
+    return img.crop(box)
+
+
+def resize_long_edge(img, max_long_edge):
+    width, height = img.size
+    if max(width, height) <= max_long_edge:
+        return img
+
+    scale = max_long_edge / float(max(width, height))
+    return img.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.LANCZOS)
+
+
+def encode_image(img, image_format="JPEG", max_bytes=LLM_IMAGE_MAX_BYTES, quality=85, min_quality=50):
+    """
+    Encodes the image, lowering the quality and then the resolution until it fits in max_bytes.
+
+    :return: A tuple of (encoded bytes, MIME type).
+    """
+    image_format = image_format.upper()
+    if img.mode not in ["RGB", "L"]:
+        img = img.convert("RGB")
+
+    while True:
+        buffer = io.BytesIO()
+        img.save(buffer, format=image_format, quality=quality, optimize=True)
+        data = buffer.getvalue()
+
+        if (len(data) <= max_bytes) or (max(img.size) <= 256):
+            return data, image_mime_types[image_format]
+
+        if quality > min_quality:
+            quality = max(min_quality, quality - 10)
+        else:
+            img = img.resize((max(1, int(img.size[0] * 0.85)), max(1, int(img.size[1] * 0.85))), Image.LANCZOS)
+
+
+def prepare_image_for_llm(image, max_long_edge=LLM_IMAGE_MAX_LONG_EDGE, max_bytes=LLM_IMAGE_MAX_BYTES, image_format=LLM_IMAGE_FORMAT, crop=LLM_IMAGE_CROP_TO_DOCUMENT):
+    """
+    Prepares an image for the vision model: auto-orients it, crops it to the document, downsizes
+    it to max_long_edge and re-encodes it to a size-bounded JPEG/WebP. Smaller payloads mean
+    lower upload time, fewer image tokens and faster model latency.
+
+    :param image: A file path, the image bytes or a DocumentBuffer.
+    :return: A tuple of (encoded bytes, MIME type).
+    """
+    data = load_image_bytes(image)
+
+    try:
+        original = Image.open(io.BytesIO(data))
+        img = auto_orient(original)
+        if crop: img = crop_to_document(img)
+        img = resize_long_edge(img, max_long_edge)
+        encoded, mime_type = encode_image(img, image_format=image_format, max_bytes=max_bytes)
+
+        # Small images that were already compressed are not worth re-encoding
+        untouched = (img.size == original.size) and (original.getexif().get(0x0112, 1) == 1)
+        if untouched and (len(data) <= len(encoded)) and (original.format in image_mime_types):
+            return data, image_mime_types[original.format]
+        return encoded, mime_type
+    except Exception as e:
+        logging.warning(f"Could not preprocess image for the LLM, sending it as is: {e}")
+        return data, guess_image_mime_type(data)
+
+
+def guess_image_mime_type(data):
+    try:
+        return image_mime_types.get(Image.open(io.BytesIO(data)).format, "image/jpeg")
+    except Exception:
+        return "image/jpeg"
+
+
+def get_image_data_url(image):
+    """Returns the preprocessed image as a base64 data URL with the correct MIME type."""
+    data, mime_type = prepare_image_for_llm(image)
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode('ascii')}"
@@ -0,0 +1,283 @@
+import json
+import time
+import logging
+
+from openai import OpenAI
+from pydantic import TypeAdapter
+
+from utils.openai_helpers import get_azure_openai_client, get_resource_endpoint, build_structured_output_messages
+from utils.retry_helpers import openai_retry
+
+from env_vars import *
+
+
+batch_terminal_statuses = ["completed", "failed", "expired", "cancelled"]
+
+
+def get_batch_client():
+    """
+    Returns the client of the batch API: the local stand-in server when OPENAI_BATCH_ENDPOINT is
+    set, otherwise the Azure OpenAI resource of the Global-Batch deployment.
+    """
+    if OPENAI_BATCH_ENDPOINT:
+        return OpenAI(base_url=OPENAI_BATCH_ENDPOINT, api_key=AZURE_OPENAI_BATCH_KEY or "local", max_retries=0)
+
+    return get_azure_openai_client(get_resource_endpoint(AZURE_OPENAI_BATCH_RESOURCE), AZURE_OPENAI_BATCH_KEY, api_version=AZURE_OPENAI_BATCH_API_VERSION)
+
+
+def make_strict_json_schema(schema, defs=None):
+    """
+    Rewrites a JSON schema for the strict structured outputs, as the SDK does for
+    beta.chat.completions.parse: every object requires all its properties and allows no others
+    (except dicts, which keep the schema of their values), and the defaults, which strict mode does
+    not support, are dropped. A $ref with sibling keywords, e.g. a description, is inlined, since
+    strict mode does not allow them next to a $ref.
+
+    :param schema: A JSON schema, e.g. TypeAdapter(model).json_schema(). It is not modified.
+    :param defs: The $defs of the root schema, when rewriting a subschema.
+    :return: The strict schema.
+    """
+    if not isinstance(schema, dict):
+        return schema
+    if defs is None:
+        defs = schema.get("$defs", {})
+
+    schema = {key: value for key, value in schema.items() if key != "default"}
+
+    # Pydantic wraps a referenced model in a single allOf to describe it
+    if ("allOf" in schema) and (len(schema["allOf"]) == 1):
+        schema = {**schema.pop("allOf")[0], **schema}
+
+    if ("$ref" in schema) and (len(schema) > 1):
+        ref = schema.pop("$ref")
+        schema = {**defs[ref.split("/")[-1]], **schema}
+
+    if schema.get("type") == "object":
+        # A dict field keeps the schema of its values
+        schema.setdefault("additionalProperties", False)
+        if "properties" in schema:
+            schema["required"] = list(schema["properties"].keys())
+
+    for key in ["properties", "$defs"]:
+        if key in schema:
+            schema[key] = {name: make_strict_json_schema(subschema, defs) for name, subschema in schema[key].items()}
+    for key in ["anyOf", "allOf"]:
+        if key in schema:
+            schema[key] = [make_strict_json_schema(subschema, defs) for subschema in schema[key]]
+    if "items" in schema:
+        schema["items"] = make_strict_json_schema(schema["items"], defs)
+
+    return schema
+
+
+def get_json_schema_response_format(response_format):
+    """Converts a pydantic model to the strict json_schema response format of the REST API, as beta.chat.completions.parse does."""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": response_format.__name__,
+            "schema": make_strict_json_schema(TypeAdapter(response_format).json_schema()),
+            "strict": True,
+        }
+    }
+
+
+class BatchResult:
+    """The outcome of one request of a batch: the message content, or the error that replaced it."""
+
+    def __init__(self, custom_id, content=None, error=None):
+        self.custom_id = custom_id
+        self.content = content
+        self.error = error
+
+    @property
+    def ok(self):
+        return (self.error is None) and (self.content is not None)
+
+    def parse(self, response_format):
+        """Parses the content into the pydantic response format, like message.parsed of a synchronous call."""
+        if not self.ok:
+            raise ValueError(f"Batch request {self.custom_id} has no result: {self.error}")
+        return response_format.parse_raw(self.content)
+
+    def __repr__(self):
+        return f"BatchResult(custom_id={self.custom_id!r}, ok={self.ok}, error={self.error!r})"
+
+
+class OpenAIBatchRunner:
+    """
+    Runs structured-output chat completions through the Batch API instead of one synchronous call
+    each: the requests are written as JSONL, uploaded, submitted with a 24h completion window and
+    polled until the batch finishes. Batches trade latency for about half the price per token and
+    a separate quota, which is what bulk backfills need.
+
+    Example:
+        runner = OpenAIBatchRunner()
+        requests = [runner.request("doc-1", prompt, images, response_format=IDDocument)]
+        results = runner.run(requests)
+        id_doc = results["doc-1"].parse(IDDocument)
+    """
+
+    def __init__(self, client=None, deployment=AZURE_OPENAI_BATCH_DEPLOYMENT, poll_interval=OPENAI_BATCH_POLL_SECONDS, timeout=OPENAI_BATCH_TIMEOUT,
+                 max_requests=OPENAI_BATCH_MAX_REQUESTS, max_file_mb=OPENAI_BATCH_MAX_FILE_MB):
+        self.client = client if client is not None else get_batch_client()
+        self.deployment = deployment
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.max_requests = max_requests
+        self.max_file_bytes = int(max_file_mb * 1024 * 1024)
+
+    def request(self, custom_id, prompt_or_messages, images=[], response_format=None, temperature=0.2):
+        """
+        Builds one line of the batch input file, with the same messages as ask_LLM_with_structured_outputs.
+
+        :param custom_id: The id the result is mapped back with, unique within the batch.
+        :return: The request dict.
+        """
+        body = {
+            "model": self.deployment,
+            "temperature": temperature,
+            "messages": build_structured_output_messages(prompt_or_messages, images),
+        }
+        if response_format is not None:
+            body["response_format"] = get_json_schema_response_format(response_format)
+
+        return {"custom_id": custom_id, "method": "POST", "url": "/chat/completions", "body": body}
+
+    def split_requests(self, requests):
+        """Splits the requests into JSONL input files within the request count and file size limits."""
+        files = []
+        lines = []
+        size = 0
+
+        for request in requests:
+            line = (json.dumps(request) + "\n").encode("utf-8")
+            if lines and ((len(lines) >= self.max_requests) or (size + len(line) > self.max_file_bytes)):
+                files.append(b"".join(lines))
+                lines, size = [], 0
+            lines.append(line)
+            size += len(line)
+
+        if lines:
+            files.append(b"".join(lines))
+        return files
+
+    @openai_retry
+    def submit(self, jsonl):
+        """
+        Uploads a JSONL input file and creates its batch.
+
+        :return: The id of the batch.
+        """
+        input_file = self.client.files.create(file=("batch.jsonl", jsonl, "application/jsonl"), purpose="batch")
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint="/chat/completions", completion_window="24h")
+        request_count = jsonl.count(b"\n")
+        logging.info(f"Submitted OpenAI batch {batch.id} ({request_count} requests, {len(jsonl) / 1e6:.1f} MB).")
+        return batch.id
+
+    @openai_retry
+    def retrieve(self, batch_id):
+        return self.client.batches.retrieve(batch_id)
+
+    @openai_retry
+    def download(self, file_id):
+        return self.client.files.content(file_id).text
+
+    def wait(self, batch_ids, stop_event=None):
+        """
+        Polls the batches until they are all finished. Batches still running after the timeout, or
+        when stop_event is set, are cancelled: the results they already have are still returned.
+
+        :return: A dict of batch id to the final batch object.
+        """
+        deadline = time.time() + self.timeout
+        pending = list(batch_ids)
+        batches = {}
+
+        while pending:
+            for batch_id in list(pending):
+                batch = self.retrieve(batch_id)
+                if batch.status in batch_terminal_statuses:
+                    counts = batch.request_counts
+                    logging.info(f"OpenAI batch {batch_id} {batch.status}: {counts.completed if counts else '?'} completed, {counts.failed if counts else '?'} failed.")
+                    batches[batch_id] = batch
+                    pending.remove(batch_id)
+
+            if not pending:
+                break
+
+            if (time.time() > deadline) or ((stop_event is not None) and stop_event.is_set()):
+                for batch_id in pending:
+                    logging.warning(f"Cancelling OpenAI batch {batch_id}.")
+                    self.client.batches.cancel(batch_id)
+                deadline = float("inf")
+                stop_event = None
+
+            if stop_event is not None:
+                stop_event.wait(self.poll_interval)
+            else:
+                time.sleep(self.poll_interval)
+
+        return batches
+
+    def fetch_results(self, batch):
+        """
+        Downloads the output and error files of a finished batch.
+
+        :return: A dict of custom_id to BatchResult.
+        """
+        results = {}
+
+        if batch.output_file_id:
+            for line in self.download(batch.output_file_id).splitlines():
+                if not line.strip(): continue
+                output = json.loads(line)
+                custom_id = output["custom_id"]
+                response = output.get("response") or {}
+                body = response.get("body") or {}
+
+                if output.get("error") or (response.get("status_code", 200) != 200):
+                    results[custom_id] = BatchResult(custom_id, error=output.get("error") or body.get("error") or f"HTTP {response.get('status_code')}")
+                    continue
+
+                message = body["choices"][0]["message"]
+                if message.get("refusal"):
+                    results[custom_id] = BatchResult(custom_id, error=f"Refused: {message['refusal']}")
+                else:
+                    results[custom_id] = BatchResult(custom_id, content=message.get("content"))
+
+        if batch.error_file_id:
+            for line in self.download(batch.error_file_id).splitlines():
+                if not line.strip(): continue
+                output = json.loads(line)
+                error = output.get("error") or ((output.get("response") or {}).get("body") or {}).get("error")
+                results[output["custom_id"]] = BatchResult(output["custom_id"], error=error or "Unknown error")
+
+        return results
+
+    def run(self, requests, stop_event=None):
+        """
+        Submits the requests, waits for the batches and maps the results back by custom_id.
+        Requests without any result, e.g. from an expired batch, get a BatchResult with an error.
+
+        :param requests: A list of request dicts, from request().
+        :param stop_event: An optional threading.Event cancelling the batches when set.
+        :return: A dict of custom_id to BatchResult.
+        """
+        if len(requests) == 0:
+            return {}
+
+        batch_ids = [self.submit(jsonl) for jsonl in self.split_requests(requests)]
+        batches = self.wait(batch_ids, stop_event=stop_event)
+
+        results = {}
+        for batch_id, batch in batches.items():
+            results.update(self.fetch_results(batch))
+            if batch.status != "completed":
+                logging.warning(f"OpenAI batch {batch_id} ended as {batch.status}: {batch.errors}")
+
+        for request in requests:
+            if request["custom_id"] not in results:
+                results[request["custom_id"]] = BatchResult(request["custom_id"], error="No result returned by the batch.")
+
+        return results
@@ -1,6 +1,10 @@
 import base64
 import os
-from openai import AzureOpenAI
+import threading
+import asyncio
+import weakref
+from openai import AzureOpenAI, AsyncAzureOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+import httpx
 import tiktoken
 import PIL
 from PIL import Image
@@ -18,6 +22,10 @@ from tenacity import (
 
 import re
 
+from utils.openai_router import OpenAIRouter
+from utils.retry_helpers import openai_retry, call_with_circuit_breaker, get_deployment_name
+from utils.image_helpers import get_image_data_url, load_image_bytes
+
 ############# GLOBAL VARIABLES
 
 
@@ -48,60 +56,134 @@ def get_token_count(text, model = "gpt-4"):
 OPENAI_API_BASE = f"https://{os.getenv('AZURE_OPENAI_RESOURCE')}.openai.azure.com/"
 AZURE_OPENAI_EMBEDDING_API_BASE = f"https://{os.getenv('AZURE_OPENAI_EMBEDDING_MODEL_RESOURCE')}.openai.azure.com"
 
-oai_client = AzureOpenAI(
-    azure_endpoint = OPENAI_API_BASE, 
-    api_key= AZURE_OPENAI_KEY,  
-    api_version= AZURE_OPENAI_API_VERSION,
-)
 
-oai_emb_client = AzureOpenAI(
-    azure_endpoint = AZURE_OPENAI_EMBEDDING_API_BASE, 
-    api_key= AZURE_OPENAI_EMBEDDING_MODEL_RESOURCE_KEY,  
-    api_version= AZURE_OPENAI_EMBEDDING_MODEL_API_VERSION,
-)
+############# CLIENT REGISTRY
+
+# One keep-alive client per (endpoint, api_version, key), so that every call reuses the same
+# connection pool instead of paying a new TCP + TLS handshake. The SDK's own retries are turned
+# off, since retry_helpers owns the retry policy and would otherwise multiply them.
+client_registry = {}
+client_registry_lock = threading.Lock()
+
+# The async clients of each event loop, since their connection pools are bound to the loop they
+# were created on. Keyed by the loop itself, so that the entries of finished loops go away with them
+async_client_registry = weakref.WeakKeyDictionary()
+
+
+def get_httpx_limits():
+    return httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+    )
+
+
+def get_azure_openai_client(azure_endpoint, api_key, api_version = AZURE_OPENAI_API_VERSION):
+    key = ("sync", azure_endpoint.rstrip("/"), api_version, api_key)
+
+    with client_registry_lock:
+        client = client_registry.get(key)
+        if client is None:
+            client = AzureOpenAI(
+                azure_endpoint = azure_endpoint,
+                api_key = api_key,
+                api_version = api_version,
+                max_retries = 0,
+                http_client = DefaultHttpxClient(limits=get_httpx_limits()),
+            )
+            client_registry[key] = client
+
+    return client
+
+
+def get_async_azure_openai_client(azure_endpoint, api_key, api_version = AZURE_OPENAI_API_VERSION):
+    """Returns the async client of the running event loop for the endpoint, e.g. for OpenAIRouter.call_async."""
+    loop = asyncio.get_running_loop()
+    key = (azure_endpoint.rstrip("/"), api_version, api_key)
+
+    with client_registry_lock:
+        clients = async_client_registry.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            client = AsyncAzureOpenAI(
+                azure_endpoint = azure_endpoint,
+                api_key = api_key,
+                api_version = api_version,
+                max_retries = 0,
+                http_client = DefaultAsyncHttpxClient(limits=get_httpx_limits()),
+            )
+            clients[key] = client
+
+    return client
+
 
+async def close_async_azure_openai_clients():
+    """Closes the async clients of the running event loop and their connection pools, e.g. before the loop ends."""
+    with client_registry_lock:
+        clients = async_client_registry.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.close()
 
-# @retry(wait=wait_random_exponential(min=1, max=5), stop=(stop_after_delay(TENACITY_STOP_AFTER_DELAY) | stop_after_attempt(5)))             
+
+def get_resource_endpoint(resource):
+    # A full URL can be given instead of a resource name, e.g. for a local fake endpoint
+    if resource.startswith("http://") or resource.startswith("https://"):
+        return resource
+    return f"https://{resource}.openai.azure.com"
+
+
+def get_client_from_model_info(model_info):
+    return get_azure_openai_client(get_resource_endpoint(model_info['AZURE_OPENAI_RESOURCE']), model_info['AZURE_OPENAI_KEY'])
+
+
+oai_client = get_azure_openai_client(OPENAI_API_BASE, AZURE_OPENAI_KEY)
+
+oai_emb_client = get_azure_openai_client(AZURE_OPENAI_EMBEDDING_API_BASE, AZURE_OPENAI_EMBEDDING_MODEL_RESOURCE_KEY, api_version=AZURE_OPENAI_EMBEDDING_MODEL_API_VERSION)
+
+# Spreads the extraction and comparison calls over AZURE_OPENAI_RESOURCE and AZURE_OPENAI_RESOURCE_1..6
+openai_router = OpenAIRouter.from_env(get_azure_openai_client, get_async_azure_openai_client, get_resource_endpoint)
+
+
+@openai_retry
 def get_chat_completion(messages: List[dict], model = AZURE_OPENAI_MODEL, client = oai_client, temperature = AZURE_OPENAI_TEMPERATURE):
     # print(f"\nCalling OpenAI APIs with {len(messages)} messages - Model: {model} - Endpoint: {oai_client._base_url}\n")
-    return client.chat.completions.create(model = model, temperature = temperature, messages = messages, timeout=TENACITY_TIMEOUT)
+    return call_with_circuit_breaker(get_deployment_name(client, model), lambda: client.chat.completions.create(model = model, temperature = temperature, messages = messages, timeout=TENACITY_TIMEOUT))
 
 
-# @retry(wait=wait_random_exponential(min=1, max=5), stop=(stop_after_delay(TENACITY_STOP_AFTER_DELAY) | stop_after_attempt(5)))             
+@openai_retry
 def get_embeddings(text, embedding_model = AZURE_OPENAI_EMBEDDING_MODEL, client = oai_emb_client):
-    return client.embeddings.create(input=[text], model=embedding_model,timeout=TENACITY_TIMEOUT).data[0].embedding
+    return call_with_circuit_breaker(get_deployment_name(client, embedding_model), lambda: client.embeddings.create(input=[text], model=embedding_model,timeout=TENACITY_TIMEOUT)).data[0].embedding
 
-# @retry(wait=wait_random_exponential(min=1, max=5), stop=(stop_after_delay(TENACITY_STOP_AFTER_DELAY) | stop_after_attempt(5)))             
+@openai_retry
 def get_chat_completion_with_json(messages: List[dict], model = AZURE_OPENAI_MODEL, client = oai_client, temperature = AZURE_OPENAI_TEMPERATURE):
     # print(f"\nCalling OpenAI APIs with {len(messages)} messages - Model: {model} - Endpoint: {oai_client._base_url}\n")
-    return client.chat.completions.create(model = model, temperature = temperature, messages = messages, response_format={ "type": "json_object" },timeout=TENACITY_TIMEOUT)
+    return call_with_circuit_breaker(get_deployment_name(client, model), lambda: client.chat.completions.create(model = model, temperature = temperature, messages = messages, response_format={ "type": "json_object" },timeout=TENACITY_TIMEOUT))
 
 
-# @retry(wait=wait_random_exponential(min=1, max=5), stop=(stop_after_delay(TENACITY_STOP_AFTER_DELAY) | stop_after_attempt(5)))             
+@openai_retry
 def get_chat_completion_stream(messages: List[dict], model = AZURE_OPENAI_MODEL, client = oai_client, temperature = AZURE_OPENAI_TEMPERATURE):
     # print(f"\nCalling OpenAI APIs with {len(messages)} messages - Model: {model} - Endpoint: {oai_client._base_url}\n")
-    return client.chat.completions.create(model = model, temperature = temperature, messages = messages, timeout=TENACITY_TIMEOUT, stream=True)
+    return call_with_circuit_breaker(get_deployment_name(client, model), lambda: client.chat.completions.create(model = model, temperature = temperature, messages = messages, timeout=TENACITY_TIMEOUT, stream=True))
 
 
-# @retry(wait=wait_random_exponential(min=1, max=5), stop=(stop_after_delay(TENACITY_STOP_AFTER_DELAY) | stop_after_attempt(5)))             
+@openai_retry
 def get_chat_completion_with_functions(messages: List[dict], functions: List[dict], function_call: str="auto", model = AZURE_OPENAI_MODEL, client = oai_client, temperature = 0.2):
     # print(f"\nCalling OpenAI APIs with Function Calling with {len(messages)} messages - Model: {model} - Endpoint: {oai_client._base_url}\n")
-    return client.chat.completions.create(
+    return call_with_circuit_breaker(get_deployment_name(client, model), lambda: client.chat.completions.create(
         model = model,
         temperature=temperature,
         messages=messages,
         tools=functions,
         tool_choice=function_call,
         timeout=TENACITY_TIMEOUT
-    )
+    ))
 
 
 
 # Function to encode an image file in base64
 def get_image_base64(image_path):
-    with open(image_path, "rb") as image_file: 
-        encoded_string = base64.b64encode(image_file.read())
-        return encoded_string.decode('ascii')
+    encoded_string = base64.b64encode(load_image_bytes(image_path))
+    return encoded_string.decode('ascii')
 
 
 def extract_json(s):
@@ -115,11 +197,7 @@ def extract_json(s):
 def ask_LLM_with_images(images, labels, image_explanation_prompt = "You are a helpful vision assistant who will explain the attached image.", model_info = None, temperature = 0.2, with_json = False):
 
     if model_info is not None:
-        client = AzureOpenAI(
-                azure_endpoint =  f"https://{model_info['AZURE_OPENAI_RESOURCE']}.openai.azure.com" , 
-                api_key= model_info['AZURE_OPENAI_KEY'],  
-                api_version= AZURE_OPENAI_API_VERSION,
-            )
+        client = get_client_from_model_info(model_info)
         model = model_info['AZURE_OPENAI_MODEL']
     else:
         client = oai_client
@@ -138,7 +216,7 @@ def ask_LLM_with_images(images, labels, image_explanation_prompt = "You are a he
                     "type": "image_url",
                     "image_url": 
                     {
-                        "url": f"data:image/jpeg;base64,{get_image_base64(image)}",
+                        "url": get_image_data_url(image),
                     },
                 },
             ],
@@ -170,11 +248,7 @@ def ask_LLM(prompt_or_messages, temperature = 0.2, model_info = None):
         messages = prompt_or_messages
 
     if model_info is not None:
-        client = AzureOpenAI(
-                azure_endpoint =  f"https://{model_info['AZURE_OPENAI_RESOURCE']}.openai.azure.com" , 
-                api_key= model_info['AZURE_OPENAI_KEY'],  
-                api_version= AZURE_OPENAI_API_VERSION,
-            )
+        client = get_client_from_model_info(model_info)
         
         result = get_chat_completion(messages, model = model_info['AZURE_OPENAI_MODEL'], temperature = temperature, client=client)
     else:
@@ -186,11 +260,7 @@ def ask_LLM(prompt_or_messages, temperature = 0.2, model_info = None):
 
 def ask_LLM_streaming(messages, temperature= 0.2, model_info = None):
     if model_info is not None:
-        client = AzureOpenAI(
-                azure_endpoint =  f"https://{model_info['AZURE_OPENAI_RESOURCE']}.openai.azure.com" , 
-                api_key= model_info['AZURE_OPENAI_KEY'],  
-                api_version= AZURE_OPENAI_API_VERSION,
-            )
+        client = get_client_from_model_info(model_info)
         
         stream = get_chat_completion_stream(messages, model = model_info['AZURE_OPENAI_MODEL'], temperature = temperature, client=client)
     else:
@@ -210,11 +280,7 @@ def ask_LLM_with_JSON(prompt_or_messages, temperature = 0.2, model_info = None):
         messages = prompt_or_messages  
 
     if model_info is not None:
-        client = AzureOpenAI(
-                azure_endpoint =  f"https://{model_info['AZURE_OPENAI_RESOURCE']}.openai.azure.com" , 
-                api_key= model_info['AZURE_OPENAI_KEY'],  
-                api_version= AZURE_OPENAI_API_VERSION,
-            )
+        client = get_client_from_model_info(model_info)
         
         result = get_chat_completion_with_json(messages, model = model_info['AZURE_OPENAI_MODEL'], temperature = temperature, client=client)
     else:
@@ -241,11 +307,7 @@ def ask_LLM_with_functions(prompt_or_messages, functions_descr, functions = {},
 
 
     if model_info is not None:
-        client = AzureOpenAI(
-                azure_endpoint =  f"https://{model_info['AZURE_OPENAI_RESOURCE']}.openai.azure.com" , 
-                api_key= model_info['AZURE_OPENAI_KEY'],  
-                api_version= AZURE_OPENAI_API_VERSION,
-            )
+        client = get_client_from_model_info(model_info)
         
         result = get_chat_completion_with_functions(messages, functions=functions, model = model_info['AZURE_OPENAI_MODEL'], temperature = temperature, client=client)
     else:
@@ -296,22 +358,30 @@ def ask_LLM_with_functions(prompt_or_messages, functions_descr, functions = {},
         return result.choices[0].message.content
 
 
-def ask_LLM_with_structured_outputs(
-    prompt_or_messages, 
-    images=[], 
-    temperature=0.2, 
-    json_output=True, 
-    response_format={"type": "json_object"}
-):
+@openai_retry
+def get_chat_completion_parsed(messages: List[dict], temperature = AZURE_OPENAI_TEMPERATURE, response_format = None):
+    # Runs on the least loaded healthy deployment
+    return openai_router.call(lambda endpoint: endpoint.client.beta.chat.completions.parse(
+        model=endpoint.deployment,
+        temperature=temperature,
+        messages=messages,
+        response_format=response_format,
+        timeout=TENACITY_TIMEOUT
+    ))
 
-    # Initialize the Azure OpenAI client using the environment variables.
-    azure_client = AzureOpenAI(
-        azure_endpoint=f"https://{os.getenv('AZURE_OPENAI_RESOURCE')}.openai.azure.com", 
-        api_key=os.getenv('AZURE_OPENAI_KEY'), 
-        api_version= AZURE_OPENAI_API_VERSION,
-    )
+
+@openai_retry
+async def get_chat_completion_parsed_async(messages: List[dict], temperature = AZURE_OPENAI_TEMPERATURE, response_format = None):
+    return await openai_router.call_async(lambda endpoint: endpoint.async_client.beta.chat.completions.parse(
+        model=endpoint.deployment,
+        temperature=temperature,
+        messages=messages,
+        response_format=response_format,
+        timeout=TENACITY_TIMEOUT
+    ))
 
 
+def build_structured_output_messages(prompt_or_messages, images=[]):
     # Prepare the messages to be sent
     if isinstance(prompt_or_messages, str):
         messages = [
@@ -328,22 +398,28 @@ def ask_LLM_with_structured_outputs(
             "content": [
                 {
                     "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{get_image_base64(image)}"},
+                    "image_url": {"url": get_image_data_url(image)},
                 },
             ],
         }
         for image in images
     ]
-    messages += image_messages
+
+    return messages + image_messages
+
+
+def ask_LLM_with_structured_outputs(
+    prompt_or_messages, 
+    images=[], 
+    temperature=0.2, 
+    json_output=True, 
+    response_format={"type": "json_object"}
+):
+
+    messages = build_structured_output_messages(prompt_or_messages, images)
 
     # Call Azure OpenAI to get the chat completion with structured output
-    result = azure_client.beta.chat.completions.parse(
-        model=os.getenv('AZURE_OPENAI_CHAT_DEPLOYMENT_NAME'),
-        temperature=temperature,
-        messages=messages,
-        response_format=response_format if json_output else None
-    )
+    result = get_chat_completion_parsed(messages, temperature=temperature, response_format=response_format if json_output else None)
 
 
     return result.choices[0].message.parsed
-
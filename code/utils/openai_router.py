@@ -0,0 +1,247 @@
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+
+from env_vars import *
+from utils.retry_helpers import get_retry_after, is_endpoint_failure, RetryAfterError, get_circuit_breaker
+
+
+class NoHealthyEndpointError(RetryAfterError):
+    def __init__(self, retry_after):
+        super().__init__(f"All Azure OpenAI endpoints are ejected. Retry after {retry_after:.1f} seconds.", retry_after)
+
+
+class OpenAIEndpoint:
+    """One Azure OpenAI deployment, with its load and health state."""
+
+    def __init__(self, name, azure_endpoint, api_key, deployment, tokens_per_minute=0, client_factory=None, async_client_factory=None):
+        self.name = name
+        self.azure_endpoint = azure_endpoint
+        self.api_key = api_key
+        self.deployment = deployment
+        self.tokens_per_minute = tokens_per_minute
+        self.client_factory = client_factory
+        self.async_client_factory = async_client_factory
+
+        self.breaker = get_circuit_breaker(f"{azure_endpoint}|{deployment}")
+        self.outstanding = 0
+        self.ejected_until = 0.0
+        self.token_window = deque()
+        self.counters = {"requests": 0, "failures": 0, "ejections": 0}
+
+    @property
+    def client(self):
+        return self.client_factory(self.azure_endpoint, self.api_key)
+
+    @property
+    def async_client(self):
+        return self.async_client_factory(self.azure_endpoint, self.api_key)
+
+    def is_ejected(self, now):
+        return (self.ejected_until > now) or not self.breaker.is_available()
+
+    def available_in(self, now):
+        return max(self.ejected_until - now, self.breaker.retry_after(), 0.0)
+
+    def tokens_in_window(self, now):
+        while self.token_window and (self.token_window[0][0] < now - 60):
+            self.token_window.popleft()
+        return sum([tokens for _, tokens in self.token_window])
+
+    def budget_used(self, now):
+        """Fraction of the tokens-per-minute budget used in the last minute, 0 if there is no budget."""
+        if self.tokens_per_minute <= 0:
+            return 0.0
+        return self.tokens_in_window(now) / self.tokens_per_minute
+
+    def as_dict(self, now):
+        return {
+            "name": self.name,
+            "deployment": self.deployment,
+            "outstanding": self.outstanding,
+            "ejected_for": self.available_in(now),
+            "circuit": self.breaker.state,
+            "tokens_last_minute": self.tokens_in_window(now),
+            **self.counters,
+        }
+
+
+class OpenAIRouter:
+    """
+    Spreads the calls over all configured Azure OpenAI deployments. An endpoint is chosen by the
+    least number of outstanding requests, preferring endpoints still under their tokens-per-minute
+    budget. Endpoints returning 429/5xx are ejected for their Retry-After time, endpoints failing
+    repeatedly are cut off by their circuit breaker, and the call fails over to the next healthy endpoint.
+    """
+
+    def __init__(self, endpoints, eject_seconds=OPENAI_ROUTER_EJECT_SECONDS):
+        if len(endpoints) == 0:
+            raise ValueError("The router needs at least one Azure OpenAI endpoint.")
+
+        self.endpoints = endpoints
+        self.eject_seconds = eject_seconds
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, client_factory, async_client_factory, endpoint_builder):
+        """
+        Builds the router from AZURE_OPENAI_RESOURCE and AZURE_OPENAI_RESOURCE_1..6.
+
+        :param client_factory: Callable returning a pooled sync client for (azure_endpoint, api_key).
+        :param async_client_factory: Callable returning a pooled async client for (azure_endpoint, api_key).
+        :param endpoint_builder: Callable turning a resource name into its endpoint URL.
+        """
+        default_deployment = os.getenv('AZURE_OPENAI_CHAT_DEPLOYMENT_NAME', '')
+        configs = [("primary", os.getenv('AZURE_OPENAI_RESOURCE', ''), os.getenv('AZURE_OPENAI_KEY', ''), default_deployment, os.getenv('AZURE_OPENAI_TPM', '0'))]
+
+        for i in range(1, 7):
+            configs.append((
+                f"resource_{i}",
+                os.getenv(f'AZURE_OPENAI_RESOURCE_{i}', ''),
+                os.getenv(f'AZURE_OPENAI_KEY_{i}', ''),
+                os.getenv(f'AZURE_OPENAI_MODEL_{i}', default_deployment),
+                os.getenv(f'AZURE_OPENAI_TPM_{i}', '0'),
+            ))
+
+        endpoints = [
+            OpenAIEndpoint(name, endpoint_builder(resource), key, deployment, int(tpm or 0), client_factory, async_client_factory)
+            for name, resource, key, deployment, tpm in configs
+            if resource
+        ]
+
+        # The same deployment listed twice shares one quota: as two endpoints, a 429 on one would
+        # fail over to the same quota, and its tokens-per-minute budget would be counted twice
+        unique = {}
+        for endpoint in endpoints:
+            key = (endpoint.azure_endpoint.rstrip("/").lower(), endpoint.deployment)
+            if key in unique:
+                logging.warning(f"Azure OpenAI endpoint {endpoint.name} is the same deployment as {unique[key].name}, ignoring it.")
+                continue
+            unique[key] = endpoint
+        endpoints = list(unique.values())
+
+        # Keep the previous single-endpoint behavior when nothing is configured
+        if len(endpoints) == 0:
+            endpoints = [OpenAIEndpoint("primary", endpoint_builder(''), '', default_deployment, 0, client_factory, async_client_factory)]
+
+        logging.info(f"Azure OpenAI router configured with endpoints: {[e.name for e in endpoints]}")
+        return cls(endpoints)
+
+    def acquire(self, exclude=()):
+        """
+        Picks the endpoint for the next call and counts it as outstanding.
+
+        :param exclude: Endpoints already tried for this call.
+        :return: The chosen endpoint.
+        """
+        with self.lock:
+            now = time.time()
+            candidates = [e for e in self.endpoints if (e not in exclude) and not e.is_ejected(now)]
+
+            while len(candidates) > 0:
+                endpoint = self.pick(candidates, now)
+                # Claims the probe call if the endpoint's circuit breaker is half-open. The breaker
+                # is shared, so another caller may have claimed the probe since is_ejected
+                if endpoint.breaker.allow():
+                    endpoint.outstanding += 1
+                    endpoint.counters["requests"] += 1
+                    return endpoint
+                candidates.remove(endpoint)
+
+            raise NoHealthyEndpointError(min([e.available_in(now) for e in self.endpoints]))
+
+    def pick(self, candidates, now):
+        """:return: The candidate with the least outstanding requests, preferring the ones under their budget."""
+        under_budget = [e for e in candidates if e.budget_used(now) < 1.0]
+        if len(under_budget) > 0:
+            candidates = under_budget
+
+        lowest = min([(e.outstanding, e.budget_used(now)) for e in candidates])
+        return random.choice([e for e in candidates if (e.outstanding, e.budget_used(now)) == lowest])
+
+    def release(self, endpoint, tokens=0, error=None):
+        with self.lock:
+            now = time.time()
+            endpoint.outstanding -= 1
+            if tokens:
+                endpoint.token_window.append((now, tokens))
+
+            if (error is None) or not is_endpoint_failure(error):
+                endpoint.breaker.record_success()
+            else:
+                endpoint.breaker.record_failure()
+                retry_after = get_retry_after(error)
+                endpoint.ejected_until = now + (retry_after if retry_after is not None else self.eject_seconds)
+                endpoint.counters["failures"] += 1
+                endpoint.counters["ejections"] += 1
+                logging.warning(f"Ejecting Azure OpenAI endpoint {endpoint.name} for {endpoint.ejected_until - now:.1f} seconds: {error}")
+
+    def call(self, func):
+        """
+        Runs func(endpoint) on the best endpoint, failing over to the other healthy endpoints
+        when an endpoint throttles or fails. When no endpoint is usable, NoHealthyEndpointError
+        carries the time until the first one is back, for the retry layer to wait on.
+
+        :param func: A callable taking an OpenAIEndpoint and returning the OpenAI response.
+        :return: The response of the first endpoint that succeeded.
+        """
+        tried = []
+        last_error = None
+
+        while True:
+            try:
+                endpoint = self.acquire(exclude=tried)
+            except NoHealthyEndpointError as e:
+                raise e from last_error
+
+            try:
+                response = func(endpoint)
+            except Exception as e:
+                self.release(endpoint, error=e)
+                if not is_endpoint_failure(e): raise
+                tried.append(endpoint)
+                last_error = e
+                continue
+
+            self.release(endpoint, tokens=get_total_tokens(response))
+            return response
+
+    async def call_async(self, func):
+        """Async counterpart of call(), where func(endpoint) returns an awaitable."""
+        tried = []
+        last_error = None
+
+        while True:
+            try:
+                endpoint = self.acquire(exclude=tried)
+            except NoHealthyEndpointError as e:
+                raise e from last_error
+
+            try:
+                response = await func(endpoint)
+            except Exception as e:
+                self.release(endpoint, error=e)
+                if not is_endpoint_failure(e): raise
+                tried.append(endpoint)
+                last_error = e
+                continue
+
+            self.release(endpoint, tokens=get_total_tokens(response))
+            return response
+
+    def get_deployments(self):
+        """The deployments the calls can land on, e.g. to version cached model outputs."""
+        return sorted(set([e.deployment for e in self.endpoints]))
+
+    def get_stats(self):
+        with self.lock:
+            now = time.time()
+            return [e.as_dict(now) for e in self.endpoints]
+
+
+def get_total_tokens(response):
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", 0) or 0
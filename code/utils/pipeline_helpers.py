@@ -0,0 +1,77 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class StageGraph:
+    """
+    A small dependency graph of blocking pipeline stages. Each stage starts as soon as the stages
+    it depends on have finished, so independent branches run concurrently and the end-to-end
+    latency is that of the longest path instead of the sum of all the stages.
+
+    Example:
+        graph = StageGraph()
+        graph.add("extract", extract)
+        graph.add("record", read_record)
+        graph.add("fields", lambda extract, record: compare(extract, record), depends_on=["extract", "record"])
+        results = graph.run()
+    """
+
+    def __init__(self, max_concurrency=4):
+        self.max_concurrency = max_concurrency
+        self.stages = {}
+        self.timings = {}
+
+    def add(self, name, func, depends_on=()):
+        """
+        Adds a stage to the graph.
+
+        :param name: The name of the stage, also the keyword its result is passed as to its dependents.
+        :param func: The blocking callable, called with the results of its dependencies as keyword arguments.
+        :param depends_on: The names of the stages that must finish first.
+        """
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dependency}. Add the stages in dependency order.")
+
+        self.stages[name] = (func, list(depends_on))
+        return self
+
+    def run_stage(self, name, results):
+        func, depends_on = self.stages[name]
+        start = time.time()
+        try:
+            return func(**{dependency: results[dependency] for dependency in depends_on})
+        finally:
+            self.timings[name] = round(time.time() - start, 3)
+            logging.info(f"Stage {name} took {self.timings[name]:.3f} seconds.")
+
+    def run(self):
+        """
+        Runs all the stages in a dedicated pool, so that a graph running inside the shared
+        executor cannot starve it. The first exception raised by a stage is re-raised.
+
+        :return: A dict of stage name to its result. The per-stage durations in seconds are in self.timings.
+        """
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+        start = time.time()
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="kyc-stage") as executor:
+            while pending or running:
+                ready = [name for name, (_, depends_on) in pending.items() if all([d in results for d in depends_on])]
+                for name in ready:
+                    del pending[name]
+                    running[executor.submit(self.run_stage, name, dict(results))] = name
+
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        for other in running: other.cancel()
+                        raise future.exception()
+                    results[name] = future.result()
+
+        self.timings["total"] = round(time.time() - start, 3)
+        return results
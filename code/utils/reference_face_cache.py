@@ -0,0 +1,47 @@
+import time
+
+from utils.cache_helpers import *
+
+from env_vars import *
+
+
+class ReferenceFaceCache:
+    """
+    In-memory cache of the customer reference photos: the downloaded image and its face detection
+    results, keyed by customer id, photo URL and blob etag, so that a replaced photo is never
+    served from the cache. The Face API face ids only live for face_id_time_to_live seconds, so
+    entries remember when they were detected, and the caller re-detects from the cached bytes
+    (without downloading again) once the face ids are about to expire.
+    """
+
+    def __init__(self, ttl=REFERENCE_FACE_CACHE_TTL, max_entries=REFERENCE_FACE_CACHE_MAX_ENTRIES, refresh_margin=15):
+        self.stats = CacheStats()
+        self.cache = InMemoryCacheBackend(ttl=ttl, max_entries=max_entries, stats=self.stats)
+        self.refresh_margin = refresh_margin
+
+    def make_key(self, customer_id, photo_url, etag):
+        return make_cache_key("reference-face", customer_id or "", photo_url, etag)
+
+    def get(self, key):
+        """:return: The cached entry, a dict with the image, the detection results, and when they were detected, or None."""
+        entry = self.cache.get(key)
+        self.stats.increment("hits" if entry is not None else "misses")
+        return entry
+
+    def set(self, key, image, detection, face_id_time_to_live):
+        self.cache.set(key, {
+            "image": image,
+            "detection": detection,
+            "face_ids_expire_at": time.time() + face_id_time_to_live,
+        })
+        self.stats.increment("sets")
+
+    def face_ids_expired(self, entry):
+        # Refresh a bit early, so the face ids are still valid when the verify call lands
+        return time.time() > entry["face_ids_expire_at"] - self.refresh_margin
+
+    def get_stats(self):
+        return self.stats.as_dict()
+
+
+reference_face_cache = ReferenceFaceCache()
@@ -0,0 +1,311 @@
+import time
+import random
+import asyncio
+import logging
+import functools
+import threading
+
+from tenacity import (
+    retry,
+    stop_after_attempt,
+    stop_after_delay,
+    retry_if_exception,
+)
+
+from env_vars import *
+
+
+def get_status_code(error):
+    """Returns the HTTP status code of an OpenAI/HTTP error, or None if it has none."""
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code
+
+
+def get_retry_after(error):
+    """
+    Parses the rate-limit headers of a throttled or failed response.
+
+    :return: The number of seconds to wait, or None if the response did not say.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers is None:
+        return None
+
+    for header, scale in [("retry-after-ms", 0.001), ("x-ms-retry-after-ms", 0.001), ("retry-after", 1.0)]:
+        value = headers.get(header)
+        if value is None: continue
+        try:
+            return max(0.0, float(value) * scale)
+        except ValueError:
+            continue
+
+    return None
+
+
+def is_endpoint_failure(error):
+    """Throttling, server errors and connection errors make an endpoint temporarily unusable."""
+    status_code = get_status_code(error)
+    if status_code is None:
+        return type(error).__name__ in ["APIConnectionError", "APITimeoutError", "ConnectError", "ReadTimeout", "ConnectTimeout"]
+    return (status_code == 429) or (status_code >= 500)
+
+
+class RetryAfterError(Exception):
+    """Raised locally when a call must not be sent before `retry_after` seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RetryMetrics:
+    """Thread-safe counters of the retry layer, to watch retry amplification under load."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {
+            "calls": 0,
+            "attempts": 0,
+            "retries": 0,
+            "throttled": 0,
+            "server_errors": 0,
+            "connection_errors": 0,
+            "giveups": 0,
+            "rejected_locally": 0,
+            "backoff_seconds": 0.0,
+        }
+
+    def increment(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def record_error(self, error):
+        # Counted once per failed attempt of the retry layer. When the router ran out of endpoints
+        # after failing over, the attempt failed because of the last endpoint error, not locally
+        if isinstance(error, RetryAfterError) and (error.__cause__ is not None):
+            error = error.__cause__
+
+        status_code = get_status_code(error)
+        if status_code == 429:
+            self.increment("throttled")
+        elif (status_code is not None) and (status_code >= 500):
+            self.increment("server_errors")
+        elif isinstance(error, RetryAfterError):
+            self.increment("rejected_locally")
+        elif status_code is None:
+            self.increment("connection_errors")
+
+    def as_dict(self):
+        with self.lock:
+            metrics = dict(self.counters)
+        metrics["amplification"] = (metrics["attempts"] / metrics["calls"]) if metrics["calls"] > 0 else 0.0
+        return metrics
+
+
+retry_metrics = RetryMetrics()
+
+
+class CircuitOpenError(RetryAfterError):
+    def __init__(self, name, retry_after):
+        super().__init__(f"Circuit breaker for {name} is open. Retry after {retry_after:.1f} seconds.", retry_after)
+
+
+class CircuitBreaker:
+    """
+    Per-deployment circuit breaker. After `failure_threshold` consecutive failures it opens and
+    rejects calls for `reset_timeout` seconds, then lets a single probe call through (half-open):
+    a success closes it again, a failure re-opens it.
+    """
+
+    def __init__(self, name, failure_threshold=OPENAI_CIRCUIT_FAILURE_THRESHOLD, reset_timeout=OPENAI_CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.time() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def retry_after(self):
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.time() - self.opened_at))
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if (state == "half-open") and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            return False
+
+    def before_call(self):
+        if not self.allow():
+            raise CircuitOpenError(self.name, self.retry_after())
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.probe_in_flight = False
+
+    def is_available(self):
+        """Whether a call could be let through right now, without claiming the half-open probe."""
+        with self.lock:
+            state = self.state
+            return (state == "closed") or ((state == "half-open") and not self.probe_in_flight)
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.probe_in_flight or ((self.opened_at is None) and (self.consecutive_failures >= self.failure_threshold)):
+                logging.warning(f"Opening circuit breaker for {self.name} after {self.consecutive_failures} consecutive failures.")
+                self.opened_at = time.time()
+            self.probe_in_flight = False
+
+    def as_dict(self):
+        return {"state": self.state, "consecutive_failures": self.consecutive_failures, "retry_after": self.retry_after()}
+
+
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name):
+    with circuit_breakers_lock:
+        if name not in circuit_breakers:
+            circuit_breakers[name] = CircuitBreaker(name)
+        return circuit_breakers[name]
+
+
+def get_deployment_name(client, model):
+    return f"{getattr(client, 'base_url', '')}|{model}"
+
+
+def call_with_circuit_breaker(name, func):
+    """Runs func() under the circuit breaker of the given deployment."""
+    breaker = get_circuit_breaker(name)
+    breaker.before_call()
+
+    try:
+        result = func()
+    except Exception as e:
+        if is_endpoint_failure(e): breaker.record_failure()
+        else: breaker.record_success()
+        raise
+
+    breaker.record_success()
+    return result
+
+
+def is_retryable_error(error):
+    return isinstance(error, RetryAfterError) or is_endpoint_failure(error)
+
+
+def wait_rate_limit_aware(retry_state):
+    """
+    Honours the Retry-After headers of throttled responses, and otherwise waits with full-jitter
+    exponential backoff. The wait is capped so that the total latency budget is not exceeded.
+    """
+    error = retry_state.outcome.exception()
+    retry_after = error.retry_after if isinstance(error, RetryAfterError) else get_retry_after(error)
+
+    if retry_after is not None:
+        delay = retry_after + random.uniform(0, OPENAI_RETRY_BASE_DELAY)
+    else:
+        delay = random.uniform(0, min(OPENAI_RETRY_MAX_DELAY, OPENAI_RETRY_BASE_DELAY * (2 ** (retry_state.attempt_number - 1))))
+
+    remaining_budget = OPENAI_RETRY_BUDGET - retry_state.seconds_since_start
+    return max(0.0, min(delay, remaining_budget))
+
+
+def stop_if_retry_after_exceeds_budget(retry_state):
+    # No point in waiting for a Retry-After that ends beyond the latency budget
+    error = retry_state.outcome.exception()
+    if error is None:
+        return False
+    retry_after = error.retry_after if isinstance(error, RetryAfterError) else get_retry_after(error)
+    return (retry_after is not None) and (retry_state.seconds_since_start + retry_after > OPENAI_RETRY_BUDGET)
+
+
+def before_sleep_record(retry_state):
+    error = retry_state.outcome.exception()
+    sleep = retry_state.next_action.sleep if retry_state.next_action else 0
+    retry_metrics.increment("retries")
+    retry_metrics.increment("backoff_seconds", sleep)
+    logging.warning(f"Retrying {retry_state.fn.__name__} in {sleep:.2f} seconds after attempt {retry_state.attempt_number} failed: {error}")
+
+
+def record_giveup(retry_state):
+    retry_metrics.increment("giveups")
+    return retry_state.outcome.result()
+
+
+tenacity_retry = retry(
+    wait=wait_rate_limit_aware,
+    stop=(stop_after_delay(OPENAI_RETRY_BUDGET) | stop_after_attempt(OPENAI_RETRY_MAX_ATTEMPTS) | stop_if_retry_after_exceeds_budget),
+    retry=retry_if_exception(is_retryable_error),
+    before_sleep=before_sleep_record,
+    retry_error_callback=record_giveup,
+)
+
+
+def openai_retry(func):
+    """
+    Decorator adding the shared retry and backoff policy to an OpenAI call, for both sync and
+    async functions, while counting calls, attempts and errors in retry_metrics.
+    """
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def attempt_async(*args, **kwargs):
+            retry_metrics.increment("attempts")
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                retry_metrics.record_error(e)
+                raise
+
+        retrying_async = tenacity_retry(attempt_async)
+
+        @functools.wraps(func)
+        async def wrapper_async(*args, **kwargs):
+            retry_metrics.increment("calls")
+            return await retrying_async(*args, **kwargs)
+
+        return wrapper_async
+
+    @functools.wraps(func)
+    def attempt(*args, **kwargs):
+        retry_metrics.increment("attempts")
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            retry_metrics.record_error(e)
+            raise
+
+    retrying = tenacity_retry(attempt)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        retry_metrics.increment("calls")
+        return retrying(*args, **kwargs)
+
+    return wrapper
+
+
+def get_retry_stats():
+    with circuit_breakers_lock:
+        breakers = {name: breaker.as_dict() for name, breaker in circuit_breakers.items()}
+    return {"metrics": retry_metrics.as_dict(), "circuit_breakers": breakers}
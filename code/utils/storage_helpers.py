@@ -13,6 +13,7 @@ from azure.storage.blob import (
     ContainerClient,
     generate_blob_sas,
     BlobSasPermissions,
+    ContentSettings,
 )
 from azure.identity import DefaultAzureCredential
 
@@ -21,7 +22,6 @@ from env_vars import *
 class BlobStorageHelper:
     def __init__(self, storage_account_name = AZURE_STORAGE_ACCOUNT_NAME, container_name = AZURE_STORAGE_CONTAINER_NAME, category_id = COSMOS_CATEGORYID):
         self.work_dir = "temp_imgs"
-        os.makedirs(self.work_dir, exist_ok=True)
 
         self.storage_account_name = storage_account_name
         self.container_name = container_name
@@ -169,6 +169,23 @@ class BlobStorageHelper:
         logging.info(f"Uploaded {local_file_path} to {blob_url}")
         return blob_url
 
+    def upload_bytes(self, data, blob_name, content_type=None):
+        """
+        Uploads in-memory bytes to Azure Blob Storage, without going through a local file.
+
+        :param data: The bytes to upload.
+        :param blob_name: The name of the blob in storage.
+        :param content_type: The MIME type stored with the blob, so it is served correctly.
+        :return: The URL of the uploaded blob.
+        """
+        blob_client = self.container_client.get_blob_client(blob=blob_name)
+        content_settings = ContentSettings(content_type=content_type) if content_type else None
+        blob_client.upload_blob(data, overwrite=True, content_settings=content_settings)
+
+        blob_url = blob_client.url
+        logging.info(f"Uploaded {len(data)} bytes to {blob_url}")
+        return blob_url
+
     def download_document(self, blob_name, local_file_path = None):
         """
         Downloads a blob from Azure Blob Storage to a local file.
@@ -197,6 +214,42 @@ class BlobStorageHelper:
         return local_file_path
 
 
+    def get_blob_client_by_url(self, url):
+        parsed_url = urllib.parse.urlparse(url)
+        path = parsed_url.path
+        # Path format is /container/blob_name
+        path_parts = path.lstrip("/").split("/", 1)
+        if len(path_parts) != 2:
+            raise ValueError("URL path does not contain container and blob name")
+
+        container_name, blob_name = path_parts
+        return self.blob_service_client.get_blob_client(
+            container=container_name, blob=blob_name
+        )
+
+    def download_blob_bytes_by_url(self, url):
+        """
+        Downloads a blob from Azure Blob Storage using its URL, and returns its bytes.
+
+        :param url: The full URL of the blob to download.
+        :return: The content of the blob.
+        """
+        blob_client = self.get_blob_client_by_url(url)
+        data = blob_client.download_blob().readall()
+        logging.info(f"Downloaded blob {blob_client.blob_name} from {url} ({len(data)} bytes)")
+        return data
+
+    def get_blob_etag_by_url(self, url):
+        """
+        Returns the etag of a blob with a metadata-only request, to tell whether a cached copy
+        of the blob is still current without downloading it.
+
+        :param url: The full URL of the blob.
+        :return: The etag of the blob.
+        """
+        return self.get_blob_client_by_url(url).get_blob_properties().etag
+
+
     def download_blob_by_url(self, url, local_file_path=None):
         """
         Downloads a blob from Azure Blob Storage using its URL and saves it locally.
@@ -0,0 +1,137 @@
+import hashlib
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    # python-multipart before 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+from utils.document_buffer import DocumentBuffer
+
+from env_vars import *
+
+
+class UploadTooLargeError(ValueError):
+    pass
+
+
+class StreamingDocumentUpload:
+    """
+    Parses a multipart/form-data upload chunk by chunk, as the request body streams in, instead of
+    letting the framework spool the whole body before the endpoint runs. The file part is hashed on
+    the fly and its bytes are kept once, then handed to the pipeline as a DocumentBuffer with its
+    hash already computed. The other parts are small form fields, such as the customer id.
+
+    Example:
+        upload = StreamingDocumentUpload(request.headers["content-type"])
+        async for chunk in request.stream():
+            upload.write(chunk)
+        upload.finish()
+        document = upload.to_document()
+    """
+
+    # The form fields are small values, such as the customer id: the size left to the multipart
+    # headers and fields on top of the document, and the size and number of the fields
+    max_overhead = 64 * 1024
+    max_field_size = 8 * 1024
+    max_fields = 16
+
+    def __init__(self, content_type_header, max_size=UPLOAD_MAX_MB * 1024 * 1024):
+        """:param max_size: Size limit of the document, in bytes. The whole body may exceed it by max_overhead."""
+        content_type, params = parse_options_header(content_type_header or "")
+        if (content_type != b"multipart/form-data") or (b"boundary" not in params):
+            raise ValueError("Expected a multipart/form-data upload.")
+
+        self.max_size = max_size
+        self.fields = {}
+        self.filename = None
+        self.size = 0
+        self.body_size = 0
+
+        self.hasher = hashlib.sha256()
+        self.chunks = []
+
+        self.header_field = b""
+        self.header_value = b""
+        self.headers = {}
+        self.part_name = None
+        self.part_is_file = False
+        self.part_value = []
+        self.part_size = 0
+
+        self.parser = MultipartParser(params[b"boundary"], {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        })
+
+    def on_part_begin(self):
+        self.headers = {}
+        self.part_name = None
+        self.part_is_file = False
+        self.part_value = []
+        self.part_size = 0
+
+    def on_header_field(self, data, start, end):
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        self.headers[self.header_field.lower()] = self.header_value
+        self.header_field = b""
+        self.header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self.headers.get(b"content-disposition", b""))
+        self.part_name = options.get(b"name", b"").decode("utf-8")
+        self.part_is_file = b"filename" in options
+
+        if self.part_is_file:
+            if self.filename is not None:
+                raise ValueError("Upload a single document per request.")
+            self.filename = options[b"filename"].decode("utf-8")
+        elif len(self.fields) >= self.max_fields:
+            raise ValueError(f"The upload has more than {self.max_fields} form fields.")
+
+    def on_part_data(self, data, start, end):
+        chunk = data[start:end]
+        if self.part_is_file:
+            self.size += len(chunk)
+            if self.size > self.max_size:
+                raise UploadTooLargeError(f"The document is larger than {self.max_size / (1024 * 1024):.0f} MB.")
+            self.hasher.update(chunk)
+            self.chunks.append(bytes(chunk))
+        else:
+            self.part_size += len(chunk)
+            if self.part_size > self.max_field_size:
+                raise UploadTooLargeError(f"The form field {self.part_name} is larger than {self.max_field_size // 1024} KB.")
+            self.part_value.append(bytes(chunk))
+
+    def on_part_end(self):
+        if not self.part_is_file:
+            self.fields[self.part_name] = b"".join(self.part_value).decode("utf-8")
+
+    def write(self, chunk):
+        # Counts the whole body, headers and form fields included, not only the document
+        self.body_size += len(chunk)
+        if self.body_size > self.max_size + self.max_overhead:
+            raise UploadTooLargeError(f"The upload is larger than {self.max_size / (1024 * 1024):.0f} MB.")
+        self.parser.write(chunk)
+
+    def finish(self):
+        self.parser.finalize()
+
+    def to_document(self):
+        """:return: The DocumentBuffer of the uploaded file, with its SHA-256 already set."""
+        if self.filename is None:
+            raise ValueError("The upload does not contain any document.")
+
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return DocumentBuffer(self.filename, data, sha256=self.hasher.hexdigest())
@@ -0,0 +1,43 @@
+from utils.cache_helpers import *
+from utils.field_normalizer import normalize_text
+
+from env_vars import *
+
+
+class VerdictCache:
+    """
+    Content-addressed cache of the FieldChecker LLM verdicts. Entries are keyed by the check type,
+    the hash of the prompt template and the normalized pair of values, so editing a prompt
+    naturally invalidates its cached verdicts.
+    """
+
+    def __init__(self, backend="memory", ttl=VERDICT_CACHE_TTL, max_entries=VERDICT_CACHE_MAX_ENTRIES):
+        self.cache = JSONCache(create_cache_backend(backend, "verdicts", ttl=ttl, max_entries=max_entries))
+        self.prompt_hashes = {}
+
+    def make_key(self, check_type, prompt_template, field1, field2, field_name=""):
+        if prompt_template not in self.prompt_hashes:
+            self.prompt_hashes[prompt_template] = hash_text(prompt_template)
+
+        return make_cache_key(check_type, self.prompt_hashes[prompt_template], field_name, normalize_text(field1), normalize_text(field2))
+
+    def get(self, key):
+        """:return: The cached verdict ('Same', 'Different' or 'ToBeChecked'), or None."""
+        return self.cache.get(key)
+
+    def set(self, key, result):
+        self.cache.set(key, result)
+
+    @property
+    def enabled(self):
+        return self.cache.enabled
+
+    @property
+    def max_entries(self):
+        return self.cache.max_entries
+
+    def get_stats(self):
+        return self.cache.get_stats()
+
+
+verdict_cache = VerdictCache(backend=VERDICT_CACHE_BACKEND)
@@ -56,17 +56,9 @@ def analyze_documents():
     customer_id = st.session_state.customer_data.get('id', '')
     if customer_id:
 
-        info = {}
-        info['customer_id'] = customer_id
-        im_bytes = Image.open(io.BytesIO(st.session_state.selected_id_document))
-        buffered = io.BytesIO()
-        im_bytes.save(buffered, format="JPEG")  # or "PNG" depending on the image type
-        image_data = buffered.getvalue()
-        image_base64 = base64.b64encode(image_data).decode('utf-8')
-        info['id_document'] = image_base64
-        info['id_document_name'] = st.session_state.selected_id_document_name
-
-        response = requests.post(f'http://localhost:8000/api/analyze', json=info)
+        # The document is sent as is, as a multipart upload, instead of being re-encoded and base64-ed into JSON
+        files = {'id_document': (st.session_state.selected_id_document_name, st.session_state.selected_id_document)}
+        response = requests.post(f'http://localhost:8000/api/analyze/upload', data={'customer_id': customer_id}, files=files)
         if response.status_code == 200:
             data = response.json()
             st.session_state.extracted_data = data.get('document_id_extracted_data', {})
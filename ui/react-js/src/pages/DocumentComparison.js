@@ -89,13 +89,12 @@ function DocumentComparison() {
     try {
       setLoading(true);
       const fileData = uploadedFiles[selectedImageIndex];
-      const base64data = fileData.dataUrl.split(',')[1];
-      const info = {
-        customer_id: customerData.id,
-        id_document: base64data,
-        id_document_name: fileData.name,
-      };
-      const response = await axios.post(`${apiBaseUrl}/api/analyze`, info);
+      // Send the document as a multipart upload instead of base64 inside JSON
+      const blob = await (await fetch(fileData.dataUrl)).blob();
+      const formData = new FormData();
+      formData.append('customer_id', customerData.id);
+      formData.append('id_document', blob, fileData.name);
+      const response = await axios.post(`${apiBaseUrl}/api/analyze/upload`, formData);
 
       // Update extracted data and logs
       setExtractedData(response.data.document_id_extracted_data);